@@ -0,0 +1,235 @@
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'example')
+sys.path.insert(0, EXAMPLE_DIR)
+
+import numpy as np
+
+from idm import idm_parameters
+from integrators import make_integrator
+from kernels import numba_available, step_ring
+from metrics import StreamingMetrics
+from ring import initial_positions
+from simulation import DT, TOTAL_SIMULATIONS, make_ring, run_sweep, scenario_seeds, simulation_steps
+from trajectory import TrajectoryRecorder
+
+
+# Speed of the simulation hot path: the car following models stepped on headless rings of every size,
+# for every backend, and whole density sweeps. Every case runs in its own interpreter so that its peak
+# resident memory is its own. The results are written to a JSON file, which a later run compares against:
+#
+#   python benchmarks/hot_path.py --output benchmarks/baseline.json
+#   python benchmarks/hot_path.py --baseline benchmarks/baseline.json --output benchmarks/results.json
+#   python benchmarks/hot_path.py --compare benchmarks/baseline.json benchmarks/results.json
+
+# Vehicle counts of the density sweep in 'Environment', and large rings
+VEHICLE_COUNTS = [1, 2, 2, 4, 7, 11, 15, 18, 21, 24, 30, 40, 60, 80, 99]
+LARGE_VEHICLE_COUNTS = [1000, 10000, 100000]
+# The Car objects are stepped one by one in Python, and pandas writes CSV trajectories row by row:
+# larger rings take minutes, their trajectories are recorded into .npy arrays instead
+CAR_MAX_VEHICLES = 1000
+CSV_MAX_VEHICLES = 1000
+# Number of scenarios of the batched sweeps, as multiples of the density sweep
+SWEEP_REPEATS = [1, 10]
+MODELS = ['IDM', 'Custom']
+
+# Phases timed in every time step of a ring case
+PHASES = ['dynamics', 'metrics', 'trajectory', 'io']
+
+
+def ring_cases(vehicle_counts, backends, output_format):
+    return [{'kind': 'ring', 'model': model, 'backend': backend, 'num_vehicles': num_vehicles,
+             'output_format': output_format if num_vehicles <= CSV_MAX_VEHICLES else 'npy'}
+            for model in MODELS for backend in backends for num_vehicles in sorted(set(vehicle_counts))
+            if backend != 'car' or num_vehicles <= CAR_MAX_VEHICLES]
+
+
+def sweep_cases(repeats):
+    return [{'kind': 'sweep', 'model': model, 'backend': backend, 'scenarios': TOTAL_SIMULATIONS * repeat}
+            for model in MODELS for backend in ('numpy', 'batched') for repeat in repeats]
+
+
+def case_name(case):
+    if case['kind'] == 'ring':
+        return f"ring/{case['model']}/{case['backend']}/{case['num_vehicles']}"
+    return f"sweep/{case['model']}/{case['backend']}/{case['scenarios']}"
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_ring_case(case, steps, trajectory_directory):
+    # Step one ring like 'Environment.run' does and time each phase of every step
+    num_vehicles = case['num_vehicles']
+    start = time.perf_counter()
+    if case['output_format'] != 'npy':
+        # The trajectory is written with pandas, loaded here so that the I/O phase only times the writing
+        import pandas  # noqa: F401
+    positions = initial_positions(num_vehicles, 1000, np.random.default_rng(0).uniform)
+    # The 'numba' cases run the numpy backend with the compiled kernel, the 'numpy' cases always take the NumPy update
+    backend, kernel = ('numpy', 'numba') if case['backend'] == 'numba' else (case['backend'], 'numpy')
+    ring = make_ring(positions, 1000, positions[-1] - 1, case['model'], idm_parameters(), backend, kernel=kernel)
+    if kernel == 'numba':
+        # Importing Numba and loading the compiled step are part of the setup
+        step_ring(copy.deepcopy(ring), DT)
+    integrator = make_integrator('euler')
+    metrics = StreamingMetrics(np.ones(num_vehicles, dtype=bool))
+    recorder = TrajectoryRecorder(os.path.join(trajectory_directory, 'trajectory.csv'), steps,
+                                  output_format=case['output_format'])
+    recorder.start(1, num_vehicles)
+    setup = time.perf_counter() - start
+
+    # Writing the chunks is timed as I/O rather than as trajectory recording
+    phases = dict.fromkeys(PHASES, 0.0)
+    flush = recorder.flush
+
+    def timed_flush():
+        flush_start = time.perf_counter()
+        flush()
+        phases['io'] += time.perf_counter() - flush_start
+
+    recorder.flush = timed_flush
+
+    for step in range(steps):
+        time_elapsed = (step + 1) * DT
+        t0 = time.perf_counter()
+        previous_position = ring.position.copy()
+        integrator.advance(ring, DT)
+        t1 = time.perf_counter()
+        metrics.update(ring, previous_position, DT)
+        t2 = time.perf_counter()
+        io = phases['io']
+        recorder.record(time_elapsed, ring.position, ring.velocity, ring.acceleration)
+        t3 = time.perf_counter()
+        phases['dynamics'] += t1 - t0
+        phases['metrics'] += t2 - t1
+        phases['trajectory'] += t3 - t2 - (phases['io'] - io)
+
+    recorder.close()
+    metrics.summary()
+
+    vehicle_steps = num_vehicles * steps
+    return {'setup_seconds': setup, 'phase_seconds': phases,
+            'total_seconds': setup + sum(phases.values()),
+            'vehicle_steps': vehicle_steps,
+            'vehicle_steps_per_second': vehicle_steps / phases['dynamics']}
+
+
+def run_sweep_case(case):
+    # A whole density sweep in this process, the vehicle counts repeated with fresh seeds
+    vehicle_counts = VEHICLE_COUNTS * (case['scenarios'] // TOTAL_SIMULATIONS)
+    start = time.perf_counter()
+    run_sweep(vehicle_counts, scenario_seeds(len(vehicle_counts)), case['model'], idm_parameters(), case['backend'])
+    total = time.perf_counter() - start
+
+    vehicle_steps = sum(vehicle_counts) * simulation_steps()
+    return {'total_seconds': total, 'vehicle_steps': vehicle_steps,
+            'vehicle_steps_per_second': vehicle_steps / total}
+
+
+def run_case(case, steps):
+    with tempfile.TemporaryDirectory() as trajectory_directory:
+        if case['kind'] == 'ring':
+            result = run_ring_case(case, steps, trajectory_directory)
+        else:
+            result = run_sweep_case(case)
+    return dict(case, name=case_name(case), peak_rss_mb=peak_rss_mb(), **result)
+
+
+def run_in_subprocess(case, steps):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case),
+                             '--steps', str(steps)], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def compare(baseline, results, threshold):
+    # Cases slower or larger than the baseline by more than 'threshold' (a fraction) are regressions
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = baseline_cases.get(case['name'])
+        if old is None:
+            continue
+        speedup = case['vehicle_steps_per_second'] / old['vehicle_steps_per_second']
+        memory = case['peak_rss_mb'] / old['peak_rss_mb']
+        flags = []
+        if speedup < 1 - threshold:
+            flags.append('slower')
+        if memory > 1 + threshold:
+            flags.append('more memory')
+        print(f"{case['name']:<32} {speedup:6.2f}x speed {memory:6.2f}x peak RSS  {', '.join(flags)}")
+        if flags:
+            regressions.append(case['name'])
+
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {threshold:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the simulation hot path')
+    parser.add_argument('--output', default='benchmarks/results.json', help='JSON file of the results')
+    parser.add_argument('--steps', type=int, default=simulation_steps(), help='time steps of every ring case')
+    parser.add_argument('--backends', nargs='+', default=['car', 'numpy'] + (['numba'] if numba_available() else []),
+                        choices=['car', 'numpy', 'numba'],
+                        help='backends of the ring cases, numba for the compiled kernel of the numpy backend')
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'npy'], default='csv',
+                        help=f'trajectory format of the ring cases, .npy above {CSV_MAX_VEHICLES} vehicles')
+    parser.add_argument('--quick', action='store_true',
+                        help='only the density sweep rings and sweeps, without the large rings')
+    parser.add_argument('--baseline', default=None, help='compare the results against this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'), default=None,
+                        help='only compare two JSON files of results')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown or memory growth reported as a regression')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # Child process of a single case
+        print(json.dumps(run_case(json.loads(args.case), args.steps)))
+        return
+
+    if args.compare is not None:
+        with open(args.compare[0]) as baseline_file, open(args.compare[1]) as results_file:
+            regressions = compare(json.load(baseline_file), json.load(results_file), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    vehicle_counts = VEHICLE_COUNTS if args.quick else VEHICLE_COUNTS + LARGE_VEHICLE_COUNTS
+    cases = (ring_cases(vehicle_counts, args.backends, args.output_format) +
+             sweep_cases(SWEEP_REPEATS[:1] if args.quick else SWEEP_REPEATS))
+
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+               'steps': args.steps, 'cases': []}
+    for case in cases:
+        result = run_in_subprocess(case, args.steps)
+        results['cases'].append(result)
+        phases = ' '.join(f'{phase} {seconds:.3f}' for phase, seconds in result.get('phase_seconds', {}).items())
+        print(f"{result['name']:<32} {result['vehicle_steps_per_second']:>14,.0f} vehicle-steps/s "
+              f"{result['peak_rss_mb']:>8.1f} MB  {phases}", flush=True)
+
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import os
+import sys
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'example')
+sys.path.insert(0, EXAMPLE_DIR)
+
+import numpy as np
+
+import kernels
+from idm import idm_parameters
+from ring import Ring, initial_positions
+from simulation import DT, TOTAL_SIMULATIONS, run_scenario, scenario_seeds, simulation_steps
+
+
+# Parity of the compiled kernel of kernels.py with the NumPy update of 'Ring' and with the reference 'Car' loop.
+#  - kernel against NumPy: both update all vehicles from the previous time step, so their states must agree
+#    to rounding after every time step of the ring, and the fundamental diagram rows of the density sweep with
+#    them
+#  - kernel against Car: the Car loop updates the vehicles one after the other, so that a vehicle sees the
+#    updated state of its leader, a difference of first order in DT for the IDM as for the Custom model (whose
+#    safe step is the same in both updates). At DT the mean speeds differ by up to 10%, which a wrong update
+#    could hide in, so the rows of the density sweep are compared at DT / 10 only, where they agree within 1.5%
+# Without Numba, 'ring_step' runs in the interpreter, which checks the same code much more slowly.
+# Exits with an error when a case is out of tolerance.
+#
+#   python benchmarks/kernel_parity.py
+
+VEHICLE_COUNTS = [1, 2, 4, 7, 11, 15, 18, 21, 24, 30, 40, 60, 80, 99, 1000, 10000]
+MODELS = ['IDM', 'Custom']
+# Largest difference of positions (m) and velocities (m/s) between the kernel and the NumPy update, and largest
+# relative difference of the mean speeds and flows of their rows
+STATE_TOLERANCE = 1e-9
+ROW_TOLERANCE = 1e-9
+# Largest relative difference of the mean speeds to the Car loop at DT / 10
+FINE_SPEED_TOLERANCE = 0.015
+
+
+def kernel_step():
+    # The compiled step, or the interpreted one without Numba
+    if kernels.numba_available():
+        return kernels.compiled_ring_step()
+    return kernels.ring_step
+
+
+def state_difference(model, num_vehicles, steps):
+    # Largest differences of positions and velocities over 'steps' time steps of a ring
+    step = kernel_step()
+    params = idm_parameters()
+    positions = initial_positions(num_vehicles, 1000, np.random.default_rng(num_vehicles).uniform)
+    reference = Ring(positions, 1000, positions[-1] - 1, model, params)
+    ring = Ring(positions, 1000, positions[-1] - 1, model, params)
+
+    position_difference = velocity_difference = 0.0
+    for _ in range(steps):
+        reference.step(DT)
+        step(ring.position, ring.velocity, ring.acceleration, model == 'Custom', *(float(params[name]) for name in
+             ('S_MIN', 'T', 'A_MAX', 'B', 'DELTA', 'MAX_VELOCITY')), float(ring.edge),
+             float(ring.reference_position_x), float(ring.road_length), DT)
+        position_difference = max(position_difference, float(np.max(np.abs(ring.position - reference.position))))
+        velocity_difference = max(velocity_difference, float(np.max(np.abs(ring.velocity - reference.velocity))))
+    return position_difference, velocity_difference
+
+
+def relative_difference(value, reference):
+    return abs(value - reference) / max(abs(reference), 1e-9)
+
+
+def row_difference(model, num_vehicles, seed, backend, dt=DT):
+    # Relative differences of the mean speed and of the flow of a scenario of the kernel to 'backend'
+    row = run_scenario(num_vehicles, seed, idm_parameters(), model, 'numpy', dt=dt, kernel='numba')
+    reference = run_scenario(num_vehicles, seed, idm_parameters(), model, backend, dt=dt, kernel='numpy')
+    return relative_difference(row['speed'], reference['speed']), relative_difference(row['flow'], reference['flow'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity of the compiled kernel with the NumPy and Car updates')
+    parser.add_argument('--steps', type=int, default=simulation_steps(), help='time steps of every ring')
+    args = parser.parse_args()
+
+    if not kernels.numba_available():
+        print('Numba is not installed, checking the interpreted kernel against NumPy only')
+
+    failed = False
+    for model in MODELS:
+        for num_vehicles in VEHICLE_COUNTS:
+            if not kernels.numba_available() and num_vehicles > 100:
+                continue
+            position_difference, velocity_difference = state_difference(model, num_vehicles, args.steps)
+            ok = max(position_difference, velocity_difference) <= STATE_TOLERANCE
+            failed = failed or not ok
+            print(f'{model:<7} numpy {num_vehicles:>6d} vehicles  position {position_difference:.1e} m  '
+                  f'velocity {velocity_difference:.1e} m/s  {"ok" if ok else "FAIL"}')
+
+        if not kernels.numba_available():
+            continue
+        # The scenarios of the density sweep, against the NumPy update at DT and the Car loop at DT / 10
+        scenarios = list(zip(VEHICLE_COUNTS[:TOTAL_SIMULATIONS - 1], scenario_seeds(TOTAL_SIMULATIONS)))
+        for num_vehicles, seed in scenarios:
+            speed, flow = row_difference(model, num_vehicles, seed, 'numpy')
+            ok = max(speed, flow) <= ROW_TOLERANCE
+            failed = failed or not ok
+            print(f'{model:<7} row   {num_vehicles:>6d} vehicles  speed {speed:.1e}  flow {flow:.1e}  '
+                  f'{"ok" if ok else "FAIL"}')
+        for num_vehicles, seed in scenarios:
+            speed, _ = row_difference(model, num_vehicles, seed, 'car', DT / 10)
+            ok = speed <= FINE_SPEED_TOLERANCE
+            failed = failed or not ok
+            print(f'{model:<7} car   {num_vehicles:>6d} vehicles  speed {speed:7.1%}  at DT / 10  '
+                  f'{"ok" if ok else "FAIL"}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# Reproducibility of the data files, checked through the manifests of the runs (see example/manifest.py).
+# Every run takes place in a directory of its own, with the simulator of this repository:
+#  - shards of the density sweep, merged, against the serial run they were split from
+#  - the worker pool against the serial run
+#  - the batched backend, with 1 to 3 workers, against a serial run of the adaptive integrator
+#  - the batched backend, with 1 to 3 workers, against a serial run of the steady-state window
+#  - forks of the snapshots of the serial run, which must complete and write their manifest
+# Exits with an error when a case fails.
+#
+#   python benchmarks/reproducibility.py
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'example', 'simulator.py')
+SHARDS = 3
+
+
+def simulate(directory, *options):
+    # Run the simulator in 'directory' and return its exit code
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'figures'), exist_ok=True)
+    result = subprocess.run([sys.executable, SIMULATOR, '--no-render', '--no-plot', '--no-cache', *options],
+                            cwd=directory, capture_output=True, text=True)
+    if result.returncode:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else '', file=sys.stderr)
+    return result.returncode
+
+
+def manifest_file(directory):
+    return os.path.join(directory, 'data', 'manifest.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproducibility of the data files across runs')
+    parser.add_argument('--model', choices=['idm', 'custom'], default='idm', help='car following model of the runs')
+    parser.add_argument('--keep', action='store_true', help='keep the directories of the runs')
+    args = parser.parse_args()
+
+    model = f'--run-{args.model}'
+    root = tempfile.mkdtemp(prefix='reproducibility_')
+    cases = []
+
+    # Serial runs of reference, with and without the trajectory, which the worker pool does not record
+    serial = os.path.join(root, 'serial')
+    serial_headless = os.path.join(root, 'serial_headless')
+    snapshots = os.path.join(serial, 'data', 'snapshots')
+    cases.append(('serial run with snapshots', simulate(serial, model, '--backend', 'numpy', '--snapshot-time', '15',
+                                                         '--snapshot-directory', snapshots) == 0))
+    cases.append(('serial run without trajectory', simulate(serial_headless, model, '--backend', 'numpy',
+                                                             '--no-trajectory') == 0))
+
+    # Shards merged and verified against the serial run
+    shards = []
+    for shard in range(1, SHARDS + 1):
+        shards.append(os.path.join(root, f'shard_{shard}'))
+        cases.append((f'shard {shard}/{SHARDS}', simulate(shards[-1], model, '--backend', 'numpy',
+                                                         '--shard', f'{shard}/{SHARDS}') == 0))
+    cases.append((f'{SHARDS} shards merged against the serial run',
+                  simulate(os.path.join(root, 'merged'), model, '--merge-shards',
+                           *(os.path.join(shard, 'data') for shard in shards),
+                           '--verify', manifest_file(serial)) == 0))
+
+    # Worker pool against the serial run
+    cases.append(('3 workers against the serial run',
+                  simulate(os.path.join(root, 'workers'), model, '--backend', 'numpy', '--workers', '3',
+                           '--no-trajectory', '--verify', manifest_file(serial_headless)) == 0))
+
+    # Batched scenarios against the serial run, each with the substeps and error estimate of its own ring
+    adaptive = os.path.join(root, 'serial_adaptive')
+    cases.append(('serial run of the adaptive integrator',
+                  simulate(adaptive, model, '--backend', 'numpy', '--no-trajectory', '--integrator', 'adaptive',
+                           '--dt', '0.5') == 0))
+    for workers in range(1, 4):
+        cases.append((f'batched with {workers} workers against the serial run',
+                      simulate(os.path.join(root, f'batched_{workers}'), model, '--backend', 'batched',
+                               '--workers', str(workers), '--integrator', 'adaptive', '--dt', '0.5',
+                               '--no-trajectory', '--verify', manifest_file(adaptive)) == 0))
+
+    # Steady-state windows of batched scenarios, which start and stop their measurement at times of their own
+    steady_state = os.path.join(root, 'serial_steady_state')
+    cases.append(('serial run of the steady-state window',
+                  simulate(steady_state, model, '--backend', 'numpy', '--no-trajectory', '--steady-state') == 0))
+    for workers in range(1, 4):
+        cases.append((f'steady-state batched with {workers} workers',
+                      simulate(os.path.join(root, f'steady_state_{workers}'), model, '--backend', 'batched',
+                               '--workers', str(workers), '--steady-state', '--no-trajectory',
+                               '--verify', manifest_file(steady_state)) == 0))
+
+    # Forks of the snapshots of the serial run
+    forks = os.path.join(root, 'forks')
+    completed = simulate(forks, model, '--backend', 'numpy', '--fork', snapshots) == 0
+    if completed:
+        with open(manifest_file(forks)) as file:
+            completed = len(json.load(file)['scenarios']) == len(os.listdir(snapshots))
+    cases.append(('forks of the snapshots', completed))
+
+    for name, ok in cases:
+        print(f'{name:<50} {"ok" if ok else "FAIL"}')
+    if args.keep:
+        print(f'The runs are kept in {root}')
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(0 if all(ok for _, ok in cases) else 1)
+
+
+if __name__ == '__main__':
+    main()
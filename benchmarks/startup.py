@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Startup time of the headless simulation, in fresh interpreters as every sweep worker or short job pays it.
+# Fails when a headless entry point loads one of the rendering, plotting or export libraries, or when its
+# median startup time exceeds the budget.
+#
+#   python benchmarks/startup.py --repeat 10 --budget 0.75
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'example')
+
+HEAVY_MODULES = ('pygame', 'matplotlib', 'pandas', 'PIL')
+
+# Python code run by each fresh interpreter
+ENTRY_POINTS = {
+    'import simulation': 'import simulation',
+    'import environment': 'import environment',
+    'one headless scenario': 'from idm import idm_parameters\n'
+                             'from simulation import run_scenario\n'
+                             'run_scenario(15, 0, idm_parameters(), "IDM")',
+}
+
+REPORT = 'import json, sys\nprint(json.dumps(sorted(set(%r) & set(sys.modules))))' % (HEAVY_MODULES,)
+
+
+def time_entry_point(code, repeat):
+    # Wall time of 'repeat' fresh interpreters running 'code', and the heavy modules they loaded
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code + '\n' + REPORT], cwd=EXAMPLE_DIR,
+                                capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - start)
+        loaded = json.loads(result.stdout.splitlines()[-1])
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of the headless simulation')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per entry point')
+    parser.add_argument('--budget', type=float, default=0.75, help='largest median startup time in seconds')
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in ENTRY_POINTS.items():
+        times, loaded = time_entry_point(code, args.repeat)
+        median = statistics.median(times)
+        status = 'ok'
+        if loaded:
+            status = f"FAIL: loads {', '.join(loaded)}"
+        elif median > args.budget:
+            status = f'FAIL: over the budget of {args.budget:.2f} s'
+        failed = failed or status != 'ok'
+        print(f'{name:<24} median {median:.3f} s  min {min(times):.3f} s  {status}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
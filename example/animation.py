@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+
+from PIL import GifImagePlugin, Image
+
+
+class FrameWriter:
+    # Writes the frames of an animation as they are produced, so that memory use does not grow with
+    # the number of frames. Only every 'frame_skip'-th frame is kept, downscaled by 'scale'.
+    def __init__(self, path, frame_skip=1, scale=1.0, frame_duration=100):
+        self.path = path
+        self.frame_skip = frame_skip
+        self.scale = scale
+        # Display time of a written frame in milliseconds, covering the skipped frames as well
+        self.duration = frame_duration * frame_skip
+        self.frame_count = 0
+        self.frames_written = 0
+
+    def add(self, image):
+        self.frame_count += 1
+        if (self.frame_count - 1) % self.frame_skip:
+            return
+        if self.scale != 1:
+            size = (max(1, round(image.width * self.scale)), max(1, round(image.height * self.scale)))
+            image = image.resize(size, Image.BILINEAR)
+        self.write(image)
+        self.frames_written += 1
+
+    def write(self, image):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GifWriter(FrameWriter):
+    # Streams the frames into a looping GIF file. The palette of the first frame is reused for all
+    # frames, which saves computing a palette per frame and a local color table per frame in the file.
+    def __init__(self, path, frame_skip=1, scale=1.0, frame_duration=100):
+        super().__init__(path, frame_skip, scale, frame_duration)
+        self.file = open(path, 'wb')
+        self.palette = None
+
+    def write(self, image):
+        if self.palette is None:
+            self.palette = image.quantize(colors=256)
+            frame = self.palette
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': 0, 'duration': self.duration})
+            for block in header:
+                self.file.write(block)
+        else:
+            frame = image.quantize(palette=self.palette)
+
+        for block in GifImagePlugin.getdata(frame, duration=self.duration):
+            self.file.write(block)
+
+    def close(self):
+        # GIF trailer
+        self.file.write(b';')
+        self.file.close()
+
+
+class PngSequenceWriter(FrameWriter):
+    # Writes every frame to its own PNG file in the directory 'path'
+    def __init__(self, path, frame_skip=1, scale=1.0, frame_duration=100):
+        super().__init__(path, frame_skip, scale, frame_duration)
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, image):
+        image.save(os.path.join(self.path, f'frame_{self.frames_written:05d}.png'))
+
+
+class ThreadedFrameWriter:
+    # Converts, encodes and writes the frames of the 'FrameWriter' 'writer' on a thread of its own, fed by a
+    # bounded queue of raw RGB screen captures, so that the simulation thread only copies the pixels of the
+    # screen. No pygame call is made on this thread. An error of the thread is raised again by 'close'.
+    def __init__(self, writer, queue_size=8):
+        self.writer = writer
+        self.error = None
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.write_frames, daemon=True)
+        self.thread.start()
+
+    @property
+    def frames_written(self):
+        return self.writer.frames_written
+
+    def add(self, raw_data, size):
+        # Every frame is kept, the simulation waits when the queue is full
+        self.frames.put((raw_data, size))
+
+    def write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            if self.error is None:
+                try:
+                    self.writer.add(Image.frombytes("RGB", frame[1], frame[0]))
+                except Exception as error:
+                    # Keep emptying the queue, so that the simulation does not block on a full queue
+                    self.error = error
+
+    def close(self):
+        # Write the remaining frames and finish the file
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+def open_frame_writer(path, frame_skip=1, scale=1.0, frame_duration=100):
+    # A GIF file for paths ending in .gif, a directory of PNG files otherwise
+    if path.lower().endswith('.gif'):
+        return GifWriter(path, frame_skip, scale, frame_duration)
+    return PngSequenceWriter(path, frame_skip, scale, frame_duration)
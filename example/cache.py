@@ -0,0 +1,125 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# On-disk cache of the fundamental diagram rows of the scenarios, and optionally of their trajectories.
+# Entries are addressed by a hash of everything a scenario depends on: the model and its parameters,
+# the initial positions (which fix the vehicle count, the seed and the road length), the screen width,
+# the time step, the integrator, the backend, the measurement window, the number of lanes, the vehicle
+# population, the detectors, the kernel and the source code of the simulation core. Each entry is a directory
+# 'directory/ab/abcd...' holding 'row.json' and 'trajectory.npz'. The least recently used entries are removed
+# once the cache exceeds 'max_bytes'.
+
+CACHE_DIRECTORY = "data/cache"
+CACHE_SIZE = 512 * 2 ** 20
+
+# Sources whose changes invalidate the cached results
+SOURCE_FILES = ['car.py', 'config.py', 'detectors.py', 'environment.py', 'idm.py', 'integrators.py', 'kernels.py',
+                'lanes.py', 'measurement.py', 'metrics.py', 'population.py', 'ring.py', 'rng.py', 'simulation.py']
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    digest = hashlib.sha256()
+    for name in SOURCE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as source:
+            digest.update(name.encode() + b'\0' + source.read())
+    return digest.hexdigest()
+
+
+def scenario_key(model, params, positions, screen_width, dt, integrator, backend, steady_state, road_length, lanes=1,
+                 population=None, space_time=None, kernel=None):
+    # 'kernel' is the kernel selected for the ring (see kernels.py), None for the NumPy update
+    description = {'model': model,
+                   'params': {name: float(value) for name, value in sorted(params.items())},
+                   'num_vehicles': len(positions),
+                   'positions': hashlib.sha256(np.ascontiguousarray(positions, dtype=float).tobytes()).hexdigest(),
+                   'screen_width': screen_width, 'dt': dt, 'integrator': integrator, 'backend': backend,
+                   'steady_state': steady_state, 'road_length': road_length, 'lanes': lanes,
+                   'population': None if population is None else population.describe(), 'space_time': space_time,
+                   'kernel': kernel,
+                   'code_version': code_version()}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory=CACHE_DIRECTORY, max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, trajectory=False):
+        # The cached row, with the trajectory arrays (time, position, velocity, acceleration) if 'trajectory',
+        # or None when the scenario has not been cached (with its trajectory if asked for)
+        entry = self.entry(key)
+        row_file = os.path.join(entry, 'row.json')
+        trajectory_file = os.path.join(entry, 'trajectory.npz')
+        if not os.path.exists(row_file) or (trajectory and not os.path.exists(trajectory_file)):
+            self.misses += 1
+            return None
+
+        try:
+            with open(row_file) as file:
+                row = json.load(file)
+            arrays = None
+            if trajectory:
+                with np.load(trajectory_file) as data:
+                    arrays = tuple(data[name] for name in ('time', 'position', 'velocity', 'acceleration'))
+        except (OSError, ValueError):
+            # Evicted by another process in the meantime
+            self.misses += 1
+            return None
+
+        # The modification time of an entry is the time it was last used
+        os.utime(entry)
+        self.hits += 1
+        return (row, arrays) if trajectory else row
+
+    def put(self, key, row, trajectory=None):
+        # Entries are written to a temporary directory first, so a reader never sees half an entry
+        entry = self.entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temporary = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        with open(os.path.join(temporary, 'row.json'), 'w') as file:
+            json.dump(row, file)
+        if trajectory is not None:
+            np.savez(os.path.join(temporary, 'trajectory.npz'),
+                     **dict(zip(('time', 'position', 'velocity', 'acceleration'), trajectory)))
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # Written by another process in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits into 'max_bytes'.
+        # This scans the whole cache, so it is called once after a sweep rather than after every 'put'.
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
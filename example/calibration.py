@@ -0,0 +1,292 @@
+import csv
+import logging
+import math
+import time
+
+import numpy as np
+
+from idm import idm_parameters
+from simulation import (PIXEL_METERS_RATIO, SEED, road_length_of, run_sweep, scenario_positions,
+                        scenario_seeds)
+
+
+# Calibration of the IDM parameters against observed fundamental diagrams, e.g. data/flow_density_data.csv and
+# data/speed_density_data.csv. Every target point (density, flow and/or speed) is matched to the headless ring
+# scenarios whose density is closest to it, one per replication seed. A candidate set of parameters is scored by
+# the mean squared difference between the simulated and the observed flows and speeds, each relative to the
+# root mean square of its observations. The optimizers (CMA-ES and Nelder-Mead) search the unit cube spanned
+# by the bounds of the parameters and propose candidates in batches, whose scenarios run together in one sweep
+# (on 'BatchedRing' with the batched backend, spread over the workers).
+#  - Common random numbers: all candidates run the same scenarios, so the initial positions are the same and
+#    the differences between their losses come from the parameters alone.
+#  - Memoization: the loss of every candidate is kept for the whole calibration, and with a 'ResultCache'
+#    the rows of its scenarios are reused by later calibrations against other targets.
+
+CALIBRATION_PARAMETERS = ('T', 'A_MAX', 'B', 'DELTA', 'S_MIN', 'MAX_VELOCITY')
+# Default search space of the parameters
+PARAMETER_BOUNDS = {'T': (0.5, 3.0), 'A_MAX': (0.3, 4.0), 'B': (0.5, 4.0), 'DELTA': (1.0, 8.0), 'S_MIN': (0.5, 5.0),
+                    'MAX_VELOCITY': (5.0, 40.0)}
+OPTIMIZERS = ('cma-es', 'nelder-mead')
+# Largest ring considered when matching the target densities to scenarios
+MAX_VEHICLES = 200
+
+# Columns of the calibration history, see data/calibration_history_data_dictionary.csv
+CALIBRATION_FIELDS = ['evaluation', 'iteration', 'loss', *CALIBRATION_PARAMETERS]
+
+
+def read_targets(paths):
+    # Target points of the CSV files 'paths', each with a 'density' column and a 'flow' and/or 'speed' column.
+    # Returns the arrays of densities, flows and speeds, NaN where a file has no such column.
+    density, flow, speed = [], [], []
+    for path in paths:
+        with open(path, newline='') as file:
+            reader = csv.DictReader(file)
+            if 'density' not in reader.fieldnames or not {'flow', 'speed'} & set(reader.fieldnames):
+                raise ValueError(f"{path!r} needs a 'density' column and a 'flow' or 'speed' column")
+            for row in reader:
+                density.append(float(row['density']))
+                flow.append(float(row['flow']) if row.get('flow') not in (None, '') else np.nan)
+                speed.append(float(row['speed']) if row.get('speed') not in (None, '') else np.nan)
+    if not density:
+        raise ValueError("The calibration needs at least one target point")
+    return np.array(density), np.array(flow), np.array(speed)
+
+
+def parse_bounds(text):
+    # Bounds of the parameters, e.g. 'T=0.8:2,DELTA=2:6', replacing those of PARAMETER_BOUNDS
+    bounds = dict(PARAMETER_BOUNDS)
+    for item in filter(None, (part.strip() for part in (text or '').split(','))):
+        name, _, interval = item.partition('=')
+        low, _, high = interval.partition(':')
+        if name not in CALIBRATION_PARAMETERS:
+            raise ValueError(f"Unknown parameter {name!r}, expected one of {CALIBRATION_PARAMETERS}")
+        try:
+            bounds[name] = (float(low), float(high))
+        except ValueError:
+            raise ValueError(f"Bounds of {name} must be given as {name}=LOW:HIGH, got {item!r}") from None
+        if not bounds[name][0] < bounds[name][1]:
+            raise ValueError(f"The lower bound of {name} must be below its upper bound, got {item!r}")
+    return bounds
+
+
+def match_scenarios(densities, seeds, model, screen_width=1000):
+    # The vehicle count of every seed whose ring is closest to every target density.
+    # Returns an array of shape (targets, seeds).
+    counts = np.arange(1, MAX_VEHICLES + 1)
+    vehicle_counts = np.empty((len(densities), len(seeds)), dtype=int)
+    for column, seed in enumerate(seeds):
+        ring_densities = []
+        for num_vehicles in counts:
+            positions, _ = scenario_positions(num_vehicles, seed, screen_width, model)
+            road_length = road_length_of(screen_width, positions[-1] - 1)
+            ring_densities.append(num_vehicles / (road_length * PIXEL_METERS_RATIO))
+        vehicle_counts[:, column] = counts[np.argmin(np.abs(np.subtract.outer(densities, ring_densities)), axis=1)]
+    return vehicle_counts
+
+
+class Calibration:
+    # Loss of candidate parameters against the target points (density, flow, speed), see the top of this module.
+    # 'parameters' are calibrated within 'bounds', the others keep their values of idm.py. The scenarios run
+    # with the options of 'run_sweep'; the car backend reads the parameters of idm.py and cannot be calibrated.
+    def __init__(self, targets, model='IDM', parameters=CALIBRATION_PARAMETERS, bounds=None, replications=1,
+                 backend='batched', workers=None, integrator='euler', dt=None, steady_state=None, cache=None,
+                 kernel='auto', screen_width=1000, seed=SEED):
+        if model not in ('IDM', 'Custom'):
+            raise ValueError("The calibration runs the IDM or Custom model, use --run-idm or --run-custom")
+        if backend == 'car':
+            raise ValueError("The car backend reads the parameters of idm.py, calibrate with the numpy or batched "
+                             "backend")
+        unknown = set(parameters) - set(CALIBRATION_PARAMETERS)
+        if unknown or not parameters:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}, expected some of {CALIBRATION_PARAMETERS}")
+
+        self.density, self.flow, self.speed = targets
+        self.model = model
+        self.parameters = list(parameters)
+        bounds = bounds or PARAMETER_BOUNDS
+        self.lower = np.array([bounds[name][0] for name in self.parameters], dtype=float)
+        self.upper = np.array([bounds[name][1] for name in self.parameters], dtype=float)
+        self.options = {'backend': backend, 'screen_width': screen_width, 'workers': workers,
+                        'integrator': integrator, 'steady_state': steady_state, 'cache': cache, 'kernel': kernel}
+        if dt is not None:
+            self.options['dt'] = dt
+
+        # Scenarios of every target point, the same for all candidates, with the seeds of the first scenarios
+        # of a sweep of root 'seed'
+        seeds = scenario_seeds(replications, seed)
+        self.vehicle_counts = match_scenarios(self.density, seeds, model, screen_width)
+        self.scenarios = sorted({(int(num_vehicles), seed) for row in self.vehicle_counts
+                                 for num_vehicles, seed in zip(row, seeds)})
+        index = {scenario: position for position, scenario in enumerate(self.scenarios)}
+        self.target_scenarios = np.array([[index[int(num_vehicles), seed] for num_vehicles, seed in zip(row, seeds)]
+                                          for row in self.vehicle_counts])
+        # Scales of the flows and speeds, so that both count alike in the loss
+        self.flow_scale = np.sqrt(np.nanmean(self.flow ** 2)) if np.isfinite(self.flow).any() else 1.0
+        self.speed_scale = np.sqrt(np.nanmean(self.speed ** 2)) if np.isfinite(self.speed).any() else 1.0
+
+        # Loss of every candidate evaluated so far, and the history of the evaluations
+        self.losses = {}
+        self.history = []
+        self.iteration = 0
+        self.scenario_runs = 0
+
+    def parameters_of(self, point):
+        # IDM parameters of a point of the unit cube
+        params = idm_parameters()
+        values = self.lower + np.clip(point, 0, 1) * (self.upper - self.lower)
+        params.update({name: float(value) for name, value in zip(self.parameters, values)})
+        return params
+
+    def point_of(self, params):
+        return np.clip((np.array([params[name] for name in self.parameters], dtype=float) - self.lower) /
+                       (self.upper - self.lower), 0, 1)
+
+    def loss(self, rows):
+        # Mean squared relative difference of the simulated flows and speeds (averaged over the replications
+        # of every target) to the targets; infinite when a scenario broke down
+        flow = np.array([[rows[scenario]['flow'] for scenario in row] for row in self.target_scenarios]).mean(axis=1)
+        speed = np.array([[rows[scenario]['speed'] for scenario in row] for row in self.target_scenarios]).mean(axis=1)
+        residuals = np.concatenate([((flow - self.flow) / self.flow_scale)[np.isfinite(self.flow)],
+                                    ((speed - self.speed) / self.speed_scale)[np.isfinite(self.speed)]])
+        if not np.all(np.isfinite(residuals)):
+            return math.inf
+        return float(np.mean(residuals ** 2))
+
+    def evaluate(self, points):
+        # Losses of a batch of points of the unit cube. The scenarios of all new candidates run in one sweep.
+        self.iteration += 1
+        candidates = [self.parameters_of(point) for point in points]
+        keys = [tuple(params[name] for name in CALIBRATION_PARAMETERS) for params in candidates]
+        new = list(dict.fromkeys(key for key in keys if key not in self.losses))
+        if new:
+            vehicle_counts = [num_vehicles for _ in new for num_vehicles, _ in self.scenarios]
+            seeds = [seed for _ in new for _, seed in self.scenarios]
+            params = {name: np.repeat([key[position] for key in new], len(self.scenarios))
+                      for position, name in enumerate(CALIBRATION_PARAMETERS)}
+            rows = run_sweep(vehicle_counts, seeds, self.model, params, **self.options)
+            self.scenario_runs += len(rows)
+            for candidate, key in enumerate(new):
+                start = candidate * len(self.scenarios)
+                self.losses[key] = self.loss(rows[start:start + len(self.scenarios)])
+                self.history.append(dict(zip(CALIBRATION_PARAMETERS, key), evaluation=len(self.history) + 1,
+                                         iteration=self.iteration, loss=self.losses[key]))
+        return np.array([self.losses[key] for key in keys])
+
+    def best(self):
+        # Parameters and loss of the best candidate evaluated so far
+        entry = min(self.history, key=lambda entry: entry['loss'])
+        return {name: entry[name] for name in CALIBRATION_PARAMETERS}, entry['loss']
+
+
+def cma_es(evaluate, start, sigma, max_evaluations, rng, tolerance=1e-8):
+    # Covariance matrix adaptation evolution strategy (Hansen's "The CMA Evolution Strategy: A Tutorial") on the
+    # unit cube. Every generation is evaluated as one batch. Samples outside the cube are moved onto its faces,
+    # and the distribution is updated with the moved samples.
+    dimension = len(start)
+    population = 4 + int(3 * math.log(dimension))
+    parents = population // 2
+    weights = math.log(parents + 0.5) - np.log(np.arange(1, parents + 1))
+    weights /= weights.sum()
+    parents_effective = 1 / np.sum(weights ** 2)
+    c_c = (4 + parents_effective / dimension) / (dimension + 4 + 2 * parents_effective / dimension)
+    c_sigma = (parents_effective + 2) / (dimension + parents_effective + 5)
+    c_1 = 2 / ((dimension + 1.3) ** 2 + parents_effective)
+    c_mu = min(1 - c_1, 2 * (parents_effective - 2 + 1 / parents_effective) /
+               ((dimension + 2) ** 2 + parents_effective))
+    damping = 1 + 2 * max(0.0, math.sqrt((parents_effective - 1) / (dimension + 1)) - 1) + c_sigma
+    chi = math.sqrt(dimension) * (1 - 1 / (4 * dimension) + 1 / (21 * dimension ** 2))
+
+    mean = np.array(start, dtype=float)
+    covariance = np.eye(dimension)
+    path_c = np.zeros(dimension)
+    path_sigma = np.zeros(dimension)
+    evaluations = generation = 0
+    while evaluations < max_evaluations:
+        eigenvalues, basis = np.linalg.eigh(covariance)
+        scales = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        points = np.clip(mean + sigma * (rng.standard_normal((population, dimension)) * scales) @ basis.T, 0, 1)
+        losses = evaluate(points)
+        evaluations += population
+        generation += 1
+
+        order = np.argsort(losses, kind='stable')
+        steps = (points[order[:parents]] - mean) / sigma
+        step = weights @ steps
+        mean = mean + sigma * step
+        inverse_root = basis @ np.diag(1 / scales) @ basis.T
+        path_sigma = (1 - c_sigma) * path_sigma + math.sqrt(c_sigma * (2 - c_sigma) * parents_effective) * \
+            (inverse_root @ step)
+        norm = np.linalg.norm(path_sigma)
+        # The rank-one update is stalled while the step size grows quickly
+        h_sigma = norm / math.sqrt(1 - (1 - c_sigma) ** (2 * generation)) / chi < 1.4 + 2 / (dimension + 1)
+        path_c = (1 - c_c) * path_c + h_sigma * math.sqrt(c_c * (2 - c_c) * parents_effective) * step
+        covariance = (1 - c_1 - c_mu) * covariance + \
+            c_1 * (np.outer(path_c, path_c) + (1 - h_sigma) * c_c * (2 - c_c) * covariance) + \
+            c_mu * (steps.T * weights) @ steps
+        covariance = (covariance + covariance.T) / 2
+        sigma *= math.exp(c_sigma / damping * (norm / chi - 1))
+
+        finite = losses[np.isfinite(losses)]
+        if sigma * np.sqrt(eigenvalues.max()) < tolerance or (len(finite) == population and
+                                                               np.ptp(finite) < tolerance):
+            break
+
+
+def nelder_mead(evaluate, start, step, max_evaluations, tolerance=1e-8):
+    # Nelder-Mead simplex search on the unit cube. The reflection, expansion and both contractions of every
+    # iteration are evaluated together as one batch, and so are the points of a shrink.
+    dimension = len(start)
+    simplex = np.array([start] + [np.clip(start + step * np.eye(dimension)[axis] *
+                                          (1 if start[axis] + step <= 1 else -1), 0, 1) for axis in range(dimension)])
+    losses = evaluate(simplex)
+    evaluations = len(simplex)
+    while evaluations < max_evaluations:
+        order = np.argsort(losses, kind='stable')
+        simplex, losses = simplex[order], losses[order]
+        if np.max(np.abs(simplex[1:] - simplex[0])) < tolerance or \
+                (np.all(np.isfinite(losses)) and losses[-1] - losses[0] < tolerance):
+            break
+
+        centroid = simplex[:-1].mean(axis=0)
+        direction = centroid - simplex[-1]
+        reflection, expansion, outside, inside = (np.clip(centroid + factor * direction, 0, 1)
+                                                  for factor in (1, 2, 0.5, -0.5))
+        reflection_loss, expansion_loss, outside_loss, inside_loss = evaluate(
+            np.array([reflection, expansion, outside, inside]))
+        evaluations += 4
+
+        if reflection_loss < losses[0]:
+            simplex[-1], losses[-1] = (expansion, expansion_loss) if expansion_loss < reflection_loss else \
+                (reflection, reflection_loss)
+        elif reflection_loss < losses[-2]:
+            simplex[-1], losses[-1] = reflection, reflection_loss
+        elif reflection_loss < losses[-1] and outside_loss <= reflection_loss:
+            simplex[-1], losses[-1] = outside, outside_loss
+        elif reflection_loss >= losses[-1] and inside_loss < losses[-1]:
+            simplex[-1], losses[-1] = inside, inside_loss
+        else:
+            # Shrink towards the best point
+            simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+            losses[1:] = evaluate(simplex[1:])
+            evaluations += dimension
+
+
+def calibrate(calibration, optimizer='cma-es', max_evaluations=300, step=0.2, seed=SEED, start=None):
+    # Fit the parameters of 'calibration' with 'optimizer', starting from the IDM parameters 'start' (those of
+    # idm.py by default) with steps of 'step' of the width of the bounds. Returns the best parameters and loss.
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer {optimizer!r}, expected one of {OPTIMIZERS}")
+    start = calibration.point_of(start or idm_parameters())
+    start_time = time.perf_counter()
+    # The starting point is the reference the calibration improves on
+    calibration.evaluate(start[np.newaxis])
+    if optimizer == 'cma-es':
+        cma_es(calibration.evaluate, start, step, max_evaluations, np.random.default_rng(seed))
+    else:
+        nelder_mead(calibration.evaluate, start, step, max_evaluations)
+
+    params, loss = calibration.best()
+    logging.info(f"Calibrated {', '.join(f'{name}={params[name]:.4g}' for name in calibration.parameters)} "
+                 f"with loss {loss:.4g} after {len(calibration.history)} candidates, "
+                 f"{calibration.scenario_runs} scenarios and {time.perf_counter() - start_time:.1f} s")
+    return params, loss
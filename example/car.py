@@ -1,24 +1,15 @@
 import math
 
+import numpy as np
 import pygame
 from pygame.math import Vector2
-import matplotlib
 
 import config as c
-
-matplotlib.use('PS')
+# IDM related parameters, see idm.py
+from idm import A_MAX, B, DELTA, MAX_VELOCITY, S_MIN, T, idm_parameters
 
 reference_position = pygame.Vector2()
 
-# IDM related parameters
-# TODO Define parameter specifications of your IDM model
-T = 1
-A_MAX = 2
-B = 1.5
-DELTA = 4
-S_MIN = 1
-MAX_VELOCITY = 25
-
 
 class Car:
     def __init__(self, x, y, id_value, screen_width):
@@ -200,3 +191,47 @@ class Car:
             self.position = reference_position + position_change
         else:
             self.position += position_change
+
+
+class CarRing:
+    # Adapter running a list of 'Car' objects behind the same interface as 'ring.Ring'.
+    # Vehicles are updated one after the other, so each vehicle sees the new position of its leader.
+    def __init__(self, positions, screen_width, reference_position_x, model):
+        self.model = model
+        self.reference_position_x = reference_position_x
+        self.cars = [Car(x, 2, id_value, screen_width) for id_value, x in enumerate(positions)]
+
+    def __len__(self):
+        return len(self.cars)
+
+    @property
+    def position(self):
+        return np.array([car.position.x for car in self.cars])
+
+    @property
+    def velocity(self):
+        return np.array([car.velocity.x for car in self.cars])
+
+    @property
+    def acceleration(self):
+        return np.array([car.acceleration[0] for car in self.cars])
+
+    def lead_gap(self):
+        cars = self.cars
+        return np.array([car.compute_current_lead_gap(cars[x - 1], self.reference_position_x).x
+                         for x, car in enumerate(cars)])
+
+    def headway(self):
+        # The Car objects are points, so the distance to the front of the vehicle in front is the lead gap
+        return self.lead_gap()
+
+    def step(self, dt):
+        cars = self.cars
+        for x,_ in enumerate(cars):
+            if x == 0:
+                cars[x].car_following_model(dt, cars[len(cars) - 1], cars[min(len(cars)-1, 1)],
+                self.reference_position_x, self.model)
+            elif x < len(cars) -1:
+                cars[x].car_following_model(dt, cars[x - 1], cars[x + 1], self.reference_position_x, self.model)
+            else:
+                cars[x].car_following_model(dt, cars[x - 1], cars[0], self.reference_position_x, self.model)
@@ -0,0 +1,79 @@
+import os
+import pickle
+import tempfile
+import time
+
+
+# Checkpoints and snapshots of the simulation state, written with pickle.
+#  - A checkpoint holds everything 'Environment.run' needs to carry on where it stopped: the environment
+#    (simulation count, data writers with the offsets of their open files, see 'TableWriter' and
+#    'TrajectoryRecorder') and the scenario in progress (ring, integrator, metrics, measurement window,
+#    detectors). The random numbers of a scenario are all drawn when it starts (see rng.py). A run resumed
+#    from it writes the same data files as a run that was never interrupted.
+#  - A snapshot holds the ring of one scenario at a given simulated time, to fork variants of the scenario
+#    from its warmed-up state (see 'simulation.fork_scenario').
+# Pickles are only loaded from files written by the simulation itself.
+
+CHECKPOINT_FILE = "data/checkpoint.pkl"
+SNAPSHOT_DIRECTORY = "data/snapshots"
+
+
+def save_state(path, state):
+    # The state is written to a temporary file first, so a run killed while writing leaves the previous file
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(file_descriptor, 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def load_state(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+class Checkpoints:
+    # Saves a checkpoint to 'path' whenever 'interval' seconds of wall-clock time have passed since the
+    # last one
+    def __init__(self, path=CHECKPOINT_FILE, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.last = time.perf_counter()
+
+    def due(self):
+        return time.perf_counter() - self.last >= self.interval
+
+    def save(self, state):
+        save_state(self.path, state)
+        self.last = time.perf_counter()
+
+
+class Snapshot:
+    # The ring of scenario 'simulation' after 'time_elapsed' seconds. 'snapshot_time' is the time asked for,
+    # all time steps ending after it are still to be run.
+    def __init__(self, simulation, time_elapsed, snapshot_time, ring, num_vehicles, road_length, backend, dt,
+                 lanes=1, vehicles=None):
+        self.simulation = simulation
+        self.time_elapsed = time_elapsed
+        self.snapshot_time = snapshot_time
+        self.ring = ring
+        self.num_vehicles = num_vehicles
+        self.road_length = road_length
+        self.backend = backend
+        self.dt = dt
+        self.lanes = lanes
+        self.vehicles = vehicles
+
+
+def snapshot_file(directory, simulation):
+    return os.path.join(directory, f'simulation_{simulation:03d}.pkl')
+
+
+def load_snapshots(directory):
+    # The snapshots of 'directory' in the order of their simulations
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith('simulation_') and name.endswith('.pkl'))
+    if not names:
+        raise ValueError(f"No snapshots in {directory!r}, take them with --snapshot-time")
+    return [load_state(os.path.join(directory, name)) for name in names]
@@ -0,0 +1,182 @@
+import numpy as np
+
+
+# Measurements of a ring taken while it runs, instead of post-processing the trajectory:
+#  - virtual loop detectors at any positions along the ring, counting the vehicles passing them
+#  - an Edie space-time grid: in every cell of 'cell_length' by 'interval', the flow is the total distance
+#    travelled in the cell over its area, the density the total time spent in the cell over its area and the
+#    speed their ratio (Edie, 1963). Every vehicle spends each time step in the cell of its position at the
+#    start of the step.
+# Both are updated after every time step of the whole simulation and closed every 'interval' seconds, so
+# they also give the space-time diagrams of the scenario. Positions are those of the ring: vehicles beyond
+# the edge re-enter the road at the reference position (see 'Ring.update_car_position').
+
+# Densities are scaled like the 'density' column of the fundamental diagrams
+PIXEL_METERS_RATIO = 0.04
+
+
+def distance_travelled(previous_position, position, reference_position_x):
+    # Distance covered in a time step, vehicles that wrapped around restart at the reference position
+    return np.where(position >= previous_position, position - previous_position, position - reference_position_x)
+
+
+class LoopDetectors:
+    # Detectors at 'positions' along the ring. Per interval, every detector counts the passing vehicles
+    # and sums their speeds and inverse speeds: the time-mean speed is the mean of the speeds, the
+    # space-mean speed their harmonic mean, and the density the flow over the space-mean speed.
+    def __init__(self, positions, interval_steps, dt):
+        self.positions = np.asarray(positions, dtype=float)
+        self.interval_steps = interval_steps
+        self.interval_time = interval_steps * dt
+        self.steps = 0
+        self.counts = np.zeros(len(self.positions))
+        self.speed_sums = np.zeros(len(self.positions))
+        self.inverse_speed_sums = np.zeros(len(self.positions))
+        self.intervals = {'time': [], 'counts': [], 'speed_sums': [], 'inverse_speed_sums': []}
+
+    def update(self, ring, previous_position, time_elapsed):
+        position, velocity = ring.position, ring.velocity
+        detectors = self.positions[:, None]
+        # A vehicle that wrapped around passes the detectors after its previous position and before its new one
+        wrapped = position < previous_position
+        passed = np.where(wrapped, (previous_position < detectors) | (detectors <= position),
+                          (previous_position < detectors) & (detectors <= position))
+        self.counts += passed.sum(axis=1)
+        self.speed_sums += passed @ velocity
+        with np.errstate(divide='ignore'):
+            self.inverse_speed_sums += passed @ np.where(velocity > 0, 1 / velocity, 0.0)
+
+        self.steps += 1
+        if self.steps == self.interval_steps:
+            self.close_interval(time_elapsed)
+
+    def close_interval(self, time_elapsed):
+        self.intervals['time'].append(time_elapsed)
+        self.intervals['counts'].append(self.counts.copy())
+        self.intervals['speed_sums'].append(self.speed_sums.copy())
+        self.intervals['inverse_speed_sums'].append(self.inverse_speed_sums.copy())
+        self.counts[...] = 0
+        self.speed_sums[...] = 0
+        self.inverse_speed_sums[...] = 0
+        self.steps = 0
+
+    def arrays(self):
+        # Space-time diagrams (interval x detector) of the flow (veh/s), time-mean speed and space-mean speed (m/s)
+        counts = np.array(self.intervals['counts']).reshape(-1, len(self.positions))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'time': np.array(self.intervals['time']), 'position': self.positions,
+                    'flow': counts / self.interval_time,
+                    'time_mean_speed': np.array(self.intervals['speed_sums']).reshape(counts.shape) / counts,
+                    'space_mean_speed': counts / np.array(self.intervals['inverse_speed_sums']).reshape(counts.shape)}
+
+    def estimates(self, start, end):
+        # Flow, space-mean speed and density of all detectors over the intervals ending in (start, end]
+        time = np.array(self.intervals['time'])
+        select = (time > start + 1e-9) & (time <= end + 1e-9)
+        counts = float(np.sum(np.array(self.intervals['counts'])[select]))
+        inverse_speed_sum = float(np.sum(np.array(self.intervals['inverse_speed_sums'])[select]))
+        measured_time = select.sum() * self.interval_time * len(self.positions)
+        flow = counts / measured_time if measured_time else np.nan
+        speed = counts / inverse_speed_sum if inverse_speed_sum else np.nan
+        return {'detector_flow': flow, 'detector_speed': speed,
+                'detector_density': flow / speed / PIXEL_METERS_RATIO if speed else np.nan}
+
+
+class EdieGrid:
+    # Cells of 'cell_length' from the reference position to the edge of the ring, by intervals of 'interval_steps'
+    def __init__(self, reference_position_x, road_length, cell_length, interval_steps, dt):
+        self.reference_position_x = reference_position_x
+        self.road_length = road_length
+        self.cell_length = cell_length
+        self.cells = max(1, int(np.ceil(road_length / cell_length)))
+        self.interval_steps = interval_steps
+        self.interval_time = interval_steps * dt
+        self.dt = dt
+        self.steps = 0
+        self.time_spent = np.zeros(self.cells)
+        self.distance = np.zeros(self.cells)
+        self.intervals = {'time': [], 'time_spent': [], 'distance': []}
+
+    def update(self, ring, previous_position, time_elapsed):
+        # Vehicles beyond the edge (about to wrap around) are in the last cell
+        cell = ((previous_position - self.reference_position_x) / self.cell_length).astype(int)
+        np.clip(cell, 0, self.cells - 1, out=cell)
+        self.time_spent += np.bincount(cell, minlength=self.cells) * self.dt
+        self.distance += np.bincount(cell, weights=distance_travelled(previous_position, ring.position,
+                                                                      self.reference_position_x),
+                                     minlength=self.cells)
+        self.steps += 1
+        if self.steps == self.interval_steps:
+            self.close_interval(time_elapsed)
+
+    def close_interval(self, time_elapsed):
+        self.intervals['time'].append(time_elapsed)
+        self.intervals['time_spent'].append(self.time_spent.copy())
+        self.intervals['distance'].append(self.distance.copy())
+        self.time_spent[...] = 0
+        self.distance[...] = 0
+        self.steps = 0
+
+    def cell_areas(self):
+        # The last cell ends at the edge of the ring
+        lengths = np.full(self.cells, float(self.cell_length))
+        lengths[-1] = self.road_length - self.cell_length * (self.cells - 1)
+        return lengths * self.interval_time
+
+    def arrays(self):
+        # Space-time diagrams (interval x cell) of the flow (veh/s), density and speed (m/s)
+        time_spent = np.array(self.intervals['time_spent']).reshape(-1, self.cells)
+        distance = np.array(self.intervals['distance']).reshape(time_spent.shape)
+        areas = self.cell_areas()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'time': np.array(self.intervals['time']),
+                    'cell_start': np.arange(self.cells) * self.cell_length,
+                    'flow': distance / areas, 'density': time_spent / areas / PIXEL_METERS_RATIO,
+                    'speed': distance / time_spent}
+
+    def estimates(self, start, end):
+        # Flow, density and speed of the whole ring over the intervals ending in (start, end]
+        time = np.array(self.intervals['time'])
+        select = (time > start + 1e-9) & (time <= end + 1e-9)
+        if not select.any():
+            return {'edie_flow': np.nan, 'edie_density': np.nan, 'edie_speed': np.nan}
+        area = self.road_length * self.interval_time * select.sum()
+        time_spent = float(np.sum(np.array(self.intervals['time_spent'])[select]))
+        distance = float(np.sum(np.array(self.intervals['distance'])[select]))
+        return {'edie_flow': distance / area, 'edie_density': time_spent / area / PIXEL_METERS_RATIO,
+                'edie_speed': distance / time_spent if time_spent else np.nan}
+
+
+class SpaceTimeMeasurements:
+    # The detectors and the grid of a scenario from the options {'detectors': number of detectors spread evenly
+    # along the ring (0 for none), 'cell_length': length of the cells of the grid (None for none), 'interval': s}
+    def __init__(self, options, reference_position_x, road_length, dt):
+        interval_steps = max(1, round(options.get('interval', 1.0) / dt))
+        self.detectors = self.grid = None
+        if options.get('detectors'):
+            spacing = road_length / options['detectors']
+            positions = reference_position_x + spacing * (np.arange(options['detectors']) + 0.5)
+            self.detectors = LoopDetectors(positions, interval_steps, dt)
+        if options.get('cell_length'):
+            self.grid = EdieGrid(reference_position_x, road_length, options['cell_length'], interval_steps, dt)
+
+    def update(self, ring, previous_position, time_elapsed):
+        for measurement in (self.detectors, self.grid):
+            if measurement is not None:
+                measurement.update(ring, previous_position, time_elapsed)
+
+    def columns(self, start, end):
+        # Estimates of the fundamental diagram over the measurement window from 'start' to 'end'
+        columns = {}
+        for measurement in (self.detectors, self.grid):
+            if measurement is not None:
+                columns.update(measurement.estimates(start, end))
+        return columns
+
+    def arrays(self):
+        # The space-time diagrams, e.g. 'detector_flow' and 'edie_speed'
+        arrays = {}
+        for prefix, measurement in (('detector_', self.detectors), ('edie_', self.grid)):
+            if measurement is not None:
+                arrays.update({prefix + name: values for name, values in measurement.arrays().items()})
+        return arrays
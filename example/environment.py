@@ -1,44 +1,72 @@
-import csv
+import datetime
+import json
 import logging
-import random
+import platform
 import time
 import os
+import sys
 
-import pygame
-import matplotlib
-import matplotlib.backends.backend_agg as agg
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from PIL import Image
 
-from car import Car
+from calibration import (CALIBRATION_FIELDS, CALIBRATION_PARAMETERS, Calibration, calibrate, parse_bounds,
+                         read_targets)
+from cache import CACHE_DIRECTORY, CACHE_SIZE, ResultCache, code_version, scenario_key
+from checkpoint import SNAPSHOT_DIRECTORY, Checkpoints, Snapshot, load_snapshots, load_state, save_state, snapshot_file
+from idm import idm_parameters
+from integrators import make_integrator
+from large_ring import LARGE_RING_FIELDS, PRECISIONS, run_large_ring
+from manifest import (MANIFEST_FILE, compare_manifests, merge_shards, output_checksums, parse_shard, read_manifest,
+                      shard_simulations, write_manifest)
+from population import parse_population
+from rng import scenario_seed, sweep_order
+from simulation import (CLASS_FIELDS, DT, LANE_FIELDS, SEED, SIMULATION_TIME, TOTAL_SIMULATIONS, advance_scenario,
+                        check_fork, check_integrator, check_population, fork_scenario, fundamental_diagram_row,
+                        make_measurements, make_metrics, make_ring, make_window, road_length_of, run_sweep,
+                        scenario_kernel, scenario_positions, scenario_seeds, simulation_steps, statistics_fields)
+from tables import TableWriter, data_file, read_table
+from trajectory import TrajectoryRecorder
 import config as c
 
 
-matplotlib.use('Agg')
-matplotlib.use('PS')
-random.seed(175175175)
-np.random.seed(175175175)
-
-
-TOTAL_SIMULATIONS = 15
-PIXEL_METERS_RATIO = 0.04
-SIMULATION_TIME = 30
-DT = 0.1
-TIME_THRESHOLD = 15
 DATA_FILE_FLOW = "data/flow_density_data.csv"
 DATA_FILE_SPEED = "data/speed_density_data.csv" 
+DATA_FILE_TRAJECTORY = "data/trajectory.csv"
+DATA_FILE_STATISTICS = "data/fundamental_diagram_statistics.csv"
+DATA_FILE_LANES = "data/lane_fundamental_diagram.csv"
+DATA_FILE_CLASSES = "data/class_statistics.csv"
+DATA_FILE_LARGE_RING = "data/large_ring_statistics.csv"
+DATA_FILE_SPACE_TIME = "data/large_ring_space_time.npz"
+DATA_FILE_DETECTORS = "data/space_time_diagrams.npz"
+DATA_FILE_CALIBRATION = "data/calibration_history.csv"
+DATA_FILE_CALIBRATED = "data/calibrated_parameters.json"
 GIF_FILE = "figures/traffic_simulation.gif"
+# State of the scenario in progress saved with a checkpoint of 'Environment.run'
+SCENARIO_STATE = ('num_vehicles', 'vehicles', 'road_length', 'info_string', 'key', 'ring', 'integrator', 'metrics',
+                  'window', 'measurements', 'trajectory', 'time_elapsed')
+
+
+def pyplot():
+    # matplotlib, pygame, PIL and pandas are only loaded when the simulation is drawn, plotted or exported,
+    # so that the headless simulation starts on NumPy alone
+    import matplotlib
+    matplotlib.use('PS')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class Environment:
     def __init__(self, args):
         self.render = not args.no_render
         self.plot_gif = args.plot_gif
+        # Save the figures of the fundamental diagrams at the end of the simulation
+        self.plot = not getattr(args, 'no_plot', False)
         
         if self.plot_gif:
             self.render = False
+            # Without a display (e.g. on CI machines), pygame draws the frames with the SDL dummy video driver
+            if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') \
+                    and not os.environ.get('WAYLAND_DISPLAY'):
+                os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
         
         if args.run_idm:
             self.model = 'IDM'
@@ -47,8 +75,119 @@ class Environment:
         else:
             self.model = 'Test'
 
+        # 'car' steps the original Car objects, 'numpy' the vectorized ring engine and
+        # 'batched' all scenarios of the headless sweep together
+        self.backend = getattr(args, 'backend', 'car')
+        if self.backend == 'batched' and (self.render or self.plot_gif):
+            raise ValueError("The batched backend only runs the headless sweep, use it with --no-render")
+        # Number of lanes of the ring, vehicles change lanes by MOBIL on rings of several lanes
+        self.lanes = getattr(args, 'lanes', 1)
+        if self.lanes > 1 and self.backend != 'numpy':
+            raise ValueError(f"A ring of {self.lanes} lanes needs --backend numpy")
+        # Mix of vehicle classes with parameters of their own, None when all vehicles are alike
+        self.population = None
+        if getattr(args, 'population', None):
+            self.population = parse_population(args.population)
+            check_population(self.population, self.model, self.backend)
+        # Number of worker processes for the headless sweep, None runs the original loop
+        self.workers = getattr(args, 'workers', None)
+        # Cache of the scenario results, see cache.py
+        self.cache = None
+        if not getattr(args, 'no_cache', False):
+            self.cache = ResultCache(CACHE_DIRECTORY, getattr(args, 'cache_size', CACHE_SIZE / 2 ** 20) * 2 ** 20)
+        # Numerical integration scheme and time step of the simulation
+        self.integrator = getattr(args, 'integrator', 'euler')
+        # Update of the single-lane rings of the numpy backend, compiled with Numba or NumPy (see kernels.py)
+        self.kernel = getattr(args, 'kernel', 'auto')
+        self.dt = getattr(args, 'dt', None) or DT
+        # Options of the steady-state measurement window, None measures from TIME_THRESHOLD to SIMULATION_TIME
+        self.steady_state = None
+        if getattr(args, 'steady_state', False):
+            self.steady_state = {'target_ci': args.target_ci, 'target_flow_ci': args.target_flow_ci,
+                                 'max_time': args.max_time}
+        self.output_format = getattr(args, 'output_format', 'csv')
+        # Options of the loop detectors and the Edie grid measured while the scenarios run (see detectors.py),
+        # None without detectors nor grid
+        self.space_time = None
+        if getattr(args, 'detectors', 0) or getattr(args, 'edie_cell', None):
+            if self.backend == 'batched':
+                raise ValueError("The loop detectors and the Edie grid need --backend car or numpy")
+            self.space_time = {'detectors': args.detectors, 'cell_length': args.edie_cell,
+                               'interval': args.space_time_interval}
+        # Checkpoints of the sequential loop every 'checkpoint_interval' seconds, resumed with --resume, and snapshots
+        # of every scenario after 'snapshot_time' simulated seconds, from which --fork runs variants (see checkpoint.py)
+        self.checkpoints = None
+        if getattr(args, 'checkpoint_interval', None):
+            self.checkpoints = Checkpoints(args.checkpoint_file, args.checkpoint_interval)
+        self.snapshot_time = getattr(args, 'snapshot_time', None)
+        self.snapshot_directory = getattr(args, 'snapshot_directory', SNAPSHOT_DIRECTORY)
+        # The snapshots of --fork, None for the original scenarios
+        self.snapshots = None
+        if getattr(args, 'fork', None):
+            self.snapshots = load_snapshots(args.fork)
+            for snapshot in self.snapshots:
+                check_fork(snapshot, self.model)
+        if self.checkpoints is not None or self.snapshot_time is not None or self.snapshots is not None:
+            if self.render or self.plot_gif or self.workers or self.backend == 'batched':
+                raise ValueError("Checkpoints, snapshots and forks run the sequential loop, use them with --no-render "
+                                 "and without --workers and --backend batched")
+        if self.snapshots is not None and self.steady_state is not None:
+            raise ValueError("Forks are measured over a fixed window, use them without --steady-state")
+        # The scenario in progress when a checkpoint is saved, None between scenarios
+        self.scenario = None
+        # Root seed of the random number streams of the scenarios (see rng.py), the shard of the density sweep
+        # run by this process, and the manifest that the manifest of this run is compared with (see manifest.py)
+        self.seed = getattr(args, 'seed', SEED)
+        self.shard = None
+        if getattr(args, 'shard', None):
+            if self.render or self.plot_gif:
+                raise ValueError("Shards are headless, use them with --no-render")
+            self.shard = parse_shard(args.shard, TOTAL_SIMULATIONS)
+        self.verify = getattr(args, 'verify', None)
+        # Wall time of the run and of every scenario of the sequential loop, written to the manifest
+        self.started = self.start_time = None
+        self.timings = {}
+
+        # Data directories of the shards merged into the data files of a single run
+        self.merge = getattr(args, 'merge_shards', None)
+        if self.merge:
+            return
+
+        # Calibration of the IDM parameters against the fundamental diagrams of --calibrate (see calibration.py),
+        # which writes its own data files rather than those of the density sweep
+        self.calibration = None
+        if getattr(args, 'calibrate', None):
+            if self.render or self.plot_gif:
+                raise ValueError("The calibration is headless, use it with --no-render")
+            parameters = args.calibrate_parameters.split(',') if args.calibrate_parameters else None
+            self.calibration = Calibration(read_targets(args.calibrate), self.model,
+                                           parameters or CALIBRATION_PARAMETERS, parse_bounds(args.bounds),
+                                           args.replications, self.backend, self.workers, self.integrator, self.dt,
+                                           self.steady_state, self.cache, self.kernel, seed=self.seed)
+            self.calibration_options = {'optimizer': args.optimizer, 'max_evaluations': args.max_evaluations,
+                                        'seed': self.seed}
+            # Checksums of the target files, for the manifest
+            self.calibration_targets = output_checksums(args.calibrate)
+            return
+
+        # Headless ring of many vehicles on a road given in meters (see large_ring.py), which writes its own
+        # data files rather than those of the density sweep
+        self.large_ring = None
+        if getattr(args, 'large_ring', False):
+            if self.render or self.plot_gif:
+                raise ValueError("The large ring is headless, use it with --no-render")
+            if self.model == 'Test':
+                raise ValueError("The large ring runs the IDM or Custom model, use --run-idm or --run-custom")
+            vehicles = args.vehicles
+            self.large_ring = {'num_vehicles': vehicles, 'road_length': args.road_length or 25.0 * vehicles,
+                               'simulation_time': args.simulation_time, 'dtype': PRECISIONS[args.precision],
+                               'chunk_size': args.chunk_size, 'bin_length': args.bin_length,
+                               'sample_interval': args.sample_interval}
+            return
+
         if self.render:
             # initialize the interfaces
+            import pygame
             pygame.init()
             pygame.display.set_caption(c.PROJECT_NAME)
             self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
@@ -61,26 +200,48 @@ class Environment:
             # A dummy screen width to bypass pygame
             self.screen_width = 1000
 
-        self.file_fd = open(DATA_FILE_FLOW, "w")
-        flow_data_fieldnames = ['density', 'flow']
-        self.writer_fd = csv.DictWriter(self.file_fd, fieldnames=flow_data_fieldnames)
-        self.writer_fd.writeheader()
-        self.file_sd = open(DATA_FILE_SPEED, "w")
-        speed_data_fieldnames = ['density', 'speed']
-        self.writer_sd = csv.DictWriter(self.file_sd, fieldnames=speed_data_fieldnames)
-        self.writer_sd.writeheader()
+        # Data files of the fundamental diagrams, CSV unless another output format is asked for
+        self.writer_fd = TableWriter(DATA_FILE_FLOW, ['density', 'flow'], self.output_format)
+        self.writer_sd = TableWriter(DATA_FILE_SPEED, ['density', 'speed'], self.output_format)
+        self.writer_stats = TableWriter(DATA_FILE_STATISTICS, statistics_fields(self.space_time), self.output_format)
+        # Fundamental diagrams of every lane
+        self.writer_lanes = None
+        if self.lanes > 1:
+            self.writer_lanes = TableWriter(DATA_FILE_LANES, LANE_FIELDS, self.output_format)
+        # Statistics of every vehicle class
+        self.writer_classes = None
+        if self.population is not None:
+            self.writer_classes = TableWriter(DATA_FILE_CLASSES, CLASS_FIELDS, self.output_format)
+        # Space-time diagrams of the detectors and the grid of every scenario, e.g. 'edie_speed_3'
+        self.space_time_diagrams = {}
         
-        # Load the graphs
-        self.figure_svd, self.figure_fvd, self.axis_svd, self.axis_fvd = self.init_graphs()
-        self.vehicle_counts = np.random.permutation(np.array([1,2,2,4,7,11,15,18,21,24,30,40,60,80,99]))
+        # Load the graphs, only drawn on the screen and in the GIF
+        self.figure_svd = self.figure_fvd = self.axis_svd = self.axis_fvd = None
+        if self.render or self.plot_gif:
+            self.figure_svd, self.figure_fvd, self.axis_svd, self.axis_fvd = self.init_graphs()
+        self.vehicle_counts = sweep_order(np.array([1,2,2,4,7,11,15,18,21,24,30,40,60,80,99]), self.seed)
+        # Numbers of the simulations run by this process, all of them or those of the shard
+        self.simulations = shard_simulations(TOTAL_SIMULATIONS, self.shard)
         self.simulation_count = 0
-        self.trajectory = []  # Trajectory recording the tuple of (car,time,position)
-
-        self.frames = []
+        # Trajectory recording the position, velocity and acceleration of every car over time
+        self.trajectory = None
+        if self.model == "IDM" and not getattr(args, 'no_trajectory', False) and self.snapshots is None:
+            # Long enough for the longest simulation, 'max_time' of the steady-state window
+            simulation_time = SIMULATION_TIME if self.steady_state is None else self.steady_state['max_time']
+            self.trajectory = TrajectoryRecorder(DATA_FILE_TRAJECTORY, simulation_steps(simulation_time, self.dt),
+                                                 getattr(args, 'trajectory_decimation', 1),
+                                                 getattr(args, 'trajectory_chunk', 100), self.output_format)
+
+        # Frames of the GIF are written to the file as soon as they are captured
+        self.animation = None
+        self.gif_file = getattr(args, 'gif_file', None) or GIF_FILE
+        self.gif_frame_skip = getattr(args, 'gif_frame_skip', 1)
+        self.gif_scale = getattr(args, 'gif_scale', 1.0)
 
     @staticmethod
     def init_graphs():
         # initialize the graphs
+        plt = pyplot()
         figure_svd, axis_svd = plt.subplots()
         figure_fvd, axis_fvd = plt.subplots()
         
@@ -96,206 +257,435 @@ class Environment:
         return figure_svd, figure_fvd, axis_svd, axis_fvd
 
 
-    def plot_graph(figure):
-        # Generate figure structure on the canvas
-        canvas = agg.FigureCanvasAgg(figure)
-        canvas.draw()
-        renderer = canvas.get_renderer()
-        raw_data = renderer.tostring_rgb()
+    def make_renderer(self, car_image, screen_width):
+        from render import Renderer
+        renderer = Renderer(self.screen, car_image, screen_width, self.capture_frame if self.plot_gif else None)
+        renderer.update_diagrams(self.figure_svd, self.figure_fvd)
+        return renderer
 
-        size = canvas.get_width_height()
+    def capture_frame(self, screen):
+        # Read the pixels of the screen here, on the main thread as SDL expects, and leave their conversion to
+        # a PIL Image and the encoding to the thread of the frame writer
+        import pygame
 
-        return raw_data, size
+        raw_data = pygame.image.tostring(screen, "RGB")
+        if self.animation is None:
+            from animation import ThreadedFrameWriter, open_frame_writer
+            self.animation = ThreadedFrameWriter(open_frame_writer(self.gif_file, self.gif_frame_skip, self.gif_scale,
+                                                                   self.dt * 1000))
+        self.animation.add(raw_data, (self.screen.get_width(), int(self.screen.get_height()*2/3)))
 
     def save_gif(self):
-        # Create a GIF from the captured frames
-        if self.plot_gif and self.frames:
-            self.frames[0].save(
-                GIF_FILE,
-                save_all=True,
-                append_images=self.frames[1:],  # List of remaining frames
-                duration=0.01,  # Duration in milliseconds per frame
-                loop=0  # 0 means loop forever
-            )
-            logging.info(f"Saved GIF file to {GIF_FILE}")       
+        # Finish the GIF from the captured frames
+        if self.animation is not None:
+            self.animation.close()
+            logging.info(f"Saved {self.animation.frames_written} frames to {self.gif_file}")
 
     @staticmethod
-    def plot_fundamental_diagrams():
-        flow_data = pd.read_csv(DATA_FILE_FLOW)
+    def plot_fundamental_diagrams(output_format='csv'):
+        # The 95% confidence intervals are drawn as error bars when the statistics are available
+        statistics = None
+        if os.path.exists(data_file(DATA_FILE_STATISTICS, output_format)):
+            statistics = read_table(DATA_FILE_STATISTICS, output_format)
+
+        flow_data = read_table(DATA_FILE_FLOW, output_format)
         figure_svd, figure_fvd, axis_svd, axis_fvd = Environment.init_graphs()
         axis_fvd.scatter(flow_data['density'], flow_data['flow'])
+        if statistics is not None:
+            axis_fvd.errorbar(statistics['density'], statistics['flow'], yerr=statistics['flow_ci'], fmt='none')
         figure_fvd.savefig('figures/fundamental_diagram_flow_vs_density.png')
 
-        speed_data = pd.read_csv(DATA_FILE_SPEED)
+        speed_data = read_table(DATA_FILE_SPEED, output_format)
         axis_svd.scatter(speed_data['density'], speed_data['speed'])
+        if statistics is not None:
+            axis_svd.errorbar(statistics['density'], statistics['speed'], yerr=statistics['speed_ci'], fmt='none')
         figure_svd.savefig('figures/fundamental_diagram_speed_vs_density.png')
 
     
     def clean_up(self):
         # Close file descriptors for writing data files
-        self.file_fd.close()
-        self.file_sd.close()
-
-        # Save the trajectory data of the IDM model for separate analysis
-        if self.model == "IDM":
-            df_trajectory = pd.DataFrame(self.trajectory, columns = ['Simulation No','Car', 'Time', 'Position'])
-            df_trajectory.to_csv('data/trajectory.csv')
+        self.writer_fd.close()
+        self.writer_sd.close()
+        self.writer_stats.close()
+        if self.writer_lanes is not None:
+            self.writer_lanes.close()
+        if self.writer_classes is not None:
+            self.writer_classes.close()
+        if self.space_time is not None:
+            np.savez_compressed(DATA_FILE_DETECTORS, **self.space_time_diagrams)
+
+        # Save the rest of the trajectory data of the IDM model for separate analysis
+        if self.trajectory is not None:
+            self.trajectory.close()
+
+        if self.cache is not None:
+            self.cache.evict()
+            logging.info(f"Result cache: {self.cache.hits} hits, {self.cache.misses} misses")
             
         self.save_gif()
 
 
+    def sweep_outputs(self, trajectory=True):
+        # Data files of the density sweep, with the trajectory when it is recorded
+        writers = [self.writer_fd, self.writer_sd, self.writer_stats, self.writer_lanes, self.writer_classes,
+                   self.trajectory if trajectory else None]
+        return [writer.path for writer in writers if writer is not None] + \
+            ([DATA_FILE_DETECTORS] if self.space_time is not None else [])
+
+    def sweep_scenarios(self, simulations):
+        # Vehicle count and seed of the scenarios of the density sweep, see rng.py
+        return [{'simulation': simulation, 'vehicles': int(self.vehicle_counts[simulation - 1]),
+                 'seed': scenario_seed(simulation, self.seed)} for simulation in simulations]
+
+    def write_manifest(self, outputs, scenarios=(), **options):
+        # Manifest of the run (see manifest.py) with the checksums of its data files 'outputs', and the options
+        # of the large ring or the calibration
+        manifest = {'seed': self.seed, 'model': self.model, 'parameters': idm_parameters(),
+                    'options': dict(backend=self.backend, integrator=self.integrator, dt=self.dt, lanes=self.lanes,
+                                    population=None if self.population is None else self.population.describe(),
+                                    steady_state=self.steady_state, space_time=self.space_time, kernel=self.kernel,
+                                    output_format=self.output_format, **options),
+                    'total_simulations': TOTAL_SIMULATIONS, 'shard': self.shard, 'scenarios': list(scenarios),
+                    'code_version': code_version(),
+                    'versions': {'python': platform.python_version(), 'numpy': np.__version__},
+                    'timings': {'started': self.started, 'wall_time': time.perf_counter() - self.start_time,
+                                'workers': self.workers,
+                                'scenarios': {str(simulation): seconds
+                                              for simulation, seconds in self.timings.items()}},
+                    'outputs': output_checksums(outputs)}
+        write_manifest(MANIFEST_FILE, manifest)
+        self.check_manifest(manifest)
+
+    def check_manifest(self, manifest):
+        # Compare the manifest of the run with that of --verify, exiting with an error when they differ
+        if self.verify is None:
+            return
+        differences = compare_manifests(manifest, read_manifest(self.verify))
+        for difference in differences:
+            logging.error(f"{difference} from {self.verify}")
+        if differences:
+            sys.exit(1)
+        logging.info(f"The data files are identical to those of {self.verify}")
+
+    def save_checkpoint(self):
+        # Everything the sequential loop needs to carry on, see checkpoint.py
+        self.checkpoints.save({'environment': self})
+
+    @staticmethod
+    def resume(path):
+        # The environment of the checkpoint at 'path'
+        environment = load_state(path)['environment']
+        environment.checkpoints.last = time.perf_counter()
+        logging.info(f"Resuming the {environment.model} simulations from {path} after "
+                     f"{environment.simulation_count} of {TOTAL_SIMULATIONS} simulations...")
+        return environment
+
+    def replay(self, cached):
+        # Write the cached trajectory of a scenario as if it had been run, and return its row
+        if self.trajectory is None:
+            return cached
+        row, trajectory = cached
+        for time_elapsed, position, velocity, acceleration in zip(*trajectory):
+            self.trajectory.record(time_elapsed, position, velocity, acceleration)
+        return row
+
+    def write_row(self, row):
+        self.writer_sd.writerow(row)
+        self.writer_fd.writerow(row)
+        self.writer_stats.writerow(row)
+        if self.writer_lanes is not None:
+            for lane in row['lanes']:
+                self.writer_lanes.writerow(dict(lane, simulation=self.simulation_count))
+        if self.writer_classes is not None:
+            for vehicle_class in row['classes']:
+                self.writer_classes.writerow(dict(vehicle_class, simulation=self.simulation_count))
+        if self.space_time is not None:
+            for name, values in row['space_time'].items():
+                self.space_time_diagrams[f'{name}_{self.simulation_count}'] = np.asarray(values, dtype=float)
+
+    def run_sweep(self):
+        # Headless sweep: every scenario runs with its own seed, possibly in parallel,
+        # and the rows are written in the original order of 'vehicle_counts'
+        seeds = scenario_seeds(TOTAL_SIMULATIONS, self.seed, self.simulations)
+        logging.info(f"Running {len(self.simulations)} {self.model} simulations with {self.workers or 1} workers...")
+        rows = run_sweep(self.vehicle_counts[np.array(self.simulations) - 1], seeds, self.model, idm_parameters(),
+                         self.backend, self.screen_width, self.workers, self.integrator, self.dt, self.steady_state,
+                         self.cache, self.lanes, self.population, self.space_time, self.kernel)
+
+        for simulation, row in zip(self.simulations, rows):
+            self.simulation_count = simulation
+            self.write_row(row)
+
+        self.clean_up()
+        # The headless sweep does not record the trajectory
+        self.write_manifest(self.sweep_outputs(trajectory=False), self.sweep_scenarios(self.simulations))
+        if self.plot:
+            self.plot_fundamental_diagrams(self.output_format)
+
+    def run_large_ring(self):
+        options = self.large_ring
+        check_integrator(self.integrator, self.model, 'numpy')
+        logging.info(f"Running the {self.model} model with {options['num_vehicles']} vehicles "
+                     f"on {options['road_length']:.0f} m...")
+        statistics, bins = run_large_ring(model=self.model, params=idm_parameters(), dt=self.dt,
+                                          integrator=make_integrator(self.integrator), seed=self.seed, **options)
+        logging.info(f"Density {statistics['density']:.4f} veh/m, flow {statistics['flow']:.3f} veh/s, "
+                     f"speed {statistics['speed']:.2f} m/s, "
+                     f"{statistics['vehicle_steps_per_second']:.3g} vehicle-steps/s")
+
+        writer = TableWriter(DATA_FILE_LARGE_RING, LARGE_RING_FIELDS, self.output_format)
+        writer.writerow(statistics)
+        writer.close()
+        bins.save(DATA_FILE_SPACE_TIME)
+        self.write_manifest([writer.path, DATA_FILE_SPACE_TIME],
+                            large_ring=dict(options, dtype=np.dtype(options['dtype']).name))
+
+        if self.plot:
+            # Space-time diagram of the speed, the waves run backwards along the road
+            plt = pyplot()
+            figure, axis = plt.subplots()
+            image = axis.imshow(bins.speed[:bins.interval].T, aspect='auto', origin='lower', cmap='RdYlGn',
+                                extent=(0, bins.time[bins.interval - 1], 0, bins.bins * bins.bin_length / 1000))
+            axis.set(xlabel='Time (s)', ylabel='Position (km)', title='Speed (m/s)')
+            figure.colorbar(image)
+            figure.savefig('figures/large_ring_space_time.png')
+
+    def run_forks(self):
+        # Variants of the scenarios of the snapshots of --fork, run with the model, integrator, time step and
+        # detectors of this run from the warmed-up state of the snapshots, and measured from their time on
+        for snapshot in self.snapshots:
+            self.simulation_count = snapshot.simulation
+            logging.info(f"Forking {self.model} Simulation No. {snapshot.simulation:>2d} with "
+                         f"{snapshot.num_vehicles:>2d} vehicles at {snapshot.time_elapsed:.1f} s...")
+            row = fork_scenario(snapshot, self.model, integrator=self.integrator, dt=self.dt,
+                                space_time=self.space_time)
+            self.write_row(row)
+
+        self.clean_up()
+        self.write_manifest(self.sweep_outputs(), [{'simulation': snapshot.simulation,
+                                                    'vehicles': int(snapshot.num_vehicles),
+                                                    'time_elapsed': float(snapshot.time_elapsed)}
+                                                   for snapshot in self.snapshots])
+        if self.plot:
+            self.plot_fundamental_diagrams(self.output_format)
+
+    def run_merge(self):
+        # Data files and manifest of a single run from those of the shards in the directories of --merge-shards
+        logging.info(f"Merging the shards in {', '.join(self.merge)}...")
+        manifest = merge_shards(self.merge, os.path.dirname(MANIFEST_FILE))
+        write_manifest(MANIFEST_FILE, manifest)
+        self.check_manifest(manifest)
+        if self.plot:
+            self.plot_fundamental_diagrams(manifest['options']['output_format'])
+
+    def run_calibration(self):
+        logging.info(f"Calibrating {', '.join(self.calibration.parameters)} of the {self.model} model on "
+                     f"{len(self.calibration.scenarios)} scenarios of {len(self.calibration.density)} target points...")
+        params, loss = calibrate(self.calibration, **self.calibration_options)
+
+        writer = TableWriter(DATA_FILE_CALIBRATION, CALIBRATION_FIELDS, self.output_format)
+        for entry in self.calibration.history:
+            writer.writerow(entry)
+        writer.close()
+        with open(DATA_FILE_CALIBRATED, 'w') as file:
+            json.dump({'model': self.model, 'parameters': params, 'loss': loss,
+                       'calibrated': self.calibration.parameters, 'candidates': len(self.calibration.history),
+                       'scenarios': self.calibration.scenario_runs}, file, indent=2)
+        self.write_manifest([writer.path, DATA_FILE_CALIBRATED],
+                            calibration=dict(self.calibration_options, targets=self.calibration_targets,
+                                             calibrated=self.calibration.parameters,
+                                             scenarios=[list(scenario) for scenario in self.calibration.scenarios]))
+        if self.cache is not None:
+            logging.info(f"Result cache: {self.cache.hits} hits, {self.cache.misses} misses")
+
     def run(self):
+        self.started = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        self.start_time = time.perf_counter()
+        if self.merge:
+            self.run_merge()
+            return
+
+        if self.calibration is not None:
+            self.run_calibration()
+            return
+
+        if self.large_ring is not None:
+            self.run_large_ring()
+            return
+
+        if self.snapshots is not None:
+            self.run_forks()
+            return
+
+        if (self.workers or self.backend == 'batched') and not self.render and not self.plot_gif:
+            self.run_sweep()
+            return
+
+        if self.render or self.plot_gif:
+            import pygame
+
         # load car image for the visualization
         current_dir = os.path.dirname(os.path.abspath(__file__))
         image_path = os.path.join(current_dir, "assets/car.png")
         screen_width = self.screen_width
+        renderer = None
         if self.render:
             car_image = pygame.image.load(image_path)
+            renderer = self.make_renderer(car_image, screen_width)
 
         svd_x_axis = []
         svd_y_axis = []
         fvd_x_axis = []
         fvd_y_axis = []
 
-        while self.simulation_count < TOTAL_SIMULATIONS:
+        while self.simulation_count < self.simulations[-1] or self.scenario is not None:
 
-            self.simulation_count += 1
-            time_elapsed = 0
-            cars = []
+            # The scenario in progress when the checkpoint that the run resumed from was saved
+            resumed, self.scenario = self.scenario, None
+            scenario_start = time.perf_counter()
+            if resumed is None:
+                self.simulation_count = min(simulation for simulation in self.simulations
+                                            if simulation > self.simulation_count)
+                time_elapsed = 0
 
-            num_vehicles = self.vehicle_counts[self.simulation_count-1]
+                num_vehicles = self.vehicle_counts[self.simulation_count-1]
             
-            # Initialize the pygame only for second to the last simulation
-            if self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1:
-                pygame.init()
-                pygame.display.set_caption(c.PROJECT_NAME)
-                self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-                self.exit = False
-                info_object = pygame.display.Info()
-                logging.info("Created info_object...")
-                self.screen_width = info_object.current_w
-                logging.info("Set screen_width...")
-                car_image = pygame.image.load(image_path)
-
-            for x in range(0, num_vehicles):
-                if x == 0:
-                    cars.append(Car((screen_width / c.PPU - (48 / c.PPU)) * 0.75, 2, x, screen_width))
-                else:
-                    cars.append(Car(cars[x - 1].position.x - random.uniform(1, 2), 2, x, screen_width))
-
-            reference_position_x = cars[len(cars) - 1].position.x - 1
-            road_length = max((screen_width / c.PPU - (48 / c.PPU)) * 0.25,
-                              (abs(screen_width / c.PPU - (48 / c.PPU)) - reference_position_x))
-            info_string = f'Running {self.model} Simulation No. {self.simulation_count:>2d} with ' \
-                f'{num_vehicles:>2d} vehicles and road length of {road_length:>3.0f} meters.'
-            logging.info(info_string)
-            density = num_vehicles / (road_length * PIXEL_METERS_RATIO)
-
-            flow = 0
-            sum_velocity = 0
-            velocity_count = 0
-
-            while SIMULATION_TIME > time_elapsed:
-
-                time_elapsed += DT
-                car_previous_positions_x = []
-
-                # Update each vehicle's status
-                for x,_ in enumerate(cars):
-                    if x == 0:
-                        car_previous_positions_x.append(cars[0].position.x)
-                        cars[x].car_following_model(DT, cars[len(cars) - 1], cars[min(len(cars)-1, 1)],
-                        reference_position_x, self.model)
-                    elif x < len(cars) -1:
-                        car_previous_positions_x.append(cars[x].position.x)
-                        cars[x].car_following_model(DT, cars[x - 1], cars[x + 1], reference_position_x, self.model)
-                    else:
-                        car_previous_positions_x.append(cars[x].position.x)
-                        cars[x].car_following_model(DT, cars[x - 1], cars[0], reference_position_x, self.model)
-                    self.trajectory.append((self.simulation_count, x,time_elapsed, cars[x].position.x))
-
-                if time_elapsed > TIME_THRESHOLD:
-                    for y,_ in enumerate(cars):
-                        if cars[y].position.x < car_previous_positions_x[y]:
-                            flow += 1
-
-                if time_elapsed > TIME_THRESHOLD:
-                    for car in cars:
-                        sum_velocity += car.velocity.x
-                        velocity_count += 1
-
-
-                if self.render or (self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1):
-                    # Event queue for the simulation
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            self.exit = True
-                        if event.type == pygame.KEYDOWN:
-                            # Quit the simulation whenever a key is pressed
-                            self.clean_up()
-                            self.plot_fundamental_diagrams()
-                            pygame.quit()
-                            return
-
-                    # Draw the simulation interface
-                    self.screen.fill((255, 255, 255))
-                    rotated = pygame.transform.rotate(car_image, 0)
-
-                    for x,_ in enumerate(cars):
-                        self.screen.blit(rotated, cars[x].position * c.PPU)
-
-                    screen = pygame.display.get_surface()
-
-                    # Draw the svd graph
-                    svd_raw_data, svd_size = Environment.plot_graph(self.figure_svd)
-                    surf = pygame.image.fromstring(svd_raw_data, svd_size, "RGB")
-                    screen.blit(surf, (screen_width / 9, 180))
-
-                    # Draw the fvd graph
-                    fvd_raw_data, fvd_size = Environment.plot_graph(self.figure_fvd)
-                    surf = pygame.image.fromstring(fvd_raw_data, fvd_size, "RGB")
-                    screen.blit(surf, (screen_width / 2, 180))
-
-                    # Add text to interface
-                    font = pygame.font.Font('freesansbold.ttf', 16)
-                    text = font.render(info_string, True, (0, 0, 0), (255, 255, 255))
-                    text_quit = font.render('[X] : Press any key to quit the simulation.',
-                                    True, (0, 0, 0), (255, 255, 255))
-
-                    text_rect = text.get_rect()
-                    text_rect_quit = text_quit.get_rect()
-                    text_rect.center = (400, 25)
-                    text_rect_quit.center = (400, 50)
-                    screen.blit(text, text_rect)
-                    screen.blit(text_quit, text_rect_quit)
-
-                    # Update interface
-                    pygame.display.flip()
-                    
-                    # Capture the frame if plotting GIF
-                    if self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1:
-                        # Convert screen to string and save as PIL Image
-                        raw_data = pygame.image.tostring(screen, "RGB")
-                        image = Image.frombytes("RGB", (self.screen.get_width(), int(self.screen.get_height()*2/3)), raw_data)
-                        self.frames.append(image)
-
-            # collect data relevant for plotting
-            avg_velocity = sum_velocity / velocity_count
-            self.writer_sd.writerow({'density': density, 'speed': avg_velocity})
-
-            flow_real = flow / (SIMULATION_TIME - TIME_THRESHOLD)
-            self.writer_fd.writerow({'density': density, 'flow': flow_real})
-
-            svd_x_axis.append(density)
-            svd_y_axis.append(avg_velocity)
-            self.axis_svd.scatter(svd_x_axis, svd_y_axis)
-
-            fvd_x_axis.append(density)
-            fvd_y_axis.append(flow_real)
-            self.axis_fvd.scatter(fvd_x_axis, fvd_y_axis)
+                # Initialize the pygame only for second to the last simulation
+                if self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1:
+                    pygame.init()
+                    pygame.display.set_caption(c.PROJECT_NAME)
+                    self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+                    self.exit = False
+                    info_object = pygame.display.Info()
+                    logging.info("Created info_object...")
+                    self.screen_width = info_object.current_w
+                    logging.info("Set screen_width...")
+                    car_image = pygame.image.load(image_path)
+                    renderer = self.make_renderer(car_image, screen_width)
+
+                # The positions and the vehicles of a mixed population are drawn from the streams of the scenario,
+                # as in the headless sweep
+                positions, vehicles = scenario_positions(num_vehicles, scenario_seed(self.simulation_count, self.seed),
+                                                         screen_width, self.model, self.population)
+                reference_position_x = positions[-1] - 1
+                if self.trajectory is not None:
+                    self.trajectory.start(self.simulation_count, num_vehicles)
+                road_length = road_length_of(screen_width, reference_position_x)
+                info_string = f'Running {self.model} Simulation No. {self.simulation_count:>2d} with ' \
+                    f'{num_vehicles:>2d} vehicles and road length of {road_length:>3.0f} meters.'
+                logging.info(info_string)
+
+                # Scenarios that are not drawn are taken from the cache when they were run before
+                key = cached = None
+                if self.cache is not None:
+                    key = scenario_key(self.model, idm_parameters(), positions, screen_width, self.dt, self.integrator,
+                                       self.backend, self.steady_state, road_length, self.lanes, self.population,
+                                       self.space_time, scenario_kernel(self.kernel, self.model, num_vehicles,
+                                                                        self.backend, self.lanes, self.population))
+                    if not (self.render or (self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1)
+                            or self.snapshot_time is not None):
+                        cached = self.cache.get(key, trajectory=self.trajectory is not None)
+            else:
+                (num_vehicles, vehicles, road_length, info_string, key, ring, integrator, metrics, window, measurements,
+                 trajectory, time_elapsed) = (resumed[name] for name in SCENARIO_STATE)
+                cached = None
+                logging.info(f"Resuming simulation No. {self.simulation_count:>2d} at {time_elapsed:.1f} s...")
+
+            if cached is not None:
+                logging.info("Using the cached results...")
+                row = self.replay(cached)
+            else:
+                if resumed is None:
+                    ring = make_ring(positions, screen_width, reference_position_x, self.model, idm_parameters(),
+                                     self.backend, self.integrator, self.lanes, vehicles, self.kernel)
+                    integrator = make_integrator(self.integrator)
+                    metrics = make_metrics(num_vehicles, self.dt, self.lanes)
+                    window = make_window((), road_length, self.dt, self.steady_state)
+                    measurements = make_measurements(self.space_time, reference_position_x, road_length, self.dt,
+                                                     self.backend)
+                    # Trajectory of the scenario for the cache
+                    trajectory = [] if key is not None and self.trajectory is not None else None
+
+                def before_step(time_elapsed):
+                    if self.snapshot_time is not None and time_elapsed <= self.snapshot_time < time_elapsed + self.dt:
+                        # Warmed-up state of the scenario, all time steps ending after 'snapshot_time' are still to run
+                        save_state(snapshot_file(self.snapshot_directory, self.simulation_count),
+                                   Snapshot(self.simulation_count, time_elapsed, self.snapshot_time, ring, num_vehicles,
+                                            road_length, self.backend, self.dt, self.lanes, vehicles))
+                    if self.checkpoints is not None and self.checkpoints.due():
+                        self.scenario = dict(zip(SCENARIO_STATE, (num_vehicles, vehicles, road_length, info_string, key,
+                                                                  ring, integrator, metrics, window, measurements,
+                                                                  trajectory, time_elapsed)))
+                        self.save_checkpoint()
+                        self.scenario = None
+
+                quit_requested = False
+
+                def after_step(time_elapsed):
+                    # Record and draw the state of the ring, True when a key is pressed to quit the simulation
+                    nonlocal quit_requested
+                    if self.trajectory is not None:
+                        self.trajectory.record(time_elapsed, ring.position, ring.velocity, ring.acceleration)
+                        if trajectory is not None:
+                            trajectory.append((time_elapsed, ring.position.copy(), ring.velocity.copy(),
+                                               ring.acceleration.copy()))
+
+                    if self.render or (self.plot_gif and self.simulation_count == TOTAL_SIMULATIONS-1):
+                        # Event queue for the simulation
+                        for event in pygame.event.get():
+                            if event.type == pygame.QUIT:
+                                self.exit = True
+                            if event.type == pygame.KEYDOWN:
+                                quit_requested = True
+                                return True
+
+                        # Draw the state, every frame is kept when plotting the GIF
+                        renderer.submit(ring.position, info_string, wait=self.plot_gif,
+                                        lanes=ring.lane if self.lanes > 1 else None)
+                    return False
+
+                # The time steps are those of the headless sweep (see 'simulation.advance_scenario')
+                time_elapsed = advance_scenario(ring, integrator, metrics, window, measurements, self.dt, time_elapsed,
+                                                before_step, after_step)
+                if quit_requested:
+                    # Quit the simulation whenever a key is pressed
+                    self.clean_up()
+                    if self.plot:
+                        self.plot_fundamental_diagrams(self.output_format)
+                    pygame.quit()
+                    return
+
+                # collect data relevant for plotting
+                row = fundamental_diagram_row(num_vehicles, road_length, metrics, integrator, window, vehicles=vehicles,
+                                              measurements=measurements)
+                if key is not None:
+                    self.cache.put(key, row, None if trajectory is None else
+                                   [np.array(values) for values in zip(*trajectory)])
+
+            self.write_row(row)
+            self.timings[self.simulation_count] = self.timings.get(self.simulation_count, 0) + \
+                time.perf_counter() - scenario_start
+            if self.checkpoints is not None and self.checkpoints.due():
+                self.save_checkpoint()
+
+            svd_x_axis.append(row['density'])
+            svd_y_axis.append(row['speed'])
+            fvd_x_axis.append(row['density'])
+            fvd_y_axis.append(row['flow'])
+            if self.axis_svd is not None:
+                self.axis_svd.scatter(svd_x_axis, svd_y_axis)
+                self.axis_fvd.scatter(fvd_x_axis, fvd_y_axis)
+
+            if renderer is not None:
+                renderer.update_diagrams(self.figure_svd, self.figure_fvd)
 
         self.clean_up()
-        self.plot_fundamental_diagrams()
+        self.write_manifest(self.sweep_outputs(), self.sweep_scenarios(self.simulations))
+        if self.checkpoints is not None and os.path.exists(self.checkpoints.path):
+            # The run is complete, there is nothing left to resume
+            os.remove(self.checkpoints.path)
+        if self.plot:
+            self.plot_fundamental_diagrams(self.output_format)
 
         if self.render:
             # Wait 5 seconds before closing the display
@@ -0,0 +1,15 @@
+# Parameters of the IDM model, kept free of NumPy, pygame and matplotlib so that the headless
+# simulation can read them without loading the rendering libraries
+
+# TODO Define parameter specifications of your IDM model
+T = 1
+A_MAX = 2
+B = 1.5
+DELTA = 4
+S_MIN = 1
+MAX_VELOCITY = 25
+
+
+def idm_parameters():
+    # The IDM parameters above, in the form expected by the NumPy ring engines
+    return {'T': T, 'A_MAX': A_MAX, 'B': B, 'DELTA': DELTA, 'S_MIN': S_MIN, 'MAX_VELOCITY': MAX_VELOCITY}
@@ -0,0 +1,177 @@
+import numpy as np
+
+
+def row_maximum(ring, values):
+    # Largest of 'values' over the vehicles of every ring of a 'BatchedRing' (its padding left out),
+    # or over the vehicles of a single ring
+    return np.max(values, axis=-1, initial=0.0, where=getattr(ring, 'mask', True))
+
+
+class Integrator:
+    # Advances the whole state of a 'Ring' (or 'BatchedRing') by one time step of the simulation.
+    # Every integrator counts the steps it takes and keeps the largest estimate of its local error:
+    # the difference between its update and an update of another order built from the same
+    # acceleration evaluations. Vehicles still wrap around as in 'Ring.update_car_position'.
+    # On a 'BatchedRing', the error estimate (and the steps of 'Adaptive') are kept for every ring of the
+    # batch, so that a scenario reports the same statistics however the scenarios are batched.
+    name = None
+
+    def __init__(self):
+        self.steps = 0
+        self.rejected_steps = 0
+        self.error_estimate = 0.0
+
+    def advance(self, ring, dt):
+        raise NotImplementedError
+
+    def record_error(self, ring, *errors):
+        for error in errors:
+            self.error_estimate = np.maximum(self.error_estimate, row_maximum(ring, np.abs(error)))
+
+    def statistics(self, row=None):
+        # Steps and error estimate of the ring 'row' of a 'BatchedRing', or of a single ring
+        steps, error_estimate = np.asarray(self.steps), np.asarray(self.error_estimate)
+        if row is not None:
+            steps = steps[row] if steps.ndim else steps
+            error_estimate = error_estimate[row] if error_estimate.ndim else error_estimate
+        return int(steps), float(error_estimate)
+
+
+class Euler(Integrator):
+    # The update of the models in 'Car' and 'Ring', including the safe step of the Custom model
+    name = 'euler'
+
+    def advance(self, ring, dt):
+        ring.step(dt)
+        self.steps += 1
+        # Position error against the ballistic update
+        self.record_error(ring, 0.5 * ring.acceleration * dt ** 2)
+
+
+class Ballistic(Integrator):
+    # Constant acceleration over the step; vehicles that would move backwards stop within the step
+    name = 'ballistic'
+
+    def advance(self, ring, dt):
+        acceleration = ring.model_acceleration(ring.position, ring.velocity)
+        velocity = ring.velocity + acceleration * dt
+        stopping = velocity < 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            position_change = np.where(stopping, -ring.velocity ** 2 / (2 * acceleration),
+                                       ring.velocity * dt + 0.5 * acceleration * dt ** 2)
+
+        # Position error against the Euler update of the models
+        self.record_error(ring, np.where(stopping, 0.0, 0.5 * acceleration * dt ** 2))
+        ring.acceleration = acceleration
+        ring.velocity = np.maximum(velocity, 0)
+        ring.update_car_position(position_change)
+        self.steps += 1
+
+
+class RungeKutta4(Integrator):
+    # Classical fourth order Runge-Kutta on positions and velocities
+    name = 'rk4'
+
+    def advance(self, ring, dt):
+        position, velocity = ring.position, ring.velocity
+        a1 = ring.model_acceleration(position, velocity)
+        v2 = velocity + 0.5 * dt * a1
+        a2 = ring.model_acceleration(position + 0.5 * dt * velocity, v2)
+        v3 = velocity + 0.5 * dt * a2
+        a3 = ring.model_acceleration(position + 0.5 * dt * v2, v3)
+        v4 = velocity + dt * a3
+        a4 = ring.model_acceleration(position + dt * v3, v4)
+
+        position_change = dt / 6 * (velocity + 2 * v2 + 2 * v3 + v4)
+        velocity_change = dt / 6 * (a1 + 2 * a2 + 2 * a3 + a4)
+
+        # Error against the second order midpoint update
+        self.record_error(ring, position_change - dt * v2, velocity_change - dt * a2)
+        ring.acceleration = a1
+        ring.velocity = np.maximum(velocity + velocity_change, 0)
+        ring.update_car_position(np.maximum(position_change, 0))
+        self.steps += 1
+
+
+class Adaptive(Integrator):
+    # Bogacki-Shampine 3(2) pair with step size control. Within every time step of the simulation,
+    # the integrator takes as many substeps as needed to keep the error estimate of each substep below
+    # 'atol + rtol * |state|', so it takes few large substeps in free flow and refines in stop-and-go waves.
+    # The substep size carries over between time steps, substeps shorter than 'min_substep' are always accepted.
+    name = 'adaptive'
+
+    def __init__(self, rtol=1e-3, atol=1e-3, min_substep=1e-6):
+        super().__init__()
+        self.rtol = rtol
+        self.atol = atol
+        self.min_substep = min_substep
+        self.substep = None
+
+    @staticmethod
+    def stage_acceleration(ring, position, velocity):
+        # Stopped vehicles do not move backwards, so their braking is zero rather than the (possibly huge)
+        # acceleration of the model, which would otherwise keep the error estimate above the tolerance
+        acceleration = ring.model_acceleration(position, velocity)
+        return np.where((velocity <= 0) & (acceleration < 0), 0.0, acceleration)
+
+    def advance(self, ring, dt):
+        # The rings of a 'BatchedRing' take substeps of their own: 'time' and 'substep' hold one value per ring,
+        # and a ring that reached the end of the time step waits, with a substep of zero, for the others
+        position, velocity = ring.position, ring.velocity
+        acceleration = self.stage_acceleration(ring, position, velocity)
+        time = np.zeros(position.shape[:-1])
+        substep = np.minimum(dt if self.substep is None else self.substep, dt)
+        active = dt - time > 1e-12 * dt
+
+        while np.any(active):
+            h = np.where(active, np.minimum(substep, dt - time), 0.0)
+            # Substep coefficients of every ring, Python floats on a single ring so that they take the precision of
+            # each state array (the positions of a float32 'LargeRing' and its float64 velocities)
+            half, three_quarters, ninth, twenty_fourth = (
+                coefficient[..., None] if coefficient.ndim else float(coefficient)
+                for coefficient in (0.5 * h, 0.75 * h, h / 9, h / 24))
+            v2 = velocity + half * acceleration
+            a2 = self.stage_acceleration(ring, position + half * velocity, np.maximum(v2, 0))
+            v3 = velocity + three_quarters * a2
+            a3 = self.stage_acceleration(ring, position + three_quarters * v2, np.maximum(v3, 0))
+            new_position = position + ninth * (2 * velocity + 3 * v2 + 4 * v3)
+            new_velocity = np.maximum(velocity + ninth * (2 * acceleration + 3 * a2 + 4 * a3), 0)
+            new_acceleration = self.stage_acceleration(ring, new_position, new_velocity)
+
+            # Difference to the embedded second order update, relative to the tolerance
+            position_error = new_position - (position + twenty_fourth * (7 * velocity + 6 * v2 + 8 * v3 +
+                                                                         3 * new_velocity))
+            velocity_error = new_velocity - (velocity + twenty_fourth * (7 * acceleration + 6 * a2 + 8 * a3 +
+                                                                         3 * new_acceleration))
+            error = np.maximum(
+                row_maximum(ring, np.abs(position_error) / (self.atol + self.rtol * np.abs(new_position - position))),
+                row_maximum(ring, np.abs(velocity_error) / (self.atol + self.rtol * np.abs(new_velocity))))
+
+            accepted = active & ((error <= 1) | (h <= self.min_substep))
+            time = np.where(accepted, time + h, time)
+            position = np.where(accepted[..., None], new_position, position)
+            velocity = np.where(accepted[..., None], new_velocity, velocity)
+            acceleration = np.where(accepted[..., None], new_acceleration, acceleration)
+            self.steps = self.steps + accepted
+            self.rejected_steps = self.rejected_steps + (active & ~accepted)
+            self.record_error(ring, np.where(accepted[..., None], position_error, 0.0),
+                              np.where(accepted[..., None], velocity_error, 0.0))
+            # In Python floats, as the vectorized power of NumPy may round differently depending on the number of rings
+            factor = np.reshape([5.0 if value == 0 else min(5.0, max(0.2, 0.9 * value ** (-1 / 3)))
+                                 for value in np.ravel(error).tolist()], np.shape(error))
+            substep = np.where(active, h * factor, substep)
+            active = dt - time > 1e-12 * dt
+
+        self.substep = substep
+        ring.acceleration = acceleration
+        ring.velocity = velocity
+        ring.update_car_position(np.maximum(position - ring.position, 0))
+
+
+INTEGRATORS = {integrator.name: integrator for integrator in (Euler, Ballistic, RungeKutta4, Adaptive)}
+
+
+def make_integrator(name):
+    if name not in INTEGRATORS:
+        raise ValueError(f"Unknown integrator {name!r}, expected one of {tuple(INTEGRATORS)}")
+    return INTEGRATORS[name]()
@@ -0,0 +1,107 @@
+import functools
+import importlib.util
+import math
+
+
+# Compiled Euler step of a single-lane 'Ring' of the IDM or Custom model. The NumPy update of 'Ring.step'
+# evaluates every expression of the models over the whole ring, allocating a temporary array for each, and
+# takes the safe step of the Custom model through masks. 'ring_step' does the same in one pass over the
+# vehicles: gap, acceleration, Euler update, safe step and wraparound, writing into the state arrays of the
+# ring without allocating. Like the NumPy update, all vehicles are updated from the state of the previous
+# time step: the loop keeps the previous state of the vehicle in front, and of vehicle 0 for the last vehicle,
+# which follows it. Compiled with Numba, it agrees with the NumPy update to rounding (bit for bit in the
+# runs of benchmarks/kernel_parity.py).
+#
+# Numba is optional. Without it, the rings take the NumPy update.
+
+KERNELS = ('auto', 'numpy', 'numba')
+# Smallest ring for which 'auto' compiles the step: importing Numba and loading the compiled step take
+# about half a second, which the NumPy update of the small rings of the density sweep does not make up for
+AUTO_MIN_VEHICLES = 1000
+
+
+def ring_step(position, velocity, acceleration, custom, s_min, t, a_max, b, delta, max_velocity, edge,
+              reference_position_x, road_length, dt):
+    num_vehicles = len(position)
+    if num_vehicles == 0:
+        return
+    comfortable_braking = 2 * math.sqrt(a_max * b)
+    # Integer exponents (4 in idm.py) are taken by repeated multiplication rather than by 'pow'
+    integer_delta = int(delta) if delta == math.floor(delta) and 0 <= delta <= 16 else -1
+    # Previous state of the vehicle in front of vehicle 0, and of the vehicle behind the last one
+    lead_position = position[num_vehicles - 1]
+    lead_velocity = velocity[num_vehicles - 1]
+    first_position = position[0]
+
+    for x in range(num_vehicles):
+        own_position = position[x]
+        own_velocity = velocity[x]
+        lead_gap = lead_position - own_position + (road_length if own_position >= lead_position else 0.0)
+        # The IDM uses the velocity difference of the vehicle to itself, see 'Ring.velocity_difference'
+        velocity_difference = own_velocity - lead_velocity if custom else 0.0
+        desired_gap = s_min + max(0.0, own_velocity * t + (own_velocity * velocity_difference) / comfortable_braking)
+        gap_ratio = desired_gap / lead_gap
+        relative_velocity = own_velocity / max_velocity
+        free_road = relative_velocity ** integer_delta if integer_delta >= 0 else math.pow(relative_velocity, delta)
+        own_acceleration = a_max * (1 - free_road - gap_ratio * gap_ratio)
+
+        # Euler update, vehicles never move backwards
+        velocity_change = own_acceleration * dt
+        new_velocity = max(own_velocity + velocity_change, 0.0)
+        position_change = new_velocity * dt
+        if custom and velocity_change < -10:
+            # Vehicles that are tailgated and brake hard take the safe step of 'Car.safe_next_step'
+            follow_position = position[x + 1] if x + 1 < num_vehicles else first_position
+            follow_gap = own_position - follow_position + (road_length if own_position <= follow_position else 0.0)
+            if follow_gap < 1.5 * s_min:
+                new_velocity = lead_gap / 2 * dt
+                position_change = lead_gap / 2 if new_velocity < -10 else new_velocity * dt
+
+        # Vehicles beyond the right edge of the screen re-enter the road at the reference position
+        if own_position > edge:
+            position[x] = reference_position_x + position_change
+        else:
+            position[x] = own_position + position_change
+        velocity[x] = new_velocity
+        acceleration[x] = own_acceleration
+        lead_position = own_position
+        lead_velocity = own_velocity
+
+
+def numba_available():
+    # Whether Numba is installed, without importing it
+    return importlib.util.find_spec('numba') is not None
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_ring_step():
+    # 'ring_step' compiled by Numba, cached on disk next to this file so that later processes only load it
+    import numba
+    return numba.njit(cache=True, nogil=True)(ring_step)
+
+
+def select_kernel(kernel, model, num_vehicles, vehicles=None):
+    # The kernel of a single-lane ring: 'numba' for the compiled step, or None for the NumPy update.
+    # 'auto' compiles the step of large rings when Numba is installed. Mixed populations and the Test model
+    # take the NumPy update.
+    if kernel not in KERNELS:
+        raise ValueError(f"Unknown kernel {kernel!r}, expected one of {KERNELS}")
+    supported = model in ('IDM', 'Custom') and vehicles is None
+    if kernel == 'numba':
+        if not supported:
+            raise ValueError("The numba kernel runs the IDM and Custom models of vehicles that are alike")
+        if not numba_available():
+            raise ValueError("The numba kernel needs Numba, install it with 'pip install numba'")
+        return 'numba'
+    if kernel == 'auto' and supported and num_vehicles >= AUTO_MIN_VEHICLES and numba_available():
+        return 'numba'
+    return None
+
+
+def step_ring(ring, dt):
+    # One Euler step of 'ring' with the compiled kernel, in place
+    p = ring.params
+    compiled_ring_step()(ring.position, ring.velocity, ring.acceleration, ring.model == 'Custom',
+                         float(p['S_MIN']), float(p['T']), float(p['A_MAX']), float(p['B']), float(p['DELTA']),
+                         float(p['MAX_VELOCITY']), float(ring.edge), float(ring.reference_position_x),
+                         float(ring.road_length), float(dt))
@@ -0,0 +1,191 @@
+import numpy as np
+
+from metrics import StreamingMetrics
+from ring import Ring
+
+
+# Multi-lane ring road with lane changes by MOBIL (Kesting, Treiber and Helbing, 2007)
+
+# Distance between the lanes on the screen (in meters)
+LANE_WIDTH = 1.4
+
+# MOBIL parameters
+POLITENESS = 0.2  # weight of the advantage or disadvantage of the other vehicles
+B_SAFE = 4  # largest deceleration imposed on the new follower (m/s^2)
+A_THRESHOLD = 0.1  # smallest advantage that makes a vehicle change lanes (m/s^2)
+
+
+def mobil_parameters():
+    return {'POLITENESS': POLITENESS, 'B_SAFE': B_SAFE, 'A_THRESHOLD': A_THRESHOLD}
+
+
+def initial_lanes(num_vehicles, lanes):
+    # The vehicles placed one behind the other by 'initial_positions' are dealt to the lanes in turn
+    return np.arange(num_vehicles) % lanes
+
+
+class MultiLaneRing(Ring):
+    # A ring of several lanes, the vehicle followed by each vehicle is the next one in its lane.
+    # The vehicles are kept in 'order', sorted by lane and position, so the leader and the follower of
+    # a vehicle are its neighbors in 'order' (O(1)) and those in another lane are found by binary search
+    # (O(log n)). After every step, 'order' is sorted again starting from the previous order: it is only
+    # disturbed by the vehicles that wrapped around or changed lanes, which the stable (Timsort) argsort
+    # merges in linear time. At the end of every step, the vehicles change lanes by MOBIL, alternating
+    # between moves to the left (higher lane) and to the right to avoid two vehicles swapping lanes.
+    def __init__(self, positions, lanes, screen_width, reference_position_x, model, params, vehicles=None,
+                 mobil_params=None):
+        super().__init__(positions, screen_width, reference_position_x, model, params, vehicles)
+        self.lanes = int(np.max(lanes)) + 1 if np.size(lanes) else 1
+        self.lane = np.asarray(lanes, dtype=int).copy()
+        self.mobil_params = mobil_params or mobil_parameters()
+        self.step_count = 0
+        # Vehicles that changed lanes at the end of the last step
+        self.changed = np.zeros(len(self.position), dtype=bool)
+        self.order = np.arange(len(self.position))
+        self.update_index()
+
+    def sort_keys(self, lane, position):
+        # Sort key of a position in a lane, the lanes follow each other. Positions lie between the reference
+        # position and the edge plus the last position change, less than twice the road length after it.
+        return lane * 2 * self.road_length + (position - self.reference_position_x)
+
+    def update_index(self):
+        keys = self.sort_keys(self.lane, self.position)
+        self.order = self.order[np.argsort(keys[self.order], kind='stable')]
+        self.sorted_keys = keys[self.order]
+        self.lane_start = np.searchsorted(self.lane[self.order], np.arange(self.lanes + 1))
+
+        # Next and previous vehicle of the same lane, around the ring
+        start = self.lane_start[self.lane[self.order]]
+        end = self.lane_start[self.lane[self.order] + 1]
+        sorted_index = np.arange(len(self.order))
+        self.lead_index = np.empty_like(self.order)
+        self.follow_index = np.empty_like(self.order)
+        self.lead_index[self.order] = self.order[np.where(sorted_index + 1 < end, sorted_index + 1, start)]
+        self.follow_index[self.order] = self.order[np.where(sorted_index > start, sorted_index - 1, end - 1)]
+
+    def lead(self, values):
+        return values[self.lead_index]
+
+    def follow(self, values):
+        return values[self.follow_index]
+
+    def neighbors(self, lane, position):
+        # Leader and follower of a vehicle at 'position' in 'lane', or -1 when the lane is empty
+        start, end = self.lane_start[lane], self.lane_start[lane + 1]
+        index = np.searchsorted(self.sorted_keys, self.sort_keys(lane, position), side='right')
+        empty = start == end
+        index = np.where(empty, 0, index)
+        lead = np.where(index < end, index, start)
+        follow = np.where(index > start, index - 1, end - 1)
+        return np.where(empty, -1, self.order[lead]), np.where(empty, -1, self.order[np.maximum(follow, 0)])
+
+    def gap(self, vehicles, lead):
+        # Net distance from the front of 'vehicles' to the rear of the vehicles 'lead', as 'Ring.lead_gap'
+        position, lead_position = self.position[vehicles], self.position[lead]
+        gap = lead_position - position + self.road_length * (position >= lead_position)
+        return gap if self.length is None else gap - self.length[lead]
+
+    def acceleration_behind(self, vehicles, lead):
+        # Acceleration of 'vehicles' if they followed the vehicles 'lead'. A vehicle alone in its lane
+        # (lead -1) follows itself around the ring, as in 'Ring'.
+        lead = np.where(lead < 0, vehicles, lead)
+        velocity = self.velocity[vehicles]
+        if self.custom is not None:
+            velocity_difference = np.where(self.custom[vehicles], velocity - self.velocity[lead], 0.0)
+        else:
+            velocity_difference = 0.0 if self.model == 'IDM' else velocity - self.velocity[lead]
+        params = None
+        if self.custom is not None:
+            # Parameters of the vehicles of a mixed population
+            params = {name: value[vehicles] for name, value in self.params.items()}
+        return self.desired_acceleration(self.gap(vehicles, lead), velocity, velocity_difference, params)
+
+    def change_lanes(self):
+        # MOBIL: a vehicle moves to the neighboring lane when it is safe for its new follower and
+        # its own advantage, plus 'POLITENESS' times that of its old and new followers, exceeds 'A_THRESHOLD'
+        p = self.mobil_params
+        direction = 1 if self.step_count % 2 else -1
+        target = self.lane + direction
+        candidates = np.flatnonzero((target >= 0) & (target < self.lanes))
+        self.changed[...] = False
+        if self.model == 'Test' or not len(candidates):
+            return
+
+        target = target[candidates]
+        new_lead, new_follow = self.neighbors(target, self.position[candidates])
+        old_lead, old_follow = self.lead_index[candidates], self.follow_index[candidates]
+        alone = old_lead == candidates
+
+        # Accelerations of the vehicle and of its new and old followers, before and after the change
+        acceleration = self.acceleration_behind(candidates, old_lead)
+        new_acceleration = self.acceleration_behind(candidates, new_lead)
+        has_new_follow = new_follow >= 0
+        new_follow = np.where(has_new_follow, new_follow, candidates)
+        new_follow_before = np.where(has_new_follow,
+                                     self.acceleration_behind(new_follow, self.lead_index[new_follow]), 0)
+        new_follow_after = np.where(has_new_follow, self.acceleration_behind(new_follow, candidates), 0)
+        old_follow_before = np.where(alone, 0, self.acceleration_behind(old_follow, candidates))
+        old_follow_after = np.where(alone, 0, self.acceleration_behind(old_follow, old_lead))
+
+        incentive = new_acceleration - acceleration + p['POLITENESS'] * (
+            new_follow_after - new_follow_before + old_follow_after - old_follow_before)
+        change = ((new_follow_after >= -p['B_SAFE']) & (new_acceleration >= -p['B_SAFE']) &
+                  (incentive > p['A_THRESHOLD']))
+        # The gaps in the new lane must hold the vehicle
+        change &= ~has_new_follow | (self.gap(new_follow, candidates) > 0)
+        change &= (new_lead < 0) | (self.gap(candidates, np.where(new_lead < 0, candidates, new_lead)) > 0)
+
+        # At most one vehicle moves into every gap, the one with the largest incentive
+        change = np.flatnonzero(change)
+        if not len(change):
+            return
+        change = change[np.argsort(-incentive[change], kind='stable')]
+        gap_id = target[change] * (len(self.position) + 1) + new_lead[change] + 1
+        _, first = np.unique(gap_id, return_index=True)
+        change = candidates[change[first]]
+
+        self.lane[change] += direction
+        self.changed[change] = True
+
+    def update_car_position(self, position_change):
+        super().update_car_position(position_change)
+        self.update_index()
+        self.step_count += 1
+        self.change_lanes()
+        if self.changed.any():
+            self.update_index()
+
+
+class LaneMetrics(StreamingMetrics):
+    # The statistics of 'StreamingMetrics' for all vehicles, and the density, flow and speed of every lane
+    # of a 'MultiLaneRing', from the number of vehicles in the lane, their speeds and their crossings of the
+    # screen edge, summed over the measured steps
+    def __init__(self, mask, lanes, batch_steps=10):
+        # Only whole rings are measured, 'update' is never given 'active'
+        super().__init__(mask, batch_steps)
+        self.lanes = lanes
+        self.lane_vehicles = np.zeros(lanes)
+        self.lane_velocity_sum = np.zeros(lanes)
+        self.lane_crossings = np.zeros(lanes)
+        self.lane_changes = np.zeros(lanes)
+
+    def update(self, ring, previous_position, dt, active=None):
+        super().update(ring, previous_position, dt, active)
+        crossed = ring.position < previous_position
+        self.lane_vehicles += np.bincount(ring.lane, minlength=self.lanes)
+        self.lane_velocity_sum += np.bincount(ring.lane, weights=ring.velocity, minlength=self.lanes)
+        self.lane_crossings += np.bincount(ring.lane, weights=crossed, minlength=self.lanes)
+        self.lane_changes += np.bincount(ring.lane[ring.changed], minlength=self.lanes)
+
+    def summary(self, row=None, measurement_time=None):
+        statistics = super().summary(row, measurement_time)
+        steps, time = int(self.steps), float(self.time)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speeds = self.lane_velocity_sum / self.lane_vehicles
+        statistics['lanes'] = [{'lane': lane, 'vehicles': float(self.lane_vehicles[lane]) / steps if steps else np.nan,
+                                'flow': float(self.lane_crossings[lane]) /
+                                (time if measurement_time is None else measurement_time),
+                                'speed': float(speeds[lane]), 'lane_changes': int(self.lane_changes[lane])}
+                               for lane in range(self.lanes)]
+        return statistics
@@ -0,0 +1,250 @@
+import logging
+import time
+
+import numpy as np
+
+from ring import Ring
+
+
+# Headless rings of 10^5 to 10^6 vehicles on roads of realistic length, given in meters and vehicles rather
+# than screen pixels. The state is held in contiguous float32 or float64 arrays and the time steps are
+# computed in chunks of vehicles, with buffers allocated once, so the temporaries stay in the CPU caches.
+# Instead of per-vehicle records, the vehicles are counted in bins along the road, like loop detectors,
+# giving the space-time diagrams of density, speed and flow in which stop-and-go waves propagate.
+
+# Vehicles have lengths on realistic roads (m)
+VEHICLE_LENGTH = 5.0
+# Length of the bins along the road (m), and sampling interval of the bins (s)
+BIN_LENGTH = 100.0
+SAMPLE_INTERVAL = 1.0
+# Vehicles of a chunk: the buffers of a chunk stay in the CPU caches (twice as fast as whole arrays of 10^6 vehicles)
+CHUNK_SIZE = 2 ** 16
+# Standard deviation of the initial positions around the uniform spacing (m), which seeds the waves
+PERTURBATION = 0.5
+
+PRECISIONS = {'float32': np.float32, 'float64': np.float64}
+
+# Columns of the statistics of a large ring, see data/large_ring_statistics_data_dictionary.csv
+LARGE_RING_FIELDS = ['num_vehicles', 'road_length', 'density', 'flow', 'speed', 'speed_std', 'simulation_time',
+                     'integrator_steps', 'vehicle_steps_per_second']
+
+
+def equilibrium_velocity(gap, params):
+    # Velocity at which the IDM vehicles of the ring (without approaching term, as in 'Ring') keep 'gap',
+    # by bisection of the acceleration, which decreases with the velocity
+    low, high = 0.0, float(params['MAX_VELOCITY'])
+    for _ in range(60):
+        velocity = (low + high) / 2
+        desired_gap = params['S_MIN'] + velocity * params['T']
+        acceleration = 1 - (velocity / params['MAX_VELOCITY']) ** params['DELTA'] - (desired_gap / gap) ** 2
+        low, high = (velocity, high) if acceleration > 0 else (low, velocity)
+    return low
+
+
+class LargeRing(Ring):
+    # A closed road of 'road_length' meters with 'num_vehicles' vehicles of 'vehicle_length', independent of
+    # the screen. Positions run from 0 to 'road_length' and wrap around exactly (the screen ring re-enters
+    # vehicles at the reference position instead). As in 'Ring', vehicle x follows vehicle x-1 and all vehicles
+    # are updated synchronously, so the chunks give the same result as one step over the whole ring.
+    # 'step' (the Euler update) runs chunk by chunk; the other integrators use the methods of 'Ring'
+    # on the whole arrays.
+    def __init__(self, num_vehicles, road_length, model, params, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                 vehicle_length=VEHICLE_LENGTH, perturbation=PERTURBATION, seed=0):
+        # The geometry of the screen is replaced below
+        super().__init__([], 0, 0, model, params)
+        if model == 'Test':
+            raise ValueError("The large ring runs the IDM or Custom model")
+        spacing = road_length / num_vehicles
+        if spacing <= vehicle_length:
+            raise ValueError(f"{num_vehicles} vehicles of {vehicle_length} m do not fit on {road_length} m")
+
+        resolution = float(np.spacing(dtype(road_length)))
+        if resolution > 0.01:
+            logging.warning(f"Positions in {np.dtype(dtype).name} are only resolved to {resolution:.2g} m "
+                            f"on {road_length:.0f} m, use float64")
+
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.vehicle_length = vehicle_length
+        self.edge = self.road_length = float(road_length)
+        self.reference_position_x = 0.0
+
+        # Uniformly spaced vehicles at the equilibrium velocity of their gap, slightly perturbed
+        rng = np.random.default_rng(seed)
+        position = road_length - spacing * (np.arange(num_vehicles) + 0.5)
+        position += rng.normal(0, min(perturbation, (spacing - vehicle_length) / 4), num_vehicles)
+        self.position = position.astype(dtype)
+        self.velocity = np.full(num_vehicles, equilibrium_velocity(spacing - vehicle_length, params), dtype=dtype)
+        self.acceleration = np.zeros(num_vehicles, dtype=dtype)
+
+        # Buffers of one chunk
+        size = min(chunk_size, num_vehicles)
+        self.buffers = [np.empty(size, dtype=dtype) for _ in range(4)]
+        self.position_change = np.empty(num_vehicles, dtype=dtype)
+
+    def lead_gap(self, position=None):
+        return self.headway(position) - self.vehicle_length
+
+    def follow_gap(self):
+        follow = self.follow(self.position)
+        return self.position - follow + self.road_length * (self.position <= follow) - self.vehicle_length
+
+    def neighbor_values(self, values, start, stop, offset, out):
+        # values[x + offset] for the vehicles x of the chunk, around the ring
+        n = len(values)
+        first, last = start + offset, stop + offset
+        if 0 <= first and last <= n:
+            out[:stop - start] = values[first:last]
+        else:
+            out[:stop - start] = np.take(values, np.arange(first, last) % n)
+        return out[:stop - start]
+
+    def chunk_gap(self, start, stop):
+        # Net gap of the vehicles of a chunk to their leaders, around the ring for the last vehicle before the end
+        position = self.position[start:stop]
+        gap = self.neighbor_values(self.position, start, stop, -1, self.buffers[0])
+        wrapped = position >= gap
+        np.subtract(gap, position, out=gap)
+        gap += self.road_length * wrapped
+        gap -= self.vehicle_length
+        return gap
+
+    def chunk_acceleration(self, start, stop):
+        # Acceleration of the vehicles of a chunk from the state of the previous step, computed in place
+        p = self.params
+        velocity = self.velocity[start:stop]
+        gap = self.chunk_gap(start, stop)
+
+        desired_gap = self.buffers[1][:stop - start]
+        np.multiply(velocity, p['T'], out=desired_gap)
+        if self.model == 'Custom':
+            approach = self.neighbor_values(self.velocity, start, stop, -1, self.buffers[2])
+            np.subtract(velocity, approach, out=approach)
+            approach *= velocity
+            approach /= 2 * np.sqrt(p['A_MAX'] * p['B'])
+            desired_gap += approach
+        np.maximum(desired_gap, 0, out=desired_gap)
+        desired_gap += p['S_MIN']
+
+        acceleration = self.acceleration[start:stop]
+        np.divide(desired_gap, gap, out=desired_gap)
+        np.square(desired_gap, out=desired_gap)
+        np.divide(velocity, p['MAX_VELOCITY'], out=acceleration)
+        acceleration **= p['DELTA']
+        np.subtract(1, acceleration, out=acceleration)
+        acceleration -= desired_gap
+        acceleration *= p['A_MAX']
+
+    def step(self, dt):
+        n = len(self.position)
+        chunks = [(start, min(start + self.chunk_size, n)) for start in range(0, n, self.chunk_size)]
+        # The accelerations of all vehicles are computed before any velocity changes, the Custom model
+        # needs the velocity of the leader
+        for start, stop in chunks:
+            self.chunk_acceleration(start, stop)
+
+        for start, stop in chunks:
+            velocity, acceleration = self.velocity[start:stop], self.acceleration[start:stop]
+            change = self.position_change[start:stop]
+            if self.model == 'Custom':
+                # Tailgated vehicles take the safe step of 'Ring.custom_model'
+                gap = self.chunk_gap(start, stop)
+                position = self.position[start:stop]
+                follow = self.neighbor_values(self.position, start, stop, 1, self.buffers[3])
+                follow_gap = position - follow + self.road_length * (position <= follow) - self.vehicle_length
+                hard_brake = (follow_gap < 1.5 * self.params['S_MIN']) & (acceleration * dt < -10)
+                new_velocity = np.where(hard_brake, gap / 2 * dt, np.maximum(velocity + acceleration * dt, 0))
+                change[...] = np.where(hard_brake & (new_velocity < -10), gap / 2, new_velocity * dt)
+                velocity[...] = new_velocity
+            else:
+                velocity += acceleration * dt
+                np.maximum(velocity, 0, out=velocity)
+                np.multiply(velocity, dt, out=change)
+        self.update_car_position(self.position_change)
+
+    def update_car_position(self, position_change):
+        self.position += position_change.astype(self.dtype, copy=False)
+        self.position[self.position >= self.road_length] -= self.road_length
+
+
+class SpatialBins:
+    # Vehicles counted in bins of 'bin_length' along the road at every time step, like a row of loop
+    # detectors, and averaged over intervals of 'interval_steps' steps into space-time diagrams of the
+    # density (veh/m), the space-mean speed (m/s) and the flow (density times speed, veh/s). The diagrams
+    # are allocated once for all 'intervals', so the memory does not depend on the number of vehicles.
+    def __init__(self, road_length, bin_length, interval_steps, intervals, chunk_size=CHUNK_SIZE):
+        self.bins = int(np.ceil(road_length / bin_length))
+        self.bin_length = bin_length
+        self.interval_steps = interval_steps
+        self.chunk_size = chunk_size
+        self.counts = np.zeros(self.bins)
+        self.speed_sums = np.zeros(self.bins)
+        self.steps = 0
+        self.interval = 0
+        self.time = np.full(intervals, np.nan)
+        self.density = np.full((intervals, self.bins), np.nan, dtype=np.float32)
+        self.speed = np.full((intervals, self.bins), np.nan, dtype=np.float32)
+
+    def update(self, ring, time_elapsed):
+        n = len(ring.position)
+        for start in range(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            index = (ring.position[start:stop] / self.bin_length).astype(np.intp)
+            np.minimum(index, self.bins - 1, out=index)
+            # The vehicles of a chunk follow each other, so they only cover a few bins
+            first = int(index.min())
+            index -= first
+            counts = np.bincount(index)
+            self.counts[first:first + len(counts)] += counts
+            self.speed_sums[first:first + len(counts)] += np.bincount(index, weights=ring.velocity[start:stop])
+        self.steps += 1
+        if self.steps == self.interval_steps:
+            self.close_interval(time_elapsed)
+
+    def close_interval(self, time_elapsed):
+        if self.interval < len(self.time):
+            self.time[self.interval] = time_elapsed
+            self.density[self.interval] = self.counts / (self.steps * self.bin_length)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.speed[self.interval] = self.speed_sums / self.counts
+            self.interval += 1
+        self.counts[...] = 0
+        self.speed_sums[...] = 0
+        self.steps = 0
+
+    def flow(self):
+        return np.nan_to_num(self.speed) * self.density
+
+    def save(self, path):
+        # The space-time diagrams, 'bin_start' in m and 'time' in s at the end of every interval
+        np.savez(path, time=self.time[:self.interval], bin_start=np.arange(self.bins) * self.bin_length,
+                 density=self.density[:self.interval], speed=self.speed[:self.interval],
+                 flow=self.flow()[:self.interval])
+
+
+def run_large_ring(num_vehicles, road_length, model, params, simulation_time, dt, integrator, dtype=np.float64,
+                   chunk_size=CHUNK_SIZE, bin_length=BIN_LENGTH, sample_interval=SAMPLE_INTERVAL, seed=0):
+    # Run a large ring and return its statistics and its space-time diagrams ('SpatialBins')
+    ring = LargeRing(num_vehicles, road_length, model, params, dtype, chunk_size, seed=seed)
+    interval_steps = max(1, round(sample_interval / dt))
+    steps = int(round(simulation_time / dt))
+    bins = SpatialBins(road_length, bin_length, interval_steps, steps // interval_steps, chunk_size)
+
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        integrator.advance(ring, dt)
+        bins.update(ring, step * dt)
+        if step % (10 * interval_steps) == 0:
+            logging.info(f"{step * dt:.0f} s simulated, {time.perf_counter() - start:.1f} s elapsed")
+    wall_time = time.perf_counter() - start
+
+    # Space-mean speed and flow over the second half of the simulation, as the fixed window of the small rings
+    measured = bins.time[:bins.interval] > simulation_time / 2
+    statistics = {'num_vehicles': num_vehicles, 'road_length': road_length,
+                  'density': num_vehicles / road_length,
+                  'speed': float(np.nanmean(bins.speed[:bins.interval][measured])) if measured.any() else np.nan,
+                  'flow': float(np.mean(bins.flow()[:bins.interval][measured])) if measured.any() else np.nan,
+                  'speed_std': float(np.std(ring.velocity, dtype=np.float64)),
+                  'simulation_time': steps * dt, 'integrator_steps': integrator.statistics()[0],
+                  'vehicle_steps_per_second': num_vehicles * steps / wall_time}
+    return statistics, bins
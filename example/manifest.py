@@ -0,0 +1,161 @@
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Reproducibility manifest of a run, written next to its data files: the root seed and the seed of every
+# scenario (see rng.py), the model and its parameters, the options of the run, the hash of the simulation
+# core (see cache.py), the versions of Python and NumPy, the timings and a checksum of every data file.
+# The scenarios of a sweep can be split into shards run on different machines with --shard, and the data
+# directories of the shards merged into the data files of a single run with --merge-shards, whose checksums
+# are compared with those of a serial run with --verify.
+
+MANIFEST_FILE = "data/manifest.json"
+
+
+def file_checksum(path):
+    # SHA-256 of a data file, of the names and contents of the arrays of an .npz archive (whose zip entries carry
+    # the time they were written), or of the relative paths and contents of the files of a directory
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(files):
+                digest.update(os.path.relpath(os.path.join(root, name), path).encode() + b'\0')
+                digest.update(file_checksum(os.path.join(root, name)).encode())
+    elif path.endswith('.npz'):
+        with np.load(path) as arrays:
+            for name in sorted(arrays.files):
+                array = np.ascontiguousarray(arrays[name])
+                digest.update(f'{name}\0{array.dtype.str}\0{array.shape}\0'.encode() + array.tobytes())
+    else:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(2 ** 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def output_checksums(paths):
+    # Checksums of the data files 'paths' that exist, by their names in the data directory
+    return {os.path.basename(path): file_checksum(path) for path in sorted(paths) if os.path.exists(path)}
+
+
+def write_manifest(path, manifest):
+    with open(path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def read_manifest(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def parse_shard(text, total_simulations):
+    # 'K/N' runs shard K of N, e.g. '2/4' runs the simulations 2, 6, 10 and 14 of 15
+    index, _, count = (text or '').partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"A shard is given as K/N, e.g. 2/4, got {text!r}") from None
+    if not 1 <= index <= count <= total_simulations:
+        raise ValueError(f"Shard {text!r} must satisfy 1 <= K <= N <= {total_simulations}")
+    return [index, count]
+
+
+def shard_simulations(total_simulations, shard=None):
+    # The simulation numbers of 'shard' ([K, N] of 'parse_shard'), all of them without shard
+    if shard is None:
+        return list(range(1, total_simulations + 1))
+    index, count = shard
+    return list(range(index, total_simulations + 1, count))
+
+
+def merge_table(paths, simulations):
+    # Merge the CSV tables of the shards 'paths' into the lines of a single run, ordered by simulation number.
+    # The lines of a table with a 'simulation' or 'Simulation No' column belong to that simulation, the tables
+    # of the fundamental diagrams have one line per simulation of its shard, in the order of 'simulations'.
+    # The row index of the trajectory (its unnamed first column) is numbered again.
+    header, lines = None, {}
+    for path, shard_simulations in zip(paths, simulations):
+        with open(path, newline='') as file:
+            shard_header, *rows = file.read().splitlines(keepends=True)
+        if header not in (None, shard_header):
+            raise ValueError(f"The columns of {path!r} differ from those of the other shards")
+        header = shard_header
+        columns = next(csv.reader([header]))
+        column = next((columns.index(name) for name in ('simulation', 'Simulation No') if name in columns), None)
+        if column is None:
+            if len(rows) != len(shard_simulations):
+                raise ValueError(f"{path!r} has {len(rows)} rows for {len(shard_simulations)} simulations")
+            for simulation, row in zip(shard_simulations, rows):
+                lines.setdefault(simulation, []).append(row)
+        else:
+            for row in rows:
+                lines.setdefault(int(next(csv.reader([row]))[column]), []).append(row)
+
+    merged = [row for simulation in sorted(lines) for row in lines[simulation]]
+    if header.startswith(','):
+        merged = [f'{index},{row.partition(",")[2]}' for index, row in enumerate(merged)]
+    return [header] + merged
+
+
+def merge_shards(directories, output_directory):
+    # Merge the data files of the shards in 'directories', each holding the data files and the manifest of a
+    # run with --shard, into 'output_directory'. Returns the manifest of the merged run.
+    manifests = [read_manifest(os.path.join(directory, os.path.basename(MANIFEST_FILE))) for directory in directories]
+    reference = manifests[0]
+    for directory, manifest in zip(directories, manifests):
+        for name in ('seed', 'model', 'parameters', 'options', 'code_version', 'total_simulations'):
+            if manifest.get(name) != reference.get(name):
+                raise ValueError(f"The {name} of the shard in {directory!r} differs from that of {directories[0]!r}")
+        if set(manifest['outputs']) != set(reference['outputs']):
+            raise ValueError(f"The shard in {directory!r} wrote other data files than {directories[0]!r}")
+    if reference['options']['output_format'] != 'csv':
+        raise ValueError("Shards are merged from CSV data files, run them with --output-format csv")
+    simulations = [[scenario['simulation'] for scenario in manifest['scenarios']] for manifest in manifests]
+    merged_simulations = sorted(simulation for shard in simulations for simulation in shard)
+    if len(set(merged_simulations)) != len(merged_simulations):
+        raise ValueError("The shards overlap, every simulation must be run by one shard only")
+    if merged_simulations != list(range(1, reference['total_simulations'] + 1)):
+        missing = sorted(set(range(1, reference['total_simulations'] + 1)) - set(merged_simulations))
+        raise ValueError(f"The shards miss the simulations {missing}")
+
+    os.makedirs(output_directory, exist_ok=True)
+    for name in reference['outputs']:
+        paths = [os.path.join(directory, name) for directory in directories]
+        output = os.path.join(output_directory, name)
+        if name.endswith('.npz'):
+            # The space-time diagrams are named after their simulations
+            arrays = {}
+            for path in paths:
+                with np.load(path) as shard_arrays:
+                    arrays.update((key, shard_arrays[key]) for key in shard_arrays.files)
+            np.savez_compressed(output, **arrays)
+        elif name.endswith('.csv'):
+            with open(output, 'w', newline='') as file:
+                file.writelines(merge_table(paths, simulations))
+        else:
+            raise ValueError(f"The data file {name!r} cannot be merged")
+
+    manifest = dict(reference, shard=None, shards=[manifest['shard'] for manifest in manifests],
+                    scenarios=sorted((scenario for manifest in manifests for scenario in manifest['scenarios']),
+                                     key=lambda scenario: scenario['simulation']),
+                    timings={'shards': [manifest['timings'] for manifest in manifests]},
+                    outputs=output_checksums(os.path.join(output_directory, name) for name in reference['outputs']))
+    return manifest
+
+
+def compare_manifests(manifest, reference):
+    # Differences of the seeds, scenarios and data files of 'manifest' to those of 'reference'
+    differences = []
+    for name in ('seed', 'model', 'parameters', 'scenarios', 'code_version'):
+        if manifest.get(name) != reference.get(name):
+            differences.append(f"The {name} differ")
+    for name in sorted(set(manifest['outputs']) | set(reference['outputs'])):
+        if manifest['outputs'].get(name) != reference['outputs'].get(name):
+            differences.append(f"{name} differs" if name in manifest['outputs'] and name in reference['outputs']
+                               else f"{name} is only written by one of the runs")
+    return differences
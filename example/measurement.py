@@ -0,0 +1,129 @@
+import numpy as np
+
+
+# When the fundamental diagram statistics of a scenario are measured, and when the scenario ends.
+# The loops of 'simulation.py' and 'Environment.run' call 'measure' after every time step and stop
+# once 'running' is False. Both windows handle a single ring or every row of a 'BatchedRing'.
+
+# Absolute floors of the convergence and precision criteria, for speeds and flows close to zero
+SPEED_FLOOR = 0.1  # m/s
+FLOW_FLOOR = 0.01  # veh/s
+
+
+class FixedWindow:
+    # The original schedule: every scenario runs for 'simulation_time' and is measured after 'time_threshold'
+    def __init__(self, shape, simulation_time, time_threshold):
+        self.simulation_time = simulation_time
+        self.time_threshold = time_threshold
+        self.measurement_start = np.full(shape, float(time_threshold))
+        self.end_time = np.zeros(shape)
+        # The rings whose measurement is done
+        self.finished = np.zeros(shape, dtype=bool)
+
+    def running(self, time_elapsed):
+        return self.simulation_time > time_elapsed
+
+    def measure(self, ring, metrics, previous_position, time_elapsed, dt):
+        if time_elapsed > self.time_threshold:
+            metrics.update(ring, previous_position, dt)
+        self.end_time[...] = time_elapsed
+        self.finished[...] = not self.running(time_elapsed)
+
+    def measurement_time(self, row=None):
+        # The flow is averaged over the whole measurement window, as in the original loop
+        return self.simulation_time - self.time_threshold
+
+    def columns(self, row=None):
+        select = () if row is None else row
+        return {'simulation_time': round(float(self.end_time[select]), 6),
+                'measurement_start': round(float(self.measurement_start[select]), 6)}
+
+
+class SteadyStateWindow(FixedWindow):
+    # Measures every ring from the time its mean speed and flow have settled, until the 95% confidence
+    # intervals of its speed and of its flow are within 'target_ci' and 'target_flow_ci' of their values,
+    # or until 'max_time'.
+    #  - settled: over the last 'window_time' seconds, the means of the older and the newer half of the
+    #    mean speed and of the flow (sum of the speeds over the road length) differ by at most 'tolerance'
+    #    (relative). Rings that have not settled at half of 'max_time' are measured from then on.
+    #  - precise: checked at the end of every batch of the metrics, after at least 'min_measurement_time'.
+    #    The speed averages every vehicle at every step, its interval is within 1% after the 10 s floor.
+    #    The flow counted at the screen edge only moves by whole crossings, its interval shrinks from
+    #    about 60% of the flow after 10 s to 10% after 400 s, so that the flow decides when a ring stops.
+    def __init__(self, shape, road_length, dt, window_time=5.0, tolerance=0.02, target_ci=0.05, target_flow_ci=0.5,
+                 min_measurement_time=10.0, max_time=60.0):
+        super().__init__(shape, max_time, max_time / 2)
+        self.road_length = np.asarray(road_length, dtype=float)
+        self.tolerance = tolerance
+        self.target_ci = target_ci
+        self.target_flow_ci = target_flow_ci
+        self.min_measurement_time = min_measurement_time
+        self.max_time = max_time
+
+        self.window_steps = 2 * max(1, round(window_time / dt / 2))
+        # Rings are checked for having settled every half second
+        self.check_steps = max(1, round(0.5 / dt))
+        self.speeds = np.zeros((self.window_steps, ) + tuple(np.shape(self.road_length)))
+        self.flows = np.zeros_like(self.speeds)
+        self.recorded_steps = 0
+
+        self.measurement_start = np.full(shape, np.nan)
+        self.measuring = np.zeros(shape, dtype=bool)
+        self.finished = np.zeros(shape, dtype=bool)
+
+    def running(self, time_elapsed):
+        return self.max_time > time_elapsed and not self.finished.all()
+
+    def measure(self, ring, metrics, previous_position, time_elapsed, dt):
+        if self.measuring.any():
+            metrics.update(ring, previous_position, dt, None if self.measuring.all() else self.measuring)
+            if metrics.batch_closed.any():
+                self.check_precision(metrics, time_elapsed)
+
+        # The rolling statistics are only needed until every ring is measured
+        waiting = ~self.measuring & ~self.finished
+        if waiting.any():
+            velocity_sum = metrics.vehicle_sum(ring.velocity)
+            self.speeds[self.recorded_steps % self.window_steps] = velocity_sum / metrics.count
+            self.flows[self.recorded_steps % self.window_steps] = velocity_sum / self.road_length
+            self.recorded_steps += 1
+
+            if self.recorded_steps % self.check_steps == 0:
+                start = waiting & (self.settled() | (time_elapsed >= self.max_time / 2))
+                self.measuring |= start
+                self.measurement_start[start] = time_elapsed
+
+        self.end_time[~self.finished] = time_elapsed
+
+    def settled(self):
+        if self.recorded_steps < self.window_steps:
+            return np.zeros(self.measuring.shape, dtype=bool)
+
+        half = self.window_steps // 2
+        settled = np.ones(self.measuring.shape, dtype=bool)
+        for values, floor in ((self.speeds, SPEED_FLOOR), (self.flows, FLOW_FLOOR)):
+            # Oldest recorded step first
+            values = np.roll(values, -(self.recorded_steps % self.window_steps), axis=0)
+            older, newer = values[:half].mean(axis=0), values[half:].mean(axis=0)
+            settled &= np.abs(newer - older) <= self.tolerance * np.maximum(np.abs(newer), floor)
+        return settled
+
+    def check_precision(self, metrics, time_elapsed):
+        # Every row is checked at the end of its own batches, counted from the start of its measurement
+        checked = self.measuring & metrics.batch_closed
+        rows = [None] if checked.ndim == 0 else np.flatnonzero(checked).tolist()
+        for row in rows:
+            select = () if row is None else row
+            if not checked[select] or metrics.time[select] < self.min_measurement_time:
+                continue
+            statistics = metrics.summary(row)
+            if statistics['speed_ci'] <= max(self.target_ci * abs(statistics['speed']), SPEED_FLOOR * self.target_ci) \
+                    and statistics['flow_ci'] <= max(self.target_flow_ci * statistics['flow'],
+                                                     FLOW_FLOOR * self.target_flow_ci):
+                self.measuring[select] = False
+                self.finished[select] = True
+                self.end_time[select] = time_elapsed
+
+    def measurement_time(self, row=None):
+        # The flow is averaged over the measured time of each ring
+        return None
@@ -0,0 +1,154 @@
+import math
+
+import numpy as np
+
+
+# Two-sided 95% quantiles of Student's t distribution for 1 to 30 degrees of freedom
+T_QUANTILES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def t_quantile_95(degrees_of_freedom):
+    if degrees_of_freedom < 1:
+        return math.nan
+    if degrees_of_freedom <= len(T_QUANTILES_95):
+        return T_QUANTILES_95[degrees_of_freedom - 1]
+    return 1.96
+
+
+def confidence_half_width(batch_means):
+    # Half width of the 95% confidence interval of a mean, from the means of consecutive batches.
+    # Batches of several time steps are much less correlated than single time steps.
+    if len(batch_means) < 2:
+        return math.nan
+    return t_quantile_95(len(batch_means) - 1) * float(np.std(batch_means, ddof=1)) / math.sqrt(len(batch_means))
+
+
+class StreamingMetrics:
+    # Online statistics of the fundamental diagram of one ring, or of every ring of a 'BatchedRing',
+    # updated from the state arrays of each measured time step without storing the trajectory.
+    # All updates are elementwise on per-vehicle accumulators, the vehicles are only summed up
+    # every 'batch_steps' steps (for the confidence intervals) and in 'summary'.
+    #  - speed: Welford mean and variance of the vehicle speeds (space-mean speed)
+    #  - flow: crossings of the screen edge, where the vehicles wrap around
+    #  - time-mean speed: mean speed of the vehicles crossing the screen edge
+    #  - spacing: mean distance to the front of the vehicle in front, the inverse of the density
+    # Rows of a 'BatchedRing' can be measured over different time windows by passing which rows are 'active'
+    # to 'update'. Every row counts its batches over its own active steps, from the start of its measurement,
+    # so that its batches are those of the same scenario on a ring of its own.
+    def __init__(self, mask, batch_steps=10):
+        # 'mask' tells the vehicles of the ring (all True) or of each row of a 'BatchedRing'
+        self.mask = np.asarray(mask, dtype=bool)
+        self.count = self.mask.sum(axis=-1)
+        self.batch_steps = batch_steps
+
+        # Measured steps and time of the ring or of each row
+        self.steps = np.zeros(self.mask.shape[:-1], dtype=int)
+        self.time = np.zeros(self.mask.shape[:-1])
+        self.speed_mean = np.zeros(self.mask.shape)
+        self.speed_m2 = np.zeros(self.mask.shape)
+        self.crossings = np.zeros(self.mask.shape, dtype=int)
+        self.crossing_speed_sum = np.zeros(self.mask.shape)
+        self.spacing_sum = np.zeros(self.mask.shape)
+
+        # Steps and time of the current batch of the ring or of each row, and which rows closed a batch at the
+        # last update
+        self.batch_step_count = np.zeros(self.mask.shape[:-1], dtype=int)
+        self.batch_time = np.zeros(self.mask.shape[:-1])
+        self.batch_closed = np.zeros(self.mask.shape[:-1], dtype=bool)
+        self.batch_velocity_sum = np.zeros(self.mask.shape)
+        self.batch_crossings = np.zeros(self.mask.shape, dtype=int)
+        self.batch_speeds = []
+        self.batch_flows = []
+
+    def update(self, ring, previous_position, dt, active=None):
+        # 'active' tells the measured rows of a 'BatchedRing', all rows are measured by default
+        velocity = ring.velocity
+        crossed = ring.position < previous_position
+        headway = ring.headway()
+
+        if active is None:
+            self.steps += 1
+            self.time += dt
+            self.batch_step_count += 1
+            self.batch_time += dt
+            delta = velocity - self.speed_mean
+            self.speed_mean += delta / self.steps[..., None]
+        else:
+            active = np.asarray(active, dtype=bool)
+            self.steps += active
+            self.time += dt * active
+            self.batch_step_count += active
+            self.batch_time += dt * active
+            active = active[..., None]
+            velocity = velocity * active
+            crossed = crossed & active
+            headway = headway * active
+            delta = np.where(active, velocity - self.speed_mean, 0)
+            self.speed_mean += delta / np.maximum(self.steps, 1)[..., None]
+
+        self.speed_m2 += delta * (velocity - self.speed_mean)
+        self.crossings += crossed
+        self.crossing_speed_sum += velocity * crossed
+        self.spacing_sum += headway
+
+        self.batch_velocity_sum += velocity
+        self.batch_crossings += crossed
+        self.batch_closed = self.batch_step_count == self.batch_steps
+        if self.batch_closed.any():
+            self.close_batch(self.batch_closed)
+
+    def close_batch(self, closed):
+        # The rows that did not close a batch get NaN, ignored by 'summary'
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.batch_speeds.append(np.where(closed, self.vehicle_sum(self.batch_velocity_sum) /
+                                              (self.batch_step_count * self.count), np.nan))
+            self.batch_flows.append(np.where(closed, self.vehicle_sum(self.batch_crossings) / self.batch_time,
+                                             np.nan))
+        self.batch_step_count[closed] = 0
+        self.batch_time[closed] = 0
+        self.batch_velocity_sum[closed] = 0
+        self.batch_crossings[closed] = 0
+
+    def vehicle_sum(self, values):
+        # Sum of 'values' over the vehicles of the ring, or over the vehicles of every row of a 'BatchedRing'.
+        # Every row is summed on its own, as the pairwise summation of NumPy rounds differently over the
+        # padded rows, and a scenario must get the same statistics however the scenarios are batched.
+        if self.mask.ndim == 1:
+            return np.sum(values)
+        return np.array([np.sum(row[:count]) for row, count in zip(values, self.count)])
+
+    def summary(self, row=None, measurement_time=None):
+        # Statistics of the ring, or of row 'row' of a 'BatchedRing'. The flow is averaged over
+        # 'measurement_time', by default the time summed over the measured steps.
+        if row is None:
+            count = int(self.count)
+            select = slice(None)
+            steps, time = int(self.steps), float(self.time)
+            batch_speeds = [float(speeds) for speeds in self.batch_speeds]
+            batch_flows = [float(flows) for flows in self.batch_flows]
+        else:
+            count = int(self.count[row])
+            select = (row, slice(0, count))
+            steps, time = int(self.steps[row]), float(self.time[row])
+            batch_speeds = [speeds[row] for speeds in self.batch_speeds]
+            batch_flows = [flows[row] for flows in self.batch_flows]
+        batch_speeds = [speed for speed in batch_speeds if not math.isnan(speed)]
+        batch_flows = [flow for flow in batch_flows if not math.isnan(flow)]
+
+        speed_mean = self.speed_mean[select]
+        crossings = int(np.sum(self.crossings[select]))
+        speed = float(np.sum(speed_mean)) / count
+
+        # Chan et al. combination of the per vehicle Welford statistics, all vehicles have 'steps' samples
+        samples = count * steps
+        speed_m2 = float(np.sum(self.speed_m2[select])) + steps * float(np.sum((speed_mean - speed) ** 2))
+
+        return {'flow': crossings / (time if measurement_time is None else measurement_time),
+                'flow_ci': confidence_half_width(batch_flows),
+                'speed': speed,
+                'speed_std': math.sqrt(speed_m2 / (samples - 1)) if samples > 1 else math.nan,
+                'speed_ci': confidence_half_width(batch_speeds),
+                'time_mean_speed': float(np.sum(self.crossing_speed_sum[select])) / crossings if crossings else math.nan,
+                'spacing': float(np.sum(self.spacing_sum[select])) / samples}
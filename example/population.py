@@ -0,0 +1,105 @@
+import json
+import os
+
+import numpy as np
+
+from idm import idm_parameters
+
+
+# Mixed traffic: every vehicle of a ring gets its own IDM parameters, length and car following model,
+# from a population of named vehicle classes mixed in given shares. The parameters are drawn once per
+# scenario into one array per parameter (struct of arrays), which 'Ring' uses in place of the scalar
+# constants of idm.py, so the update stays a handful of NumPy operations whatever the mix.
+#
+# A class maps parameter names (those of 'idm_parameters', 'LENGTH' and 'MODEL') to values. A value is
+# either a number or a distribution [name, *arguments] of a method of numpy.random.Generator, e.g.
+# ["normal", 1.0, 0.2] for a time headway drawn for every vehicle from N(1 s, 0.2 s). Parameters that
+# a class leaves out take the values of idm.py, vehicles of length 0 and the model of the scenario.
+# Lengths are in the units of the positions: the original ring treats vehicles as points.
+
+VEHICLE_CLASSES = {
+    'car': {},
+    'truck': {'T': 1.5, 'A_MAX': 1.0, 'B': 1.0, 'MAX_VELOCITY': 15, 'S_MIN': 1.5, 'LENGTH': 1.0},
+    'aggressive': {'T': ['uniform', 0.5, 0.8], 'A_MAX': 3.0, 'B': 2.5, 'S_MIN': 0.5},
+    'cautious': {'T': ['uniform', 1.5, 2.0], 'A_MAX': 1.2, 'B': 1.0, 'S_MIN': 1.5},
+    # Automated vehicles run the Custom model, with a short and exact time headway
+    'automated': {'MODEL': 'Custom', 'T': 0.8, 'A_MAX': 1.5, 'B': 2.0},
+}
+
+
+def parse_population(text):
+    # A population from the command line: shares such as 'car=0.8,truck=0.2', or a JSON file
+    # {"shares": {"car": 0.8, "slow": 0.2}, "classes": {"slow": {"MAX_VELOCITY": 10}}}
+    if os.path.exists(text):
+        with open(text) as file:
+            description = json.load(file)
+        return Population(description['shares'], description.get('classes'))
+
+    shares = {}
+    for item in text.split(','):
+        name, _, share = item.partition('=')
+        shares[name.strip()] = float(share) if share else 1.0
+    return Population(shares)
+
+
+class Vehicles:
+    # Parameters of every vehicle of a ring: 'params' maps the names of 'idm_parameters' to arrays,
+    # 'length' and 'custom' (vehicles running the Custom model) are arrays too, 'vehicle_class' holds
+    # the index of the class of every vehicle in 'class_names'
+    def __init__(self, params, length, custom, vehicle_class, class_names):
+        self.params = params
+        self.length = length
+        self.custom = custom
+        self.vehicle_class = vehicle_class
+        self.class_names = class_names
+
+    def __len__(self):
+        return len(self.length)
+
+
+class Population:
+    def __init__(self, shares, classes=None):
+        self.classes = dict(VEHICLE_CLASSES, **(classes or {}))
+        unknown = sorted(set(shares) - set(self.classes))
+        if unknown:
+            raise ValueError(f"Unknown vehicle classes {unknown}, expected some of {sorted(self.classes)}")
+        total = sum(shares.values())
+        if total <= 0 or min(shares.values()) < 0:
+            raise ValueError(f"The shares of the vehicle classes must be positive, got {shares}")
+        self.shares = {name: share / total for name, share in shares.items()}
+
+    def describe(self):
+        # Everything the vehicles depend on, e.g. for the key of the result cache
+        return {'shares': self.shares, 'classes': {name: self.classes[name] for name in self.shares}}
+
+    def class_counts(self, num_vehicles):
+        # Number of vehicles of every class, rounded by largest remainders so that they add up
+        names = list(self.shares)
+        exact = np.array([self.shares[name] for name in names]) * num_vehicles
+        counts = np.floor(exact).astype(int)
+        remainder = num_vehicles - counts.sum()
+        counts[np.argsort(counts - exact, kind='stable')[:remainder]] += 1
+        return counts
+
+    def sample(self, num_vehicles, rng, model):
+        # The vehicles of a ring of 'model' (IDM or Custom), in random order along the ring
+        names = list(self.shares)
+        vehicle_class = rng.permutation(np.repeat(np.arange(len(names), dtype=np.int8),
+                                                  self.class_counts(num_vehicles)))
+        defaults = dict(idm_parameters(), LENGTH=0.0)
+        params = {name: np.empty(num_vehicles) for name in defaults}
+        custom = np.empty(num_vehicles, dtype=bool)
+
+        for index, class_name in enumerate(names):
+            members = vehicle_class == index
+            count = int(members.sum())
+            definition = self.classes[class_name]
+            for name, default in defaults.items():
+                value = definition.get(name, default)
+                if isinstance(value, (list, tuple)):
+                    value = getattr(rng, value[0])(*value[1:], size=count)
+                params[name][members] = value
+            custom[members] = definition.get('MODEL', model) == 'Custom'
+
+        length = params.pop('LENGTH')
+        return Vehicles(params, length, custom, vehicle_class, names)
@@ -0,0 +1,86 @@
+import time
+
+import matplotlib.backends.backend_agg as agg
+import pygame
+
+import config as c
+from lanes import LANE_WIDTH
+from ring import LANE_Y
+
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+
+def rasterize(figure):
+    # Draw a matplotlib figure and return its RGBA pixels and size
+    canvas = agg.FigureCanvasAgg(figure)
+    canvas.draw()
+    return bytes(canvas.buffer_rgba()), canvas.get_width_height()
+
+
+class Renderer:
+    # Draws the simulation. All pygame display calls (blits, flip, reading the screen for the GIF) are made
+    # on the simulation thread, as SDL only supports video on the main thread; the captured frames are
+    # encoded and written on a thread of their own (see 'ThreadedFrameWriter' in animation.py). Live frames
+    # are drawn at most 'frame_rate' times per second of wall-clock time, so the simulation does not wait
+    # for the display, unless every frame is needed (e.g. for the GIF). The car image, the fonts and the
+    # rasterized fundamental diagrams are prepared once and the diagrams are only rasterized again when
+    # new points are added to them.
+    def __init__(self, screen, car_image, screen_width, capture=None, frame_rate=60):
+        self.screen = screen
+        self.screen_width = screen_width
+        self.capture = capture
+        self.frame_interval = 1 / frame_rate
+        self.last_frame = None
+
+        self.car_image = pygame.transform.rotate(car_image, 0)
+        self.font = pygame.font.Font('freesansbold.ttf', 16)
+        self.text_quit = self.font.render('[X] : Press any key to quit the simulation.', True, BLACK, WHITE)
+        self.info_string = None
+        self.text = None
+        self.diagrams = []
+
+    def update_diagrams(self, figure_svd, figure_fvd):
+        # Only called when new points are added to the figures
+        self.diagrams = [(pygame.image.fromstring(raw_data, size, "RGBA"), position)
+                         for (raw_data, size), position in ((rasterize(figure_svd), (self.screen_width / 9, 180)),
+                                                            (rasterize(figure_fvd), (self.screen_width / 2, 180)))]
+
+    def submit(self, positions, info_string, wait=False, lanes=None):
+        # 'lanes' gives the lane of every vehicle on a ring of several lanes. Without 'wait', the frame is
+        # skipped when the last one was drawn less than a frame interval ago.
+        now = time.perf_counter()
+        if not wait and self.last_frame is not None and now - self.last_frame < self.frame_interval:
+            return
+        self.last_frame = now
+        self.draw(positions, info_string, lanes)
+
+    def draw(self, positions, info_string, lanes=None):
+        # Draw the simulation interface, lane 0 on top
+        self.screen.fill(WHITE)
+        lanes = [0] * len(positions) if lanes is None else lanes.tolist()
+        for position_x, lane in zip(positions.tolist(), lanes):
+            self.screen.blit(self.car_image, (position_x * c.PPU, (LANE_Y + lane * LANE_WIDTH) * c.PPU))
+
+        # Draw the svd and fvd graphs
+        for surface, position in self.diagrams:
+            self.screen.blit(surface, position)
+
+        # Add text to interface
+        if info_string != self.info_string:
+            self.info_string = info_string
+            self.text = self.font.render(info_string, True, BLACK, WHITE)
+
+        text_rect = self.text.get_rect()
+        text_rect_quit = self.text_quit.get_rect()
+        text_rect.center = (400, 25)
+        text_rect_quit.center = (400, 50)
+        self.screen.blit(self.text, text_rect)
+        self.screen.blit(self.text_quit, text_rect_quit)
+
+        # Update interface
+        pygame.display.flip()
+
+        if self.capture is not None:
+            self.capture(self.screen)
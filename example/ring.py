@@ -0,0 +1,195 @@
+import numpy as np
+
+import config as c
+from kernels import step_ring
+
+
+# Vertical placement (in meters) of the single lane on the screen
+LANE_Y = 2
+
+# Car following models understood by the ring engines
+MODELS = ('IDM', 'Custom', 'Test')
+
+
+def road_edge(screen_width):
+    # Right most position of the visualized road, where vehicles wrap around to the reference position
+    return (screen_width - 48) / c.PPU
+
+
+def initial_positions(num_vehicles, screen_width, uniform, lengths=None):
+    # Same placement as the original Car loop: the first vehicle starts at three quarters of the road
+    # and every following vehicle is placed 1 to 2 meters behind its leader (behind its rear with 'lengths').
+    # 'uniform' is the random number generator used for the spacing (e.g. random.uniform).
+    positions = np.empty(num_vehicles)
+    positions[0] = (screen_width / c.PPU - (48 / c.PPU)) * 0.75
+    for x in range(1, num_vehicles):
+        positions[x] = positions[x - 1] - uniform(1, 2)
+        if lengths is not None:
+            positions[x] -= lengths[x - 1]
+    return positions
+
+
+class Ring:
+    # Struct-of-arrays version of a ring of 'Car' objects.
+    # Vehicle x follows vehicle x-1 and vehicle 0 follows the last vehicle, exactly as in the list of
+    # cars used by 'Environment.run'. All vehicles are updated synchronously from the state of the
+    # previous time step, whereas the 'Car' loop updates them one after the other (vehicle x already
+    # sees the new position of vehicle x-1). See the README for the resulting tolerance.
+    # With 'vehicles' (see population.py), every vehicle has its own parameters (arrays in 'params'),
+    # length, and model: the vehicles in 'custom' run the Custom model, the others the IDM.
+    # With 'kernel' set to 'numba' (see kernels.py), 'step' runs the compiled update instead of the NumPy one.
+    def __init__(self, positions, screen_width, reference_position_x, model, params, vehicles=None):
+        if model not in MODELS:
+            raise ValueError(f"Unknown car following model {model!r}, expected one of {MODELS}")
+
+        self.model = model
+        self.kernel = None
+        self.params = params if vehicles is None else vehicles.params
+        self.length = None if vehicles is None else vehicles.length
+        self.custom = None if vehicles is None else vehicles.custom
+        self.edge = road_edge(screen_width)
+        self.reference_position_x = reference_position_x
+        self.road_length = self.edge - reference_position_x
+
+        self.position = np.array(positions, dtype=float)
+        self.velocity = np.full_like(self.position, 25.0)
+        self.acceleration = np.full_like(self.position, 2.0)
+
+    def __len__(self):
+        return len(self.position)
+
+    def lead(self, values):
+        # Values of the vehicle in front of every vehicle
+        return np.roll(values, 1)
+
+    def follow(self, values):
+        # Values of the vehicle behind every vehicle
+        return np.roll(values, -1)
+
+    def headway(self, position=None):
+        # Distance to the front of the vehicle in front, measured along the ring
+        position = self.position if position is None else position
+        lead = self.lead(position)
+        return lead - position + self.road_length * (position >= lead)
+
+    def lead_gap(self, position=None):
+        # Net distance to the rear of the vehicle in front, vehicles are points unless they have lengths
+        if self.length is None:
+            return self.headway(position)
+        return self.headway(position) - self.lead(self.length)
+
+    def follow_gap(self):
+        # Net distance from the front of the vehicle behind, measured along the ring
+        follow = self.follow(self.position)
+        follow_gap = self.position - follow + self.road_length * (self.position <= follow)
+        return follow_gap if self.length is None else follow_gap - self.length
+
+    def velocity_difference(self, velocity):
+        # Approaching term of the Custom model. As in 'Car.IDM_model', the IDM uses the velocity difference
+        # of the vehicle to itself. In a mixed population, only the vehicles in 'custom' run the Custom model.
+        if self.custom is not None:
+            return np.where(self.custom, velocity - self.lead(velocity), 0.0)
+        return 0.0 if self.model == 'IDM' else velocity - self.lead(velocity)
+
+    def desired_acceleration(self, lead_gap, velocity, velocity_difference, params=None):
+        # 'params' defaults to those of the ring, e.g. the parameters of some of the vehicles of a mixed population
+        p = self.params if params is None else params
+        desired_gap = p['S_MIN'] + np.maximum(0, velocity * p['T'] + (velocity * velocity_difference) /
+                                              (2 * np.sqrt(p['A_MAX'] * p['B'])))
+        return p['A_MAX'] * (1 - ((velocity / p['MAX_VELOCITY']) ** p['DELTA']) - ((desired_gap / lead_gap) ** 2))
+
+    def model_acceleration(self, position, velocity):
+        # Acceleration of the IDM or Custom model in any state of the ring, e.g. at the stages of an integrator
+        return self.desired_acceleration(self.lead_gap(position), velocity, self.velocity_difference(velocity))
+
+    def step(self, dt):
+        if self.kernel is not None:
+            step_ring(self, dt)
+        elif self.custom is not None:
+            # Mixed population: the IDM vehicles take the plain step, 'custom_model' leaves them out of the safe step
+            self.custom_model(dt)
+        elif self.model == 'IDM':
+            self.IDM_model(dt)
+        elif self.model == 'Custom':
+            self.custom_model(dt)
+        else:
+            self.test_model(dt)
+
+    def IDM_model(self, dt):
+        self.acceleration = self.model_acceleration(self.position, self.velocity)
+        self.next_step(dt)
+
+    def next_step(self, dt):
+        # Euler update of velocity and position, vehicles never move backwards
+        self.velocity = np.maximum(self.velocity + self.acceleration * dt, 0)
+        self.update_car_position(self.velocity * dt)
+
+    def custom_model(self, dt):
+        lead_gap = self.lead_gap()
+        follow_gap = self.follow_gap()
+        self.acceleration = self.desired_acceleration(lead_gap, self.velocity, self.velocity_difference(self.velocity))
+
+        # Vehicles that are tailgated take the safe step of 'Car.safe_next_step'
+        safe = follow_gap < 1.5 * self.params['S_MIN']
+        if self.custom is not None:
+            safe &= self.custom
+        velocity_change = self.acceleration * dt
+        hard_brake = safe & (velocity_change < -10)
+        velocity = np.where(hard_brake, lead_gap / 2 * dt, np.maximum(self.velocity + velocity_change, 0))
+        position_change = np.where(hard_brake & (velocity < -10), lead_gap / 2, velocity * dt)
+
+        self.velocity = velocity
+        self.update_car_position(position_change)
+
+    def test_model(self, dt):
+        self.acceleration = np.zeros_like(self.position)
+        self.velocity = self.velocity + 0.1
+        self.update_car_position(np.full_like(self.position, 0.1))
+
+    def update_car_position(self, position_change):
+        # Vehicles beyond the right edge of the screen re-enter the road at the reference position
+        self.position = np.where(self.position > self.edge,
+                                 self.reference_position_x + position_change,
+                                 self.position + position_change)
+
+
+class BatchedRing(Ring):
+    # Many independent rings stepped in lockstep. Row s of every state array holds the vehicles of ring s,
+    # padded up to the largest ring; 'mask' tells the real vehicles from the padding.
+    # 'screen_width', 'reference_positions_x' and every entry of 'params' are either shared by all rings
+    # or given per ring, so rings of different sizes, seeds and IDM parameters advance in one NumPy call.
+    def __init__(self, positions, screen_width, reference_positions_x, model, params):
+        if model not in MODELS:
+            raise ValueError(f"Unknown car following model {model!r}, expected one of {MODELS}")
+
+        self.model = model
+        self.kernel = None
+        self.params = {name: np.asarray(value, dtype=float).reshape(-1, 1) for name, value in params.items()}
+        self.length = self.custom = None
+        self.edge = road_edge(np.asarray(screen_width, dtype=float)).reshape(-1, 1)
+        self.reference_position_x = np.asarray(reference_positions_x, dtype=float).reshape(-1, 1)
+        self.road_length = self.edge - self.reference_position_x
+
+        self.count = np.array([len(ring_positions) for ring_positions in positions])
+        index = np.arange(self.count.max())
+        self.mask = index < self.count[:, None]
+
+        # Padded vehicles are their own leader and follower, so they never interact with the real ones
+        count = np.maximum(self.count[:, None], 1)
+        self.lead_index = np.where(self.mask, (index - 1) % count, index)
+        self.follow_index = np.where(self.mask, (index + 1) % count, index)
+
+        self.position = np.zeros(self.mask.shape)
+        for row, ring_positions in enumerate(positions):
+            self.position[row, :len(ring_positions)] = ring_positions
+        self.velocity = np.where(self.mask, 25.0, 0.0)
+        self.acceleration = np.where(self.mask, 2.0, 0.0)
+
+    def __len__(self):
+        return int(self.count.sum())
+
+    def lead(self, values):
+        return np.take_along_axis(values, self.lead_index, axis=1)
+
+    def follow(self, values):
+        return np.take_along_axis(values, self.follow_index, axis=1)
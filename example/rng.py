@@ -0,0 +1,30 @@
+import numpy as np
+
+
+# Random number streams of the simulation, all derived from one root seed with 'np.random.SeedSequence'.
+# Child 0 of the root orders the vehicle counts of the density sweep, and child 'simulation' (counted from 1)
+# gives the seed of that scenario, which spawns one stream for the initial positions and one for the vehicle
+# population. A scenario draws the same numbers whichever process runs it and whatever ran before it, so
+# sequential, parallel, batched and sharded runs of the same scenarios agree.
+
+SEED = 175175175
+
+# Children of the root seed, and of the seed of a scenario
+SWEEP_STREAM = 0
+POSITIONS_STREAM, POPULATION_STREAM = 0, 1
+
+
+def scenario_seed(simulation, seed=SEED):
+    # The 64-bit seed of scenario 'simulation', recorded in the manifest of the run (see manifest.py)
+    return int(np.random.SeedSequence(seed, spawn_key=(simulation, )).generate_state(1, np.uint64)[0])
+
+
+def scenario_generators(scenario_seed):
+    # Generators of the initial positions and of the vehicle population of the scenario of 'scenario_seed'
+    children = np.random.SeedSequence(scenario_seed).spawn(2)
+    return np.random.default_rng(children[POSITIONS_STREAM]), np.random.default_rng(children[POPULATION_STREAM])
+
+
+def sweep_order(vehicle_counts, seed=SEED):
+    # The vehicle counts of the density sweep in the order of its simulations
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(SWEEP_STREAM, ))).permutation(vehicle_counts)
@@ -0,0 +1,384 @@
+import concurrent.futures
+import copy
+import functools
+
+import numpy as np
+
+import config as c
+from cache import scenario_key
+from detectors import SpaceTimeMeasurements
+from integrators import make_integrator
+from kernels import select_kernel
+from lanes import LaneMetrics, MultiLaneRing, initial_lanes
+from measurement import FixedWindow, SteadyStateWindow
+from metrics import StreamingMetrics
+from ring import BatchedRing, Ring, initial_positions
+from rng import SEED, scenario_generators, scenario_seed
+
+
+TOTAL_SIMULATIONS = 15
+PIXEL_METERS_RATIO = 0.04
+SIMULATION_TIME = 30
+DT = 0.1
+TIME_THRESHOLD = 15
+# Largest local error estimate of an integrator (m or m/s) before its integration is taken to be unstable, e.g. rk4
+# at the default DT, where it grows without bound. The Euler update of the stiff initial state stays below 10.
+ERROR_ESTIMATE_LIMIT = 1e3
+
+# Columns of the fundamental diagram statistics, see data/fundamental_diagram_statistics_data_dictionary.csv
+STATISTICS_FIELDS = ['density', 'headway_density', 'flow', 'flow_ci', 'speed', 'speed_std', 'speed_ci',
+                     'time_mean_speed', 'integrator_steps', 'error_estimate', 'simulation_time', 'measurement_start']
+# Columns of the estimates of the loop detectors and of the Edie grid, added to the statistics when measured
+DETECTOR_FIELDS = ['detector_flow', 'detector_speed', 'detector_density']
+EDIE_FIELDS = ['edie_flow', 'edie_density', 'edie_speed']
+# Columns of the fundamental diagrams of every lane, see data/lane_fundamental_diagram_data_dictionary.csv
+LANE_FIELDS = ['simulation', 'lane', 'density', 'flow', 'speed', 'lane_changes']
+# Columns of the statistics of every vehicle class, see data/class_statistics_data_dictionary.csv
+CLASS_FIELDS = ['simulation', 'vehicle_class', 'vehicles', 'flow', 'speed']
+
+
+def scenario_seeds(total_simulations, seed=SEED, simulations=None):
+    # Every scenario of a sweep gets its own seed, derived from the root 'seed' and its simulation number only
+    # (see rng.py), so the results do not depend on the order in which the scenarios are run.
+    # 'simulations' are the numbers of the scenarios, 1 to 'total_simulations' by default.
+    simulations = range(1, total_simulations + 1) if simulations is None else simulations
+    return [scenario_seed(simulation, seed) for simulation in simulations]
+
+
+def simulation_steps(simulation_time=SIMULATION_TIME, dt=DT):
+    # Number of time steps of a simulation, counted the same way as the simulation loops advance time
+    time_elapsed = 0
+    steps = 0
+    while simulation_time > time_elapsed:
+        time_elapsed += dt
+        steps += 1
+    return steps
+
+
+def road_length_of(screen_width, reference_position_x):
+    return max((screen_width / c.PPU - (48 / c.PPU)) * 0.25,
+               (abs(screen_width / c.PPU - (48 / c.PPU)) - reference_position_x))
+
+
+def check_integrator(integrator, model, backend, vehicles=None):
+    # Only the Euler update is built into the Car objects and the Test model, and the safe step of the Custom model
+    # (see 'Ring.custom_model') is a rule of the Euler update that the other integrators do not take
+    if integrator != 'euler' and (backend == 'car' or model == 'Test'):
+        raise ValueError(f"The {integrator} integrator needs the numpy or batched backend and the IDM model")
+    if integrator != 'euler' and (model == 'Custom' or (vehicles is not None and vehicles.custom.any())):
+        raise ValueError(f"The safe step of the Custom model is part of the Euler update, the {integrator} integrator "
+                         f"runs the IDM model only")
+
+
+def check_error_estimate(integrator, error_estimate):
+    # Stop a scenario whose integration was unstable rather than report its statistics
+    if not error_estimate <= ERROR_ESTIMATE_LIMIT:
+        raise ValueError(f"The error estimate of the {integrator.name} integrator reached {error_estimate:.3g}, "
+                         f"above {ERROR_ESTIMATE_LIMIT:g}: its integration is unstable, use a smaller --dt")
+
+
+def check_population(population, model, backend):
+    # Vehicles with parameters of their own are only implemented on the vectorized ring engine
+    if population is not None and (backend != 'numpy' or model == 'Test'):
+        raise ValueError("A mixed population needs the numpy backend and the IDM or Custom model")
+
+
+def scenario_positions(num_vehicles, seed, screen_width, model, population=None):
+    # Initial positions of a scenario and its vehicles drawn from 'population' (None when all vehicles are alike),
+    # each from its own stream of the scenario 'seed'
+    positions_generator, population_generator = scenario_generators(seed)
+    vehicles = None
+    if population is not None:
+        vehicles = population.sample(num_vehicles, population_generator, model)
+    positions = initial_positions(num_vehicles, screen_width, positions_generator.uniform,
+                                  None if vehicles is None else vehicles.length)
+    return positions, vehicles
+
+
+def make_ring(positions, screen_width, reference_position_x, model, params, backend, integrator='euler', lanes=1,
+              vehicles=None, kernel='auto'):
+    # 'kernel' selects the update of the single-lane rings of the numpy backend, see kernels.py
+    check_integrator(integrator, model, backend, vehicles)
+    check_population(vehicles, model, backend)
+    if kernel == 'numba' and (backend != 'numpy' or lanes > 1):
+        raise ValueError("The numba kernel runs the single-lane rings of the numpy backend")
+    if lanes > 1:
+        # Lane changes are only implemented on the vectorized ring engine
+        if backend != 'numpy':
+            raise ValueError(f"A ring of {lanes} lanes needs the numpy backend")
+        return MultiLaneRing(positions, initial_lanes(len(positions), lanes), screen_width, reference_position_x,
+                             model, params, vehicles)
+    if backend == 'car':
+        # The Car objects need pygame, so only load them when asked for
+        from car import CarRing
+        return CarRing(positions, screen_width, reference_position_x, model)
+    ring = Ring(positions, screen_width, reference_position_x, model, params, vehicles)
+    ring.kernel = select_kernel(kernel, model, len(positions), vehicles)
+    return ring
+
+
+def scenario_kernel(kernel, model, num_vehicles, backend, lanes=1, population=None):
+    # The kernel that 'make_ring' selects for a scenario, e.g. for the key of the result cache
+    if backend != 'numpy' or lanes > 1:
+        return None
+    return select_kernel(kernel, model, num_vehicles, population)
+
+
+def make_metrics(num_vehicles, dt, lanes=1):
+    # Statistics of a single ring, with those of every lane on a ring of several lanes
+    if lanes > 1:
+        return LaneMetrics(np.ones(num_vehicles, dtype=bool), lanes, batch_steps(dt))
+    return StreamingMetrics(np.ones(num_vehicles, dtype=bool), batch_steps(dt))
+
+
+def make_window(shape, road_length, dt, steady_state=None):
+    # The fixed measurement window from TIME_THRESHOLD to SIMULATION_TIME, or, when 'steady_state' is a dict
+    # of options of 'SteadyStateWindow' (possibly empty), a window adapted to every scenario
+    if steady_state is None:
+        return FixedWindow(shape, SIMULATION_TIME, TIME_THRESHOLD)
+    return SteadyStateWindow(shape, road_length, dt, **steady_state)
+
+
+def statistics_fields(space_time=None):
+    # Columns of the statistics table with the options 'space_time' of 'SpaceTimeMeasurements'
+    fields = list(STATISTICS_FIELDS)
+    if space_time is not None and space_time.get('detectors'):
+        fields += DETECTOR_FIELDS
+    if space_time is not None and space_time.get('cell_length'):
+        fields += EDIE_FIELDS
+    return fields
+
+
+def make_measurements(space_time, reference_position_x, road_length, dt, backend):
+    # The loop detectors and the Edie grid of a single ring, None without 'space_time' options
+    if space_time is None:
+        return None
+    if backend == 'batched':
+        raise ValueError("The loop detectors and the Edie grid need the car or numpy backend")
+    return SpaceTimeMeasurements(space_time, reference_position_x, road_length, dt)
+
+
+def fundamental_diagram_row(num_vehicles, road_length, metrics, integrator, window, row=None, vehicles=None,
+                            measurements=None, integrator_statistics=None):
+    # Density, flow, mean speed and their statistics of a scenario, from the metrics measured in its window.
+    # 'integrator_statistics' are the steps and error estimate of the scenario when its window ended, by default
+    # those of the integrator now.
+    measurement_time = window.measurement_time(row)
+    statistics = metrics.summary(row, measurement_time)
+    spacing = statistics.pop('spacing')
+    lanes = statistics.pop('lanes', None)
+    integrator_steps, error_estimate = integrator.statistics(row) if integrator_statistics is None \
+        else integrator_statistics
+    check_error_estimate(integrator, error_estimate)
+    result = dict(statistics, density=num_vehicles / (road_length * PIXEL_METERS_RATIO),
+                  headway_density=1 / (spacing * PIXEL_METERS_RATIO),
+                  integrator_steps=integrator_steps, error_estimate=error_estimate,
+                  **window.columns(row))
+    if lanes is not None:
+        # Density, flow, speed and lane changes of every lane
+        result['lanes'] = [{'lane': lane['lane'],
+                            'density': float(lane['vehicles'] / (road_length * PIXEL_METERS_RATIO)),
+                            'flow': lane['flow'], 'speed': lane['speed'], 'lane_changes': lane['lane_changes']}
+                           for lane in lanes]
+    if measurements is not None:
+        # Estimates of the detectors and the grid over the measurement window, and their space-time diagrams
+        result.update(measurements.columns(result['measurement_start'], result['simulation_time']))
+        result['space_time'] = {name: values.tolist() for name, values in measurements.arrays().items()}
+    if vehicles is not None:
+        # Flow and mean speed of every vehicle class, from the statistics of its vehicles
+        measurement_time = float(metrics.time) if measurement_time is None else measurement_time
+        result['classes'] = []
+        for index, name in enumerate(vehicles.class_names):
+            members = vehicles.vehicle_class == index
+            result['classes'].append({'vehicle_class': name, 'vehicles': int(members.sum()),
+                                      'flow': float(metrics.crossings[members].sum()) / measurement_time,
+                                      'speed': float(metrics.speed_mean[members].mean()) if members.any() else np.nan})
+    return result
+
+
+def batch_steps(dt):
+    # Number of time steps in a batch of the confidence intervals, batches last about one second
+    return max(1, round(1 / dt))
+
+
+def run_scenario(num_vehicles, seed, params, model, backend='numpy', screen_width=1000, integrator='euler', dt=DT,
+                 steady_state=None, lanes=1, population=None, space_time=None, kernel='auto'):
+    # Run a single headless scenario and return its row of the fundamental diagrams, with the estimates and
+    # space-time diagrams of the loop detectors and the Edie grid of the options 'space_time'
+    positions, vehicles = scenario_positions(num_vehicles, seed, screen_width, model, population)
+    reference_position_x = positions[-1] - 1
+    ring = make_ring(positions, screen_width, reference_position_x, model, params, backend, integrator, lanes,
+                     vehicles, kernel)
+    integrator = make_integrator(integrator)
+    road_length = road_length_of(screen_width, reference_position_x)
+
+    time_elapsed = 0
+    metrics = make_metrics(num_vehicles, dt, lanes)
+    window = make_window((), road_length, dt, steady_state)
+    measurements = make_measurements(space_time, reference_position_x, road_length, dt, backend)
+    advance_scenario(ring, integrator, metrics, window, measurements, dt, time_elapsed)
+
+    return fundamental_diagram_row(num_vehicles, road_length, metrics, integrator, window, vehicles=vehicles,
+                                   measurements=measurements)
+
+
+def advance_scenario(ring, integrator, metrics, window, measurements, dt, time_elapsed, before_step=None,
+                     after_step=None):
+    # Step a single ring from 'time_elapsed' until its measurement window ends, and return the time reached.
+    # The sequential loop of 'Environment.run' passes 'before_step(time_elapsed)', called before every time step
+    # (for the snapshots and checkpoints), and 'after_step(time_elapsed)', called with the time at the end of the
+    # step (for the trajectory and the display), which stops the scenario when it returns True.
+    while window.running(time_elapsed):
+        if before_step is not None:
+            before_step(time_elapsed)
+        time_elapsed += dt
+        previous_position = ring.position.copy()
+        integrator.advance(ring, dt)
+        window.measure(ring, metrics, previous_position, time_elapsed, dt)
+        if measurements is not None:
+            measurements.update(ring, previous_position, time_elapsed)
+        if after_step is not None and after_step(time_elapsed):
+            break
+    return time_elapsed
+
+
+def check_fork(snapshot, model=None, params=None):
+    if (model not in (None, snapshot.ring.model) or params is not None) and \
+            (snapshot.backend == 'car' or snapshot.vehicles is not None):
+        raise ValueError("The model and parameters of a snapshot of the car backend or of a mixed population "
+                         "cannot be changed")
+
+
+def fork_scenario(snapshot, model=None, params=None, integrator='euler', dt=None,
+                  measurement_time=SIMULATION_TIME - TIME_THRESHOLD, space_time=None):
+    # Run a variant of the scenario of a 'Snapshot' (see checkpoint.py) from its warmed-up ring, skipping the
+    # warm-up: the variant is measured from the time of the snapshot for 'measurement_time' seconds, by default
+    # the measurement window of the original scenario. 'model' and the IDM 'params' replace those of the scenario,
+    # except on the car backend and for mixed populations, whose vehicles carry their own. Without changes, a
+    # snapshot taken at TIME_THRESHOLD gives back the statistics of the original scenario, only the integrator
+    # columns count the steps of the fork alone.
+    check_fork(snapshot, model, params)
+    ring = copy.deepcopy(snapshot.ring)
+    dt = dt or snapshot.dt
+    ring.model = model or ring.model
+    if params is not None:
+        ring.params = params
+    check_integrator(integrator, ring.model, snapshot.backend, snapshot.vehicles)
+    integrator = make_integrator(integrator)
+
+    metrics = make_metrics(snapshot.num_vehicles, dt, snapshot.lanes)
+    window = FixedWindow((), snapshot.snapshot_time + measurement_time, snapshot.snapshot_time)
+    measurements = make_measurements(space_time, ring.reference_position_x, snapshot.road_length, dt,
+                                     snapshot.backend)
+    advance_scenario(ring, integrator, metrics, window, measurements, dt, snapshot.time_elapsed)
+
+    return fundamental_diagram_row(snapshot.num_vehicles, snapshot.road_length, metrics, integrator, window,
+                                   vehicles=snapshot.vehicles, measurements=measurements)
+
+
+def run_batched_scenarios(vehicle_counts, seeds, params, model, screen_width=1000, integrator='euler', dt=DT,
+                          steady_state=None):
+    # Run all scenarios in lockstep on a single 'BatchedRing'. Every entry of 'params' is either
+    # shared by all scenarios or a sequence with one value per scenario. With 'steady_state', the
+    # batch runs until the last of its scenarios is done.
+    positions = [scenario_positions(num_vehicles, seed, screen_width, model)[0]
+                 for num_vehicles, seed in zip(vehicle_counts, seeds)]
+    reference_positions_x = [ring_positions[-1] - 1 for ring_positions in positions]
+    ring = BatchedRing(positions, screen_width, reference_positions_x, model, params)
+    check_integrator(integrator, model, 'batched')
+    integrator = make_integrator(integrator)
+
+    road_lengths = [road_length_of(screen_width, reference_position_x) for reference_position_x in reference_positions_x]
+
+    time_elapsed = 0
+    metrics = StreamingMetrics(ring.mask, batch_steps(dt))
+    window = make_window(len(vehicle_counts), road_lengths, dt, steady_state)
+
+    # The steps and error estimate of every scenario when its window ends, as the batch steps on until the last
+    # of its scenarios is done
+    integrator_statistics = {}
+    while window.running(time_elapsed):
+        time_elapsed += dt
+        previous_position = ring.position.copy()
+        integrator.advance(ring, dt)
+        window.measure(ring, metrics, previous_position, time_elapsed, dt)
+        for row in np.flatnonzero(window.finished).tolist():
+            integrator_statistics.setdefault(row, integrator.statistics(row))
+
+    return [fundamental_diagram_row(num_vehicles, road_length, metrics, integrator, window, row,
+                                    integrator_statistics=integrator_statistics.get(row))
+            for row, (num_vehicles, road_length) in enumerate(zip(vehicle_counts, road_lengths))]
+
+
+def scenario_parameters(params, index):
+    # The parameters of scenario 'index' of a sweep, from values shared by all scenarios or given per scenario
+    return {name: np.asarray(value)[index] if np.ndim(value) else value for name, value in params.items()}
+
+
+def run_sweep(vehicle_counts, seeds, model, params, backend='numpy', screen_width=1000, workers=None,
+              integrator='euler', dt=DT, steady_state=None, cache=None, lanes=1, population=None, space_time=None,
+              kernel='auto'):
+    # Run all (vehicle count, seed) scenarios, in a pool of 'workers' processes if more than one.
+    # The rows are returned in the order of 'vehicle_counts', whichever scenario finishes first.
+    # The 'batched' backend steps the scenarios of every worker together on one 'BatchedRing'. The entries of
+    # 'params' are shared by all scenarios or sequences of one value per scenario. Scenarios found in the
+    # 'ResultCache' 'cache' are not run again, the others are added to it. Rings of several 'lanes' and mixed
+    # vehicle populations ('Population' of population.py, None when all vehicles are alike) need the numpy backend.
+    # The loop detectors and the Edie grid of 'space_time' (see detectors.py) need the car or numpy backend.
+    # 'kernel' selects the update of the single-lane rings of the numpy backend (see kernels.py).
+    vehicle_counts = [int(num_vehicles) for num_vehicles in vehicle_counts]
+    if lanes > 1 and backend != 'numpy':
+        raise ValueError(f"A ring of {lanes} lanes needs the numpy backend")
+    check_population(population, model, backend)
+    if space_time is not None and backend == 'batched':
+        raise ValueError("The loop detectors and the Edie grid need the car or numpy backend")
+    if cache is None:
+        return compute_sweep(vehicle_counts, seeds, model, params, backend, screen_width, workers, integrator, dt,
+                             steady_state, lanes, population, space_time, kernel)
+
+    keys = []
+    for index, (num_vehicles, seed) in enumerate(zip(vehicle_counts, seeds)):
+        positions, _ = scenario_positions(num_vehicles, seed, screen_width, model, population)
+        keys.append(scenario_key(model, scenario_parameters(params, index), positions, screen_width, dt, integrator,
+                                 backend, steady_state, road_length_of(screen_width, positions[-1] - 1), lanes,
+                                 population, space_time, scenario_kernel(kernel, model, num_vehicles, backend, lanes,
+                                                                         population)))
+    rows = [cache.get(key) for key in keys]
+
+    missing = [index for index, row in enumerate(rows) if row is None]
+    if missing:
+        computed = compute_sweep([vehicle_counts[index] for index in missing], [seeds[index] for index in missing],
+                                 model, scenario_parameters(params, missing), backend, screen_width, workers,
+                                 integrator, dt, steady_state, lanes, population, space_time, kernel)
+        for index, row in zip(missing, computed):
+            rows[index] = row
+            cache.put(keys[index], row)
+        cache.evict()
+    return rows
+
+
+def compute_sweep(vehicle_counts, seeds, model, params, backend, screen_width, workers, integrator, dt,
+                  steady_state, lanes=1, population=None, space_time=None, kernel='auto'):
+    if backend == 'batched':
+        batches = np.array_split(np.arange(len(vehicle_counts)), max(1, min(workers or 1, len(vehicle_counts))))
+        batch_counts = [[vehicle_counts[index] for index in batch] for batch in batches]
+        batch_seeds = [[seeds[index] for index in batch] for batch in batches]
+        batch_params = [scenario_parameters(params, batch) for batch in batches]
+        scenario = functools.partial(run_batched_scenarios, model=model, screen_width=screen_width,
+                                     integrator=integrator, dt=dt, steady_state=steady_state)
+    else:
+        batch_counts, batch_seeds = vehicle_counts, seeds
+        batch_params = [scenario_parameters(params, index) for index in range(len(vehicle_counts))]
+        scenario = functools.partial(run_scenario, model=model, backend=backend, screen_width=screen_width,
+                                     integrator=integrator, dt=dt, steady_state=steady_state, lanes=lanes,
+                                     population=population, space_time=space_time, kernel=kernel)
+
+    if workers is None or workers <= 1:
+        results = list(map(scenario, batch_counts, batch_seeds, batch_params))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(scenario, batch_counts, batch_seeds, batch_params))
+
+    if backend == 'batched':
+        return [row for rows in results for row in rows]
+    return results
@@ -1,5 +1,7 @@
 import logging
 from pprint import pprint
+from checkpoint import CHECKPOINT_FILE, SNAPSHOT_DIRECTORY
+from rng import SEED
 from environment import Environment
 import argparse
 
@@ -14,12 +16,127 @@ if __name__ == '__main__':
     parser.add_argument('--run-custom', action='store_true')
     parser.add_argument('--no-render', action='store_true', default=False)
     parser.add_argument('--plot-gif', action='store_true', default=False)
+    parser.add_argument('--no-plot', action='store_true', default=False,
+                        help='do not save the figures of the fundamental diagrams, so the headless numpy and '
+                             'batched backends never load matplotlib, pandas or pygame')
+    parser.add_argument('--backend', choices=['car', 'numpy', 'batched'], default='car',
+                        help="'car' steps the original Car objects, 'numpy' the vectorized ring engine, "
+                             "'batched' all scenarios of the headless sweep at once")
+    parser.add_argument('--workers', type=int, default=None,
+                        help='run the headless sweep with one seed per scenario in a pool of worker processes')
+    parser.add_argument('--integrator', choices=['euler', 'ballistic', 'rk4', 'adaptive'], default='euler',
+                        help='numerical integration scheme of the numpy and batched backends')
+    parser.add_argument('--kernel', choices=['auto', 'numpy', 'numba'], default='auto',
+                        help='update of the single-lane rings of the numpy backend: compiled with Numba, NumPy, or '
+                             'Numba for rings of 1000 vehicles or more when it is installed (auto)')
+    parser.add_argument('--dt', type=float, default=None, help='time step of the simulation in seconds (0.1 by default)')
+    parser.add_argument('--lanes', type=int, default=1,
+                        help='number of lanes of the ring, vehicles change lanes by MOBIL (needs --backend numpy)')
+    parser.add_argument('--population', default=None,
+                        help="mix of vehicle classes, e.g. 'car=0.7,truck=0.1,automated=0.2', or a JSON file of shares "
+                             "and classes (see example/population.py); needs --backend numpy")
+    parser.add_argument('--detectors', type=int, default=0,
+                        help='number of virtual loop detectors spread evenly along the ring, their estimates are added '
+                             'to the statistics and their space-time diagrams written to data/space_time_diagrams.npz')
+    parser.add_argument('--edie-cell', type=float, default=None,
+                        help='length of the cells of an Edie space-time grid measuring the flow, density and speed '
+                             'along the ring, written alongside the detectors')
+    parser.add_argument('--space-time-interval', type=float, default=1.0,
+                        help='time interval of the detectors and the Edie grid in seconds')
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help='root seed of the random number streams of the scenarios (see example/rng.py)')
+    parser.add_argument('--shard', default=None, metavar='K/N',
+                        help='run only shard K of N of the density sweep, the simulations K, K+N, K+2N, ...; '
+                             'the data directories of the shards are merged with --merge-shards')
+    parser.add_argument('--merge-shards', nargs='+', default=None, metavar='DIRECTORY',
+                        help='merge the data files and manifests of the shards in DIRECTORY ... into data/')
+    parser.add_argument('--verify', default=None, metavar='MANIFEST',
+                        help='compare the data files of this run (or of --merge-shards) with the checksums of '
+                             'MANIFEST, e.g. the data/manifest.json of a serial run, and exit with an error if any '
+                             'differ')
+    parser.add_argument('--checkpoint-interval', type=float, default=None,
+                        help='save a checkpoint of the simulation to --checkpoint-file every N seconds of wall time')
+    parser.add_argument('--checkpoint-file', default=CHECKPOINT_FILE,
+                        help='checkpoint file of --checkpoint-interval and --resume (data/checkpoint.pkl by default)')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='carry on from --checkpoint-file with the options of the interrupted run')
+    parser.add_argument('--snapshot-time', type=float, default=None,
+                        help='save the state of every scenario after N simulated seconds to --snapshot-directory')
+    parser.add_argument('--snapshot-directory', default=SNAPSHOT_DIRECTORY,
+                        help='directory of the snapshots of --snapshot-time (data/snapshots by default)')
+    parser.add_argument('--fork', default=None, metavar='DIRECTORY',
+                        help='run variants of the scenarios of the snapshots in DIRECTORY with the model, '
+                             '--integrator, --dt and detectors of this run, measured from the time of the snapshots')
+    parser.add_argument('--large-ring', action='store_true', default=False,
+                        help='run one headless ring of --vehicles on --road-length meters, independent of the screen, '
+                             'and write space-time diagrams of bins along the road')
+    parser.add_argument('--vehicles', type=int, default=100000, help='number of vehicles of --large-ring')
+    parser.add_argument('--road-length', type=float, default=None,
+                        help='road length of --large-ring in meters (25 m per vehicle by default)')
+    parser.add_argument('--simulation-time', type=float, default=300.0,
+                        help='simulated time of --large-ring in seconds')
+    parser.add_argument('--precision', choices=['float32', 'float64'], default='float64',
+                        help='floating point precision of the state of --large-ring')
+    parser.add_argument('--chunk-size', type=int, default=2 ** 16,
+                        help='number of vehicles of --large-ring processed together')
+    parser.add_argument('--bin-length', type=float, default=100.0,
+                        help='length of the bins along the road of --large-ring in meters')
+    parser.add_argument('--sample-interval', type=float, default=1.0,
+                        help='time interval of the space-time diagrams of --large-ring in seconds')
+    parser.add_argument('--calibrate', nargs='+', default=None, metavar='TARGETS',
+                        help='fit the IDM parameters to the density, flow and speed columns of the CSV files TARGETS, '
+                             'e.g. data/flow_density_data.csv data/speed_density_data.csv (needs --backend numpy or '
+                             'batched)')
+    parser.add_argument('--calibrate-parameters', default=None,
+                        help="comma separated parameters of --calibrate, e.g. 'T,A_MAX' (all of idm.py by default)")
+    parser.add_argument('--bounds', default=None,
+                        help="search space of --calibrate, e.g. 'T=0.8:2,DELTA=2:6' (see example/calibration.py "
+                             "for the defaults)")
+    parser.add_argument('--optimizer', choices=['cma-es', 'nelder-mead'], default='cma-es',
+                        help='derivative-free optimizer of --calibrate, evaluating its candidates in batches')
+    parser.add_argument('--max-evaluations', type=int, default=300,
+                        help='largest number of candidate parameter sets evaluated by --calibrate')
+    parser.add_argument('--replications', type=int, default=1,
+                        help='scenarios with different seeds averaged for every target point of --calibrate')
+    parser.add_argument('--steady-state', action='store_true', default=False,
+                        help='measure every scenario from the time it settles until its speed and flow are precise '
+                             'to --target-ci and --target-flow-ci, instead of from 15 s to 30 s')
+    parser.add_argument('--target-ci', type=float, default=0.05,
+                        help='relative half width of the 95%% confidence interval of the speed that ends a '
+                             'steady-state scenario')
+    parser.add_argument('--target-flow-ci', type=float, default=0.5,
+                        help='relative half width of the 95%% confidence interval of the flow that ends a '
+                             'steady-state scenario')
+    parser.add_argument('--max-time', type=float, default=60.0,
+                        help='longest simulation time of a steady-state scenario in seconds')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='run every scenario again instead of reusing the results cached in data/cache')
+    parser.add_argument('--cache-size', type=float, default=512,
+                        help='size of the result cache in MB, the least recently used results are removed beyond it')
+    parser.add_argument('--no-trajectory', action='store_true', default=False,
+                        help='do not record the trajectory of the IDM model, e.g. when the detectors or the grid '
+                             'measure what is needed')
+    parser.add_argument('--trajectory-decimation', type=int, default=1,
+                        help='record the trajectory of the IDM model every N time steps')
+    parser.add_argument('--trajectory-chunk', type=int, default=100,
+                        help='number of recorded time steps buffered before appending them to the trajectory file')
+    parser.add_argument('--gif-file', default=None,
+                        help='GIF file of --plot-gif (figures/traffic_simulation.gif by default), '
+                             'or a directory to write a sequence of PNG files into')
+    parser.add_argument('--gif-frame-skip', type=int, default=1, help='keep every N-th frame of the animation')
+    parser.add_argument('--gif-scale', type=float, default=1.0, help='downscaling factor of the animation frames')
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'npy'], default='csv',
+                        help='format of the data files: CSV, Parquet (needs pyarrow) or memory-mappable .npy arrays')
     args = parser.parse_args()
 
     logging.info(f"Arugments {vars(args)}")
     logging.info("Starting the simulator...")
 
-    game = Environment(args)
+    if args.resume:
+        game = Environment.resume(args.checkpoint_file)
+        game.verify = args.verify or game.verify
+    else:
+        game = Environment(args)
     logging.info("Created Environment Object...")
     game.run()
     logging.info("End of the simulation...")
@@ -0,0 +1,82 @@
+import csv
+import os
+
+import numpy as np
+
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'npy')
+
+
+def data_file(path, output_format):
+    # Path of a data file in the given output format, e.g. 'data/flow_density_data.parquet'
+    return os.path.splitext(path)[0] + '.' + output_format
+
+
+class TableWriter:
+    # Writes the rows of a data table such as the fundamental diagrams, keeping only the 'fieldnames' of each row.
+    # CSV rows are written as they come, Parquet and .npy tables are written when the writer is closed.
+    def __init__(self, path, fieldnames, output_format='csv'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+
+        self.path = data_file(path, output_format)
+        self.fieldnames = fieldnames
+        self.output_format = output_format
+        self.rows = []
+
+        if output_format == 'csv':
+            self.file = open(self.path, "w")
+            self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+            self.writer.writeheader()
+
+    def writerow(self, row):
+        if self.output_format == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.rows.append(row)
+
+    def __getstate__(self):
+        # Pickled by the checkpoints of 'Environment' (see checkpoint.py) with the offset of the CSV file,
+        # whose rows after the checkpoint are dropped when it is resumed
+        state = dict(self.__dict__)
+        if self.output_format == 'csv':
+            self.file.flush()
+            state['offset'] = self.file.tell()
+            del state['file'], state['writer']
+        return state
+
+    def __setstate__(self, state):
+        offset = state.pop('offset', None)
+        self.__dict__.update(state)
+        if self.output_format == 'csv':
+            self.file = open(self.path, "r+")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore')
+
+    def close(self):
+        if self.output_format == 'csv':
+            self.file.close()
+        elif self.output_format == 'parquet':
+            import pandas as pd
+            pd.DataFrame(self.rows, columns=self.fieldnames).to_parquet(self.path, index=False)
+        else:
+            # A structured array, so np.load(path, mmap_mode='r')['flow'] reads a single column
+            # Columns of names (e.g. the vehicle classes) are stored as strings
+            dtype = [(name, f'U{max(len(row[name]) for row in self.rows)}')
+                     if self.rows and isinstance(self.rows[0][name], str) else (name, float)
+                     for name in self.fieldnames]
+            table = np.array([tuple(row[name] for name in self.fieldnames) for row in self.rows], dtype=dtype)
+            np.save(self.path, table)
+
+
+def read_table(path, output_format='csv'):
+    # Load a data table written by 'TableWriter' as a DataFrame, pandas is only loaded when a table is read
+    import pandas as pd
+
+    path = data_file(path, output_format)
+    if output_format == 'csv':
+        return pd.read_csv(path)
+    if output_format == 'parquet':
+        return pd.read_parquet(path)
+    return pd.DataFrame(np.load(path, mmap_mode='r'))
@@ -0,0 +1,201 @@
+import math
+import os
+import shutil
+
+import numpy as np
+
+
+TRAJECTORY_COLUMNS = ['Simulation No', 'Car', 'Time', 'Position', 'Velocity', 'Acceleration']
+
+# Where the trajectory of each output format goes, relative to the trajectory path without extension:
+# a CSV file, a Parquet dataset partitioned by simulation number, or one directory of .npy arrays per simulation
+TRAJECTORY_SUFFIXES = {'csv': '.csv', 'parquet': '.parquet', 'npy': '_npy'}
+
+
+def trajectory_file(path, output_format):
+    return os.path.splitext(path)[0] + TRAJECTORY_SUFFIXES[output_format]
+
+
+def simulation_directory(path, simulation_count, output_format):
+    # Parquet partition or .npy directory holding the trajectory of one simulation
+    if output_format == 'parquet':
+        return os.path.join(path, f'simulation={simulation_count}')
+    return os.path.join(path, f'simulation_{simulation_count:03d}')
+
+
+def trajectory_data_frame(simulation_count, time, position, velocity, acceleration, first_row=0):
+    # One line per vehicle and time step, from the (time step, vehicle) arrays of a simulation.
+    # pandas is only loaded when a trajectory is exported or read.
+    import pandas as pd
+
+    steps, num_vehicles = position.shape
+    rows = steps * num_vehicles
+    return pd.DataFrame({
+        'Simulation No': np.full(rows, simulation_count),
+        'Car': np.tile(np.arange(num_vehicles), steps),
+        'Time': np.repeat(time, num_vehicles),
+        'Position': position.ravel(),
+        'Velocity': velocity.ravel(),
+        'Acceleration': acceleration.ravel(),
+    }, columns=TRAJECTORY_COLUMNS, index=pd.RangeIndex(first_row, first_row + rows))
+
+
+class TrajectoryRecorder:
+    # Records the trajectory of every vehicle into preallocated arrays, one row per recorded time step,
+    # and writes them to 'path' in chunks of 'chunk_steps' rows, so only one chunk is held in memory.
+    # Only every 'decimation'-th of the 'num_steps' time steps of a simulation is recorded.
+    def __init__(self, path, num_steps, decimation=1, chunk_steps=100, output_format='csv'):
+        self.path = trajectory_file(path, output_format)
+        self.output_format = output_format
+        self.decimation = decimation
+        self.recorded_steps = math.ceil(num_steps / decimation)
+        self.chunk_steps = min(chunk_steps, self.recorded_steps)
+        self.rows_written = 0
+        self.buffered_steps = 0
+        self.file = None
+        self.arrays = None
+
+        if output_format != 'csv':
+            os.makedirs(self.path, exist_ok=True)
+
+    def start(self, simulation_count, num_vehicles):
+        # Write out what is left of the previous scenario and allocate the buffers for a new one
+        self.finish()
+        self.simulation_count = simulation_count
+        self.num_vehicles = num_vehicles
+        self.step_count = 0
+        self.buffered_steps = 0
+        self.chunk_count = 0
+        self.time = np.empty(self.chunk_steps)
+        self.position = np.empty((self.chunk_steps, num_vehicles))
+        self.velocity = np.empty((self.chunk_steps, num_vehicles))
+        self.acceleration = np.empty((self.chunk_steps, num_vehicles))
+
+        if self.output_format != 'csv':
+            # The partition or directory of the simulation is written anew, as the CSV file is, so that no
+            # parts of an earlier run (e.g. with another chunk size) are left in it
+            shutil.rmtree(simulation_directory(self.path, simulation_count, self.output_format), ignore_errors=True)
+
+        if self.output_format == 'npy':
+            # The arrays of the simulation are preallocated on disk and filled chunk by chunk
+            directory = simulation_directory(self.path, simulation_count, 'npy')
+            os.makedirs(directory, exist_ok=True)
+            self.arrays = {name: np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'), mode='w+',
+                                                           shape=(self.recorded_steps, ) + buffer.shape[1:])
+                           for name, buffer in (('time', self.time), ('position', self.position),
+                                                ('velocity', self.velocity), ('acceleration', self.acceleration))}
+
+    def record(self, time_elapsed, position, velocity, acceleration):
+        self.step_count += 1
+        if (self.step_count - 1) % self.decimation:
+            return
+
+        row = self.buffered_steps
+        self.time[row] = time_elapsed
+        self.position[row] = position
+        self.velocity[row] = velocity
+        self.acceleration[row] = acceleration
+        self.buffered_steps += 1
+
+        if self.buffered_steps == self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        # Write the buffered rows to the trajectory output
+        steps = self.buffered_steps
+        if not steps:
+            return
+
+        if self.output_format == 'npy':
+            start = self.chunk_count * self.chunk_steps
+            for name, array in self.arrays.items():
+                array[start:start + steps] = getattr(self, name)[:steps]
+                array.flush()
+        else:
+            df_trajectory = trajectory_data_frame(self.simulation_count, self.time[:steps], self.position[:steps],
+                                                  self.velocity[:steps], self.acceleration[:steps],
+                                                  self.rows_written)
+            if self.output_format == 'parquet':
+                directory = simulation_directory(self.path, self.simulation_count, 'parquet')
+                os.makedirs(directory, exist_ok=True)
+                df_trajectory.to_parquet(os.path.join(directory, f'part-{self.chunk_count:05d}.parquet'))
+            elif self.file is None:
+                self.file = open(self.path, "w", newline='')
+                df_trajectory.to_csv(self.file)
+            else:
+                df_trajectory.to_csv(self.file, header=False)
+
+        self.rows_written += steps * self.num_vehicles
+        self.chunk_count += 1
+        self.buffered_steps = 0
+
+    def finish(self):
+        # Write out the rest of the simulation. The .npy arrays of a simulation that ended before
+        # 'num_steps' (see 'SteadyStateWindow') are cut to the recorded time steps.
+        self.flush()
+        if self.arrays is None:
+            return
+
+        recorded = math.ceil(self.step_count / self.decimation)
+        arrays, self.arrays = self.arrays, None
+        if recorded < self.recorded_steps:
+            directory = simulation_directory(self.path, self.simulation_count, 'npy')
+            for name in list(arrays):
+                np.save(os.path.join(directory, f'{name}.npy'), np.array(arrays.pop(name)[:recorded]))
+
+    def __getstate__(self):
+        # Pickled by the checkpoints of 'Environment' (see checkpoint.py) with the offset of the CSV file and
+        # without the memory maps of the .npy arrays, which are opened again when the checkpoint is resumed
+        state = dict(self.__dict__)
+        if self.file is not None:
+            self.file.flush()
+            state['offset'] = self.file.tell()
+        state['file'] = None
+        state['arrays'] = None if self.arrays is None else list(self.arrays)
+        return state
+
+    def __setstate__(self, state):
+        offset = state.pop('offset', None)
+        self.__dict__.update(state)
+        if offset is not None:
+            self.file = open(self.path, "r+", newline='')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        if self.arrays is not None:
+            directory = simulation_directory(self.path, self.simulation_count, 'npy')
+            self.arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r+')
+                           for name in self.arrays}
+
+    def close(self):
+        self.finish()
+        if self.file is not None:
+            self.file.close()
+
+
+def read_trajectory(path, simulation_count, start_time=None, end_time=None, output_format='csv'):
+    # Load the trajectory of one simulation, optionally restricted to start_time <= Time <= end_time.
+    # Parquet only reads the partition of the simulation and .npy memory maps its arrays, so neither
+    # parses the whole trajectory; a CSV file is scanned in chunks.
+    import pandas as pd
+
+    path = trajectory_file(path, output_format)
+    start_time = -np.inf if start_time is None else start_time
+    end_time = np.inf if end_time is None else end_time
+
+    if output_format == 'npy':
+        directory = simulation_directory(path, simulation_count, 'npy')
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                  for name in ('time', 'position', 'velocity', 'acceleration')}
+        first = np.searchsorted(arrays['time'], start_time, side='left')
+        last = np.searchsorted(arrays['time'], end_time, side='right')
+        return trajectory_data_frame(simulation_count, *(arrays[name][first:last] for name in
+                                                          ('time', 'position', 'velocity', 'acceleration')))
+
+    if output_format == 'parquet':
+        return pd.read_parquet(simulation_directory(path, simulation_count, 'parquet'),
+                               filters=[('Time', '>=', start_time), ('Time', '<=', end_time)])
+
+    chunks = (chunk[(chunk['Simulation No'] == simulation_count) &
+                    (chunk['Time'] >= start_time) & (chunk['Time'] <= end_time)]
+              for chunk in pd.read_csv(path, index_col=0, chunksize=100000))
+    return pd.concat(chunks)